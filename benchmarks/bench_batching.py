@@ -0,0 +1,89 @@
+"""
+Публикация строк по одной против пачек MessageBatcher.
+По умолчанию брокера нет: публикатор собирает кадры AMQP так же, как pika (Basic.Publish, заголовок, тело),
+а --rtt добавляет на каждую публикацию задержку, как у синхронного basic_publish с подтверждением.
+С --amqp публикует в настоящий RabbitMQ из config.py (в очереди с постфиксом _test).
+    python benchmarks/bench_batching.py [--lines N] [--rtt 0.0002] [--amqp]
+"""
+import argparse
+import asyncio
+import os
+import sys
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pika
+from pika import frame, spec
+
+from lib.message_queue import MessageBatcher, ExchangePublisherRabbitManager
+from benchmarks.bench_json_codec import make_corpus
+
+
+class FramingPublisher(object):
+    """Делает с сообщением то же, что pika перед отправкой в сокет, и ждёт rtt секунд"""
+
+    def __init__(self, rtt=0):
+        self.rtt = rtt
+        self.messages = 0
+        self.bytes = 0
+
+    def send_message(self, message, headers=None):
+        properties = pika.BasicProperties(delivery_mode=2, headers=headers)
+        data = (frame.Method(1, spec.Basic.Publish(exchange='android_log_exchange', routing_key='')).marshal() +
+                frame.Header(1, len(message), properties).marshal() + frame.Body(1, message).marshal())
+        self.messages += 1
+        self.bytes += len(data)
+        if self.rtt:
+            sleep(self.rtt)
+
+
+def run(lines, publisher, batched, lines_per_pass):
+    """Отдаёт строки по lines_per_pass за проход цикла событий, как если бы они пришли от устройств"""
+    loop = asyncio.new_event_loop()
+    sender = MessageBatcher(publisher, loop) if batched else publisher
+    chunks = [lines[i:i + lines_per_pass] for i in range(0, len(lines), lines_per_pass)]
+
+    def feed():
+        if not chunks:
+            loop.call_soon(loop.stop)
+            return
+        for line in chunks.pop(0):
+            sender.send_message(line, headers={'server_time': 1500000000})
+        loop.call_soon(feed)
+
+    start = perf_counter()
+    loop.call_soon(feed)
+    loop.run_forever()
+    elapsed = perf_counter() - start
+    loop.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--lines-per-pass', type=int, default=50, dest='lines_per_pass',
+                        help="сколько строк приходит от устройств за один проход цикла событий")
+    parser.add_argument('--rtt', type=float, default=0, help="задержка каждой публикации, секунд")
+    parser.add_argument('--amqp', action='store_true', help="публиковать в RabbitMQ из config.py")
+    args = parser.parse_args()
+
+    lines = make_corpus(args.lines)
+    for batched in (False, True):
+        if args.amqp:
+            ExchangePublisherRabbitManager.DEBUG = True
+            publisher = ExchangePublisherRabbitManager(exchange="android_log_exchange",
+                                                       queues=("android_loader_log",))
+        else:
+            publisher = FramingPublisher(rtt=args.rtt)
+        elapsed = run(lines, publisher, batched, args.lines_per_pass)
+        messages = getattr(publisher, 'messages', None)
+        print("{:<9} {:9.0f} lines/s  {}".format(
+            "batched" if batched else "per line", len(lines) / elapsed,
+            "" if messages is None else "{} messages, {:.0f} bytes per line on the wire".format(
+                messages, publisher.bytes / len(lines))))
+
+
+if __name__ == '__main__':
+    main()
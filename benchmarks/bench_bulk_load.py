@@ -0,0 +1,73 @@
+"""
+LOAD DATA LOCAL INFILE (Database.bulk_load, которым загрузчик разбирает накопившуюся очередь) против executemany
+(обычная запись пачек) на настоящей базе из config.DB_CONFIG.
+Строки пишутся в отдельную таблицу --scratch-table, созданную по образцу --table (CREATE TABLE ... LIKE),
+которая в конце удаляется. На сервере должен быть включен local_infile, иначе сравнивать не с чем.
+Для каждого размера пачки печатает строк в секунду обоими способами.
+    python benchmarks/bench_bulk_load.py [--rows 100000] [--batch-sizes 100 1000 10000 50000] [--db logdb]
+"""
+import argparse
+import logging
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.database import Database
+from loaders.logdb_loader import AndroidLogLoader
+
+FIELDS = AndroidLogLoader().fields
+
+
+def make_rows(count):
+    now = int(time())
+    return [(n % 1000, now, now - n % 3600, 'benchmark line {} with some log text \t and "quotes"'.format(n))
+            for n in range(count)]
+
+
+def load(db_name, table, rows, batch_size, bulk):
+    """Пишет rows пачками по batch_size. :return: строк в секунду"""
+    with Database(db_name, persistent=True, local_infile=bulk) as db:
+        db.cursor().execute("TRUNCATE TABLE {}".format(table))
+        start = time()
+        for offset in range(0, len(rows), batch_size):
+            batch = rows[offset:offset + batch_size]
+            if bulk:
+                db.bulk_load(table, FIELDS, batch)
+            else:
+                db.insert_many(table, FIELDS, batch)
+        return len(rows) / (time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='logdb', help="имя базы в config.DB_CONFIG")
+    parser.add_argument('--table', default='android.logs_android', help="таблица-образец")
+    parser.add_argument('--scratch-table', default='android.bench_bulk_load', dest='scratch_table',
+                        help="временная таблица, удаляется в конце")
+    parser.add_argument('--rows', type=int, default=100000, help="строк на каждый прогон")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 1000, 10000, 50000], dest='batch_sizes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    rows = make_rows(args.rows)
+    with Database(args.db) as db:
+        db.cursor().execute("CREATE TABLE {} LIKE {}".format(args.scratch_table, args.table))
+    try:
+        print("{} rows into {}".format(args.rows, args.scratch_table))
+        for batch_size in args.batch_sizes:
+            bulk_rate = load(args.db, args.scratch_table, rows, batch_size, bulk=True)
+            if args.db in Database.bulk_load_refused:
+                print("{} refuses LOAD DATA LOCAL INFILE, nothing to compare".format(args.db))
+                return
+            insert_rate = load(args.db, args.scratch_table, rows, batch_size, bulk=False)
+            print("batch {:6d}: LOAD DATA {:9.0f} rows/s, executemany {:9.0f} rows/s, x{:.1f}".format(
+                batch_size, bulk_rate, insert_rate, bulk_rate / insert_rate))
+    finally:
+        with Database(args.db) as db:
+            db.cursor().execute("DROP TABLE {}".format(args.scratch_table))
+
+
+if __name__ == '__main__':
+    main()
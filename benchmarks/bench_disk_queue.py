@@ -0,0 +1,96 @@
+"""
+Пропускная способность очереди на диске (lib/disk_queue.py): запись пачек строк, как от MessageBatcher,
+затем чтение с подтверждением, как в загрузчике. Для каждого DiskQueue.fsync_interval из --fsync.
+С --amqp то же самое через RabbitMQ из config.py (очередь android_loader_log_test) для сравнения.
+    python benchmarks/bench_disk_queue.py [--messages N] [--lines-per-message 50] [--fsync 1 0 none] [--amqp]
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.disk_queue import DiskQueue, DiskQueuePublisher, DiskQueueReader
+from lib.message_queue import MessageBatcher, ExchangePublisherRabbitManager, ReaderRabbitManager, \
+    AbstractRabbitManager
+from benchmarks.bench_json_codec import make_corpus
+
+QUEUE = 'android_loader_log'
+
+
+def make_messages(count, lines_per_message):
+    lines = make_corpus(count * lines_per_message)
+    headers = {MessageBatcher.BATCH_SIZE_HEADER: lines_per_message, 'server_time': 1500000000}
+    return [(MessageBatcher.BATCH_DELIMITER.join(lines[i:i + lines_per_message]), headers)
+            for i in range(0, len(lines), lines_per_message)]
+
+
+def run(publisher, reader_factory, messages):
+    """Возвращает (секунд на запись, секунд на чтение с подтверждением)"""
+    start = perf_counter()
+    for body, headers in messages:
+        publisher.send_message(body, headers=headers)
+    publisher.drain()
+    written = perf_counter() - start
+
+    reader = reader_factory()
+    start = perf_counter()
+    tag = None
+    for n in range(len(messages)):
+        _, method, _, _ = reader.read_one(block=True, timeout=30)
+        tag = method.delivery_tag
+        # загрузчик подтверждает пачками, после записи в базу
+        if n % 20 == 19:
+            reader.ack(tag)
+    reader.ack(tag)
+    return written, perf_counter() - start
+
+
+def report(name, messages, lines_per_message, written, read):
+    bytes_total = sum(len(body) for body, _ in messages)
+    print("{:<16} write {:8.0f} msg/s {:9.0f} lines/s {:6.1f} MB/s   read+ack {:8.0f} msg/s {:9.0f} lines/s".format(
+        name, len(messages) / written, len(messages) * lines_per_message / written, bytes_total / written / 1e6,
+        len(messages) / read, len(messages) * lines_per_message / read))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--lines-per-message', type=int, default=50, dest='lines_per_message')
+    parser.add_argument('--fsync', nargs='+', default=['1', '0', 'none'],
+                        help="значения DiskQueue.fsync_interval, секунд; none - не сбрасывать на диск")
+    parser.add_argument('--dir', default=None, help="где создавать очередь (по умолчанию во временном каталоге)")
+    parser.add_argument('--amqp', action='store_true', help="сравнить с RabbitMQ из config.py")
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.lines_per_message)
+    print("{} messages of {} lines, {:.0f} bytes on average".format(
+        len(messages), args.lines_per_message, sum(len(body) for body, _ in messages) / len(messages)))
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        for fsync in args.fsync:
+            DiskQueue.fsync_interval = None if fsync == 'none' else float(fsync)
+            DiskQueue.base_directory = os.path.join(directory, 'fsync_' + fsync)
+            publisher = DiskQueuePublisher(exchange=None, queues=(QUEUE,))
+            written, read = run(publisher, lambda: DiskQueueReader(QUEUE, prefetch_count=1000), messages)
+            report("disk, fsync {}".format(fsync), messages, args.lines_per_message, written, read)
+    finally:
+        # читатели остаются ждать новых сообщений, их падение из-за удалённого каталога неинтересно
+        logging.disable(logging.CRITICAL)
+        shutil.rmtree(directory)
+
+    if args.amqp:
+        AbstractRabbitManager.DEBUG = True
+        publisher = ExchangePublisherRabbitManager(exchange="android_log_exchange", queues=(QUEUE,))
+        publisher.drain = lambda timeout=None: True  # публикация синхронная
+        written, read = run(publisher, lambda: ReaderRabbitManager(QUEUE, prefetch_count=1000), messages)
+        report("amqp", messages, args.lines_per_message, written, read)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Сколько стоят простаивающие соединения устройств и как закрываются зависшие.
+Приёмщик (AndroidLogProtocol с колесом таймеров) слушает в этом процессе, отдельный процесс открывает
+--connections соединений: половина молчит, половина присылает начало строки без перевода строки (slowloris).
+Печатает прирост RSS на соединение, CPU приёмщика в простое и когда закрылись обе группы.
+    python benchmarks/bench_idle_connections.py [--connections 10000] [--idle-timeout 20] [--partial-line-timeout 10]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import subprocess
+import sys
+from time import monotonic, process_time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.metrics import MetricsSlot
+from protocols.android_log_protocol import AndroidLogProtocol
+from protocols.protocol_handler import ProtocolHandler
+
+CLIENT = '''
+import socket, sys, time
+connections = []
+for n in range({count}):
+    connection = socket.create_connection(("127.0.0.1", {port}))
+    connections.append(connection)
+    if n % 2:
+        connection.send(b'{{"type": "log", "text": "partial')
+time.sleep(3600)
+'''
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+
+
+async def wait_for(metrics, name, value):
+    while metrics.get(name) < value:
+        await asyncio.sleep(0.1)
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    metrics = MetricsSlot(ProtocolHandler.METRICS)
+    AndroidLogProtocol.protocol_manager = SimpleNamespace(metrics=metrics, working_tick=lambda status: None)
+    AndroidLogProtocol.rabbit_manager = SimpleNamespace(send_message=lambda *a, **kw: None)
+    AndroidLogProtocol.MAX_CONNECTIONS = args.connections + 10
+    AndroidLogProtocol.IDLE_TIMEOUT = args.idle_timeout
+    AndroidLogProtocol.PARTIAL_LINE_TIMEOUT = args.partial_line_timeout
+    AndroidLogProtocol.start_timers(loop)
+
+    server = await loop.create_server(AndroidLogProtocol, '127.0.0.1', 0, backlog=4096)
+    port = server.sockets[0].getsockname()[1]
+    rss_before = rss_mb()
+    client = subprocess.Popen([sys.executable, '-c', CLIENT.format(count=args.connections, port=port)])
+    try:
+        await wait_for(metrics, 'receiver_connections', args.connections)
+        start_time, start_cpu = monotonic(), process_time()
+        rss_delta = rss_mb() - rss_before
+        print("{} connections: RSS +{:.1f} MB, {:.2f} KB per connection".format(
+            args.connections, rss_delta, rss_delta * 1000 / args.connections))
+
+        await asyncio.sleep(args.idle_sample)
+        print("idle CPU {:.2f}% of a core over {} s".format(100 * (process_time() - start_cpu) / args.idle_sample,
+                                                          args.idle_sample))
+        await wait_for(metrics, 'receiver_connections_partial_line_closed_total', args.connections // 2)
+        print("partial-line connections closed at {:.1f} s (timeout {} s)".format(
+            monotonic() - start_time, args.partial_line_timeout))
+        await wait_for(metrics, 'receiver_connections_idle_closed_total', args.connections - args.connections // 2)
+        print("idle connections closed at {:.1f} s (timeout {} s), receiver CPU {:.2f} s in total".format(
+            monotonic() - start_time, args.idle_timeout, process_time() - start_cpu))
+    finally:
+        client.kill()
+        server.close()
+        AndroidLogProtocol.timers.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--idle-timeout', type=float, default=20, dest='idle_timeout')
+    parser.add_argument('--partial-line-timeout', type=float, default=10, dest='partial_line_timeout')
+    parser.add_argument('--idle-sample', type=float, default=5, dest='idle_sample',
+                        help="сколько секунд мерить CPU в простое (меньше --partial-line-timeout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # по дескриптору на соединение с каждой стороны, клиент - дочерний процесс и наследует лимит
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.connections + 100
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Сколько CPU уходит на JSON на одну строку лога: стандартный json против lib.json_codec.
+Строки - синтетические, но похожие на настоящие: строки logcat разной длины, кириллица, стектрейсы.
+    python benchmarks/bench_json_codec.py [--lines N]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import json_codec
+from protocols.android_log_protocol import AndroidLogProtocol
+
+TAGS = ('ActivityManager', 'PackageManager', 'WifiStateMachine', 'chromium', 'Launcher', 'Пульс', 'dalvikvm')
+MESSAGES = (
+    'Start proc {pid}:com.example.app/u0a{uid} for activity com.example.app/.MainActivity',
+    'Displayed com.example.app/.MainActivity: +{ms}ms',
+    'Соединение с сервером потеряно, повтор через {ms} мс',
+    'GC_CONCURRENT freed {kb}K, 12% free 9876K/11207K, paused {ms}ms+{ms}ms',
+    'java.lang.NullPointerException: Attempt to invoke virtual method on a null object reference\n' +
+    ''.join('\tat com.example.app.Module{n}.method{n}(Module{n}.java:{n})\n'.format(n=n) for n in range(30)),
+)
+
+
+def make_corpus(count, seed=1):
+    """Строки в том виде, в каком их присылают устройства"""
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        text = "{} {:5d} {:5d} {} {}: {}".format(
+            '10-18 15:08:13.123', rng.randrange(100, 30000), rng.randrange(100, 30000), rng.choice('VDIWE'),
+            rng.choice(TAGS), rng.choice(MESSAGES).format(pid=rng.randrange(30000), uid=rng.randrange(200),
+                                                          ms=rng.randrange(2000), kb=rng.randrange(4096)))
+        device_line = {'type': 'log', 'id': str(rng.randrange(10**9)), 'time': 1500000000 + rng.random() * 10**6,
+                       'text': text}
+        lines.append(json.dumps(device_line, ensure_ascii=False).encode('utf-8'))
+    return lines
+
+
+def stdlib_pipeline(line):
+    """Как было: разбор в приёмщике, сериализация с server_time, разбор в загрузчике"""
+    parse = json.loads(line)
+    parse['server_time'] = 1500000000
+    return json.loads(json.dumps(parse).encode('utf-8'))
+
+
+def codec_pipeline(line):
+    """То же самое через lib.json_codec"""
+    parse = json_codec.loads(line)
+    parse['server_time'] = 1500000000
+    return json_codec.loads(json_codec.dumps(parse))
+
+
+def pass_through_pipeline(line):
+    """Приёмщик пересылает строку как есть (PASS_THROUGH), разбирает только загрузчик"""
+    return json_codec.loads(line)
+
+
+def receiver_parse(line):
+    """Приёмщик без PASS_THROUGH: разбор и проверка полей"""
+    parse = json_codec.loads(line)
+    return parse.get('type') == 'log' and AndroidLogProtocol.validate(parse)
+
+
+def receiver_check(line):
+    """Что в режиме PASS_THROUGH остаётся приёмщику вместо разбора"""
+    return AndroidLogProtocol.looks_like_json_object(line) and AndroidLogProtocol.LOG_TYPE_MARKER in line
+
+
+def measure(function, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        for line in lines:
+            function(line)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lines = make_corpus(args.lines)
+    print("{} lines, {:.0f} bytes on average, codec backend: {}".format(
+        len(lines), sum(map(len, lines)) / len(lines), json_codec.backend))
+    baseline = measure(stdlib_pipeline, lines, args.repeat)
+    for name, function in (('stdlib json', stdlib_pipeline), ('json_codec', codec_pipeline),
+                           ('json_codec, pass-through', pass_through_pipeline),
+                           ('receiver: parse, validate', receiver_parse),
+                           ('receiver: pass-through', receiver_check)):
+        per_line = baseline if function is stdlib_pipeline else measure(function, lines, args.repeat)
+        print("{:<26} {:7.2f} us/line  x{:.1f}".format(name, per_line * 1e6, baseline / per_line))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Скорость записи в базу в зависимости от числа загрузчиков (logdb_server.py --loaders N).
+Загрузчики - настоящие AndroidLogLoader в отдельных процессах, как под ProcessAliver, но база и брокер ненастоящие:
+каждый загрузчик получает свою долю из --messages сообщений по --lines-per-message строк уже в локальной очереди
+и останавливается, выбрав её. Запись пачки занимает --db-latency секунд плюс --db-row-time на строку,
+одновременно база выполняет не больше --db-concurrency запросов (остальные ждут, как на блокировках и ядрах сервера).
+Печатает строк в секунду для каждого числа загрузчиков.
+    python benchmarks/bench_loader_workers.py [--workers 1 2 4 8] [--messages 2000] [--db-concurrency 4]
+"""
+import argparse
+import logging
+import os
+import sys
+from multiprocessing import BoundedSemaphore
+from queue import Queue, Empty
+from time import sleep, time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import json_codec
+from lib.common import Node
+from lib.message_queue import MessageBatcher
+from loaders.logdb_loader import AndroidLogLoader
+
+
+class FakeReader(object):
+    """Локальная очередь, заполненная заранее. Когда сообщения кончаются, останавливает загрузчик."""
+
+    def __init__(self, loader, messages):
+        self.loader = loader
+        self.local_queue = Queue()
+        self.channel = object()
+        for tag, (properties, body) in enumerate(messages, 1):
+            self.local_queue.put((self.channel, SimpleNamespace(delivery_tag=tag), properties, body))
+
+    def read_one(self, block=False, timeout=None):
+        try:
+            return self.local_queue.get_nowait()
+        except Empty:
+            self.loader.request_stop()
+            raise
+
+    def is_current(self, channel):
+        return channel is None or channel is self.channel
+
+    def ack(self, tag, channel=None, multiple=True):
+        pass
+
+
+class BenchmarkLoader(AndroidLogLoader):
+    """Запись в базу заменена задержкой под общим на все процессы ограничением параллельных запросов"""
+
+    def __init__(self, messages, database, args):
+        super(BenchmarkLoader, self).__init__()
+        self.SPOOL_DIR = None
+        self.MAX_INFLIGHT_BATCHES = args.inflight
+        self.messages = messages
+        self.database = database
+        self.db_latency = args.db_latency
+        self.db_row_time = args.db_row_time
+
+    def run(self):
+        self.handle_stop_signal()
+        self.read_rabbit_manager = FakeReader(self, self.messages)
+        Node.run(self)
+
+    def insert_batch(self, rows, bulk, retry=True):
+        with self.database:
+            sleep(self.db_latency + self.db_row_time*len(rows))
+        self.metrics.inc('loader_rows_inserted_total', len(rows))
+
+
+def make_messages(count, lines_per_message):
+    headers = {MessageBatcher.BATCH_SIZE_HEADER: lines_per_message, 'server_time': int(time())}
+    messages = []
+    for tag in range(count):
+        lines = [json_codec.dumps({'type': 'log', 'id': str(tag), 'time': n, 'text': 'line {} of message'.format(n)})
+                 for n in range(lines_per_message)]
+        messages.append((SimpleNamespace(headers=headers), MessageBatcher.BATCH_DELIMITER.join(lines)))
+    return messages
+
+
+def trial(messages, workers, args):
+    database = BoundedSemaphore(args.db_concurrency)
+    # как ProcessAliver: все экземпляры создаются в родителе, потом запускаются
+    loaders = [BenchmarkLoader(messages[n::workers], database, args) for n in range(workers)]
+    start = time()
+    for loader in loaders:
+        loader.start()
+    for loader in loaders:
+        loader.join()
+    elapsed = time() - start
+
+    rows = sum(loader.metrics.get('loader_rows_inserted_total') for loader in loaders)
+    print("{:3d} workers: {:8.0f} rows in {:6.2f} s, {:9.0f} rows/s".format(workers, rows, elapsed, rows / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="числа загрузчиков")
+    parser.add_argument('--messages', type=int, default=2000, help="сообщений на весь прогон")
+    parser.add_argument('--lines-per-message', type=int, default=50, dest='lines_per_message')
+    parser.add_argument('--db-latency', type=float, default=0.005, dest='db_latency',
+                        help="время запроса без учёта строк, секунд")
+    parser.add_argument('--db-row-time', type=float, default=0.00002, dest='db_row_time',
+                        help="время записи одной строки, секунд")
+    parser.add_argument('--db-concurrency', type=int, default=4, dest='db_concurrency',
+                        help="сколько запросов база выполняет одновременно")
+    parser.add_argument('--inflight', type=int, default=2, help="MAX_INFLIGHT_BATCHES загрузчика")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    messages = make_messages(args.messages, args.lines_per_message)
+    print("{} messages x {} lines, db: {} s + {} s/row, {} concurrent queries".format(
+        args.messages, args.lines_per_message, args.db_latency, args.db_row_time, args.db_concurrency))
+    for workers in args.workers:
+        trial(messages, workers, args)
+
+
+if __name__ == '__main__':
+    main()
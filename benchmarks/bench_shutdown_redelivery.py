@@ -0,0 +1,116 @@
+"""
+Сколько работы повторяется после перезапуска загрузчика: остановка по SIGTERM с доливом буфера (shutdown)
+против остановки без него (как было до корректного завершения - процесс просто выходил).
+База и брокер ненастоящие: сообщения по --lines-per-message строк приходят с частотой --rate в секунду,
+запись пачки занимает --db-latency секунд. Через --run секунд загрузчик получает request_stop().
+После перезапуска брокер отдаст заново все неподтверждённые сообщения. Считается:
+- прочитанные, но не подтверждённые сообщения (их разбор повторится);
+- строки, уже записанные в базу, но из неподтверждённых сообщений (они будут вставлены ещё раз);
+- строки, лежавшие в буфере (не потеряны, но работа по ним пропала).
+    python benchmarks/bench_shutdown_redelivery.py [--run 3] [--rate 2000] [--db-latency 0.05] [--inflight 2]
+"""
+import argparse
+import logging
+import os
+import sys
+from queue import Queue
+from threading import Thread, Timer, Event
+from time import sleep, time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import json_codec
+from lib.common import Node
+from lib.message_queue import MessageBatcher
+from loaders.logdb_loader import AndroidLogLoader
+
+
+class FakeReader(object):
+    """Очередь брокера: сообщения с растущими delivery_tag, запоминает последний подтверждённый"""
+
+    def __init__(self, prefetch_count):
+        self.local_queue = Queue(maxsize=prefetch_count)
+        self.channel = object()
+        self.acked_tag = 0
+        self.read_tag = 0
+
+    def read_one(self, block=False, timeout=None):
+        message = self.local_queue.get(block=block, timeout=timeout)
+        self.read_tag = message[1].delivery_tag
+        return message
+
+    def is_current(self, channel):
+        return channel is None or channel is self.channel
+
+    def ack(self, tag, channel=None, multiple=True):
+        self.acked_tag = max(self.acked_tag, tag)
+
+
+class BenchmarkLoader(AndroidLogLoader):
+    """Запись в базу заменена задержкой. device_id строки - delivery_tag её сообщения."""
+
+    def __init__(self, db_latency):
+        super(BenchmarkLoader, self).__init__()
+        self.SPOOL_DIR = None
+        self.db_latency = db_latency
+        self.committed = []
+
+    def insert_batch(self, rows, bulk, retry=True):
+        sleep(self.db_latency)
+        self.committed.extend(rows)
+
+
+def produce(reader, rate, lines_per_message, stop):
+    tag = 0
+    while not stop.is_set():
+        tag += 1
+        lines = [json_codec.dumps({'type': 'log', 'id': str(tag), 'time': n, 'text': 'line {}'.format(n)})
+                 for n in range(lines_per_message)]
+        headers = {MessageBatcher.BATCH_SIZE_HEADER: lines_per_message, 'server_time': int(time())}
+        reader.local_queue.put((reader.channel, SimpleNamespace(delivery_tag=tag), SimpleNamespace(headers=headers),
+                                MessageBatcher.BATCH_DELIMITER.join(lines)))
+        sleep(1 / rate)
+
+
+def trial(args, drain):
+    loader = BenchmarkLoader(args.db_latency)
+    loader.MAX_INFLIGHT_BATCHES = args.inflight
+    loader.handle_stop_signal = lambda: None
+    if not drain:
+        loader.shutdown = lambda: None
+    reader = loader.read_rabbit_manager = FakeReader(loader.prefetch_count())
+
+    stop = Event()
+    Thread(target=produce, args=(reader, args.rate, args.lines_per_message, stop), daemon=True).start()
+    Timer(args.run, loader.request_stop).start()
+    Node.run(loader)
+    stop.set()
+
+    # на этом процесс бы завершился: всё, что записано позже (пачки в полёте без долива), не считаем
+    committed = list(loader.committed)
+    reinserted = sum(1 for row in committed if row[0] > reader.acked_tag)
+    print("{:<9} read {:6d} messages, acked {:6d}: {:5d} messages redelivered, {:6d} rows inserted twice, "
+          "{:6d} buffered rows thrown away".format("drain" if drain else "no drain", reader.read_tag,
+                                                   reader.acked_tag, reader.read_tag - reader.acked_tag, reinserted,
+                                                   len(loader.buffer)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--run', type=float, default=3, help="через сколько секунд остановить загрузчик")
+    parser.add_argument('--rate', type=float, default=2000, help="сообщений в секунду")
+    parser.add_argument('--lines-per-message', type=int, default=5, dest='lines_per_message')
+    parser.add_argument('--db-latency', type=float, default=0.05, dest='db_latency', help="время записи пачки, секунд")
+    parser.add_argument('--inflight', type=int, default=2, help="MAX_INFLIGHT_BATCHES загрузчика")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    for _ in range(args.repeat):
+        for drain in (False, True):
+            trial(args, drain)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,143 @@
-#DEPRECATED
-
 import logging
 from time import time, sleep
-from lib.common import Node
 
+from lib.common import Node
+from lib.metrics import COUNTER, GAUGE
 from lib.database import Database
+from config import DB_CONFIG
 
 
 class LogDatabaseCleaner(Node):
+	"""
+	Удаление старых логов для таблиц без партиций (с партициями - LogPartitionManager).
+	Вместо одного огромного DELETE удаляет строки небольшими диапазонами packet_time
+	(не больше CHUNK_ROWS строк за запрос), каждый - отдельной транзакцией.
+	Между запросами спит тем дольше, чем дольше шёл запрос и чем больше отставание реплики,
+	чтобы не мешать вставкам загрузчика.
+	Каждый проход начинается с MIN(packet_time) (по индексу), поэтому после перезапуска
+	удаление продолжается с того места, где остановилось.
+	"""
 
 	CLEANUP_PERIOD = 60*60
 	DELETE_OLDER_THAN = 60*60*24*7  # in seconds
+	CHUNK_ROWS = 5000
+	# какую долю времени можно занимать базу: после запроса длиной t спим t * (1 - DUTY_CYCLE) / DUTY_CYCLE
+	DUTY_CYCLE = 0.2
+	MIN_PAUSE = 0.1
+	MAX_PAUSE = 30
+	# имя реплики в DB_CONFIG, по отставанию которой притормаживаем. Если её там нет - не проверяем.
+	REPLICA_DB_NAME = 'logdb_replica'
+	MAX_REPLICATION_LAG = 10  # секунд
+	PROGRESS_LOG_PERIOD = 60
+
+	METRICS = dict(Node.METRICS, **{
+		'cleaner_rows_deleted_total': (COUNTER, "Expired rows deleted"),
+		'cleaner_pause_seconds': (GAUGE, "Current pause between DELETE chunks"),
+	})
+	STATUS_METRICS = ('cleaner_rows_deleted_total',)
+
+	db_name = 'logdb'
+	table = 'android.logs_android'
+	time_column = 'packet_time'
 
 	def __init__(self):
 		super(LogDatabaseCleaner, self).__init__()
+		self.rows_deleted = 0  # с запуска процесса
+		self.rows_per_second = 0
+		self.low_bound = None  # всё, что меньше, уже удалено
+		self.last_progress_log_time = 0
 
 	def run(self):
-		self.last_cleanup_time = time()
-		while True:
+		self.handle_stop_signal()
+		self.last_cleanup_time = 0
+		while not self.stopping:
 			if (time() - self.last_cleanup_time) > self.CLEANUP_PERIOD:
-				with Database('logdb') as db:
-					cursor = db.cursor()
+				logging.info("Performing database cleanup!")
+				self.cleanup()
+				self.last_cleanup_time = time()
 
-					query = """DELETE FROM android.logs_android 
-		WHERE (UNIX_TIMESTAMP() - packet_time) > {};""".format(self.DELETE_OLDER_THAN)
+			sleep(10)
+			self.working_tick(True)
 
-					logging.info("Performing database cleanup!")
-					cursor.execute(query)
+	def cleanup(self):
+		"""Удаляет всё старше DELETE_OLDER_THAN порциями"""
+		threshold = int(time()) - self.DELETE_OLDER_THAN
+		self.low_bound = None
 
-			sleep(10)
+		start_time = time()
+		deleted_this_run = 0
+		while True:
+			with Database(self.db_name, persistent=True) as db:
+				cursor = db.cursor()
+				if self.low_bound is None:
+					cursor.execute("SELECT MIN({column}) FROM {table}".format(column=self.time_column, table=self.table))
+					self.low_bound = cursor.fetchone()[0]
+					if self.low_bound is None:
+						break  # таблица пуста
+
+				# верхняя граница порции: CHUNK_ROWS-я строка от нижней границы
+				cursor.execute("SELECT {column} FROM {table} WHERE {column} >= %s AND {column} < %s "
+								"ORDER BY {column} LIMIT 1 OFFSET %s".format(column=self.time_column, table=self.table),
+								(self.low_bound, threshold, self.CHUNK_ROWS - 1))
+				row = cursor.fetchone()
+				high_bound = row[0] if row else threshold - 1
+
+				chunk_start = time()
+				deleted = cursor.execute("DELETE FROM {table} WHERE {column} >= %s AND {column} <= %s "
+										"ORDER BY {column} LIMIT %s".format(column=self.time_column, table=self.table),
+										(self.low_bound, high_bound, self.CHUNK_ROWS))
+				chunk_time = time() - chunk_start
+
+			deleted_this_run += deleted
+			self.rows_deleted += deleted
+			self.metrics.inc('cleaner_rows_deleted_total', deleted)
+			self.rows_per_second = deleted_this_run / max(time() - start_time, 1e-6)
+			if deleted < self.CHUNK_ROWS:
+				# диапазон до high_bound включительно вычищен
+				self.low_bound = high_bound + 1
+			else:
+				# LIMIT мог оставить строки с packet_time == high_bound (ORDER BY - только их)
+				self.low_bound = high_bound
+			self.log_progress(threshold)
 			self.working_tick(True)
+
+			if self.low_bound >= threshold or self.stopping:
+				break
+			pause = self.pause(chunk_time)
+			self.metrics.set('cleaner_pause_seconds', pause)
+			sleep(pause)
+
+		logging.info("Database cleanup finished: {} rows deleted at {:.0f} rows/s".format(
+			deleted_this_run, self.rows_per_second))
+
+	def pause(self, chunk_time):
+		"""Сколько спать после запроса, длившегося chunk_time секунд"""
+		pause = chunk_time * (1 - self.DUTY_CYCLE) / self.DUTY_CYCLE
+		lag = self.replication_lag()
+		if lag is not None and lag > self.MAX_REPLICATION_LAG:
+			logging.warning("Replication lag is {} s, slowing down cleanup".format(lag))
+			pause = max(pause, lag)
+		return min(max(pause, self.MIN_PAUSE), self.MAX_PAUSE)
+
+	def replication_lag(self):
+		""":return: отставание реплики в секундах или None, если реплика не настроена или не отвечает"""
+		if self.REPLICA_DB_NAME not in DB_CONFIG:
+			return None
+		try:
+			with Database(self.REPLICA_DB_NAME, persistent=True) as db:
+				cursor = db.cursor()
+				cursor.execute("SHOW SLAVE STATUS")
+				row = cursor.fetchone()
+				if not row:
+					return None
+				status = dict(zip((column[0] for column in cursor.description), row))
+				return status.get('Seconds_Behind_Master')
+		except Exception as e:
+			logging.warning("Can't get replication lag: {}".format(e))
+			return None
+
+	def log_progress(self, threshold):
+		if time() - self.last_progress_log_time > self.PROGRESS_LOG_PERIOD:
+			self.last_progress_log_time = time()
+			logging.info("Cleanup progress: deleted up to {} of {} ({} rows, {:.0f} rows/s)".format(
+				self.low_bound, threshold, self.rows_deleted, self.rows_per_second))
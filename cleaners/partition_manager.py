@@ -0,0 +1,219 @@
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from threading import Thread, Event
+from time import time, sleep
+
+from lib.common import Node
+from lib.metrics import COUNTER, GAUGE
+from lib.database import Database
+from cleaners.log_base_cleaner import LogDatabaseCleaner
+
+
+class LogPartitionManager(Node):
+	"""
+	Хранение логов на суточных RANGE-партициях по packet_time.
+	Заранее создаёт партиции на PRECREATE_DAYS суток вперёд и удаляет партиции,
+	все строки которых старше DELETE_OLDER_THAN. Удаление партиции - это DROP PARTITION,
+	он не трогает строки по одной, не блокирует таблицу надолго и не раздувает undo log.
+	Партиции называются pYYYYMMDD (сутки по UTC), последняя - pmax (VALUES LESS THAN MAXVALUE).
+	Пока таблица не партиционирована, старые строки удаляются порционным DELETE (LogDatabaseCleaner),
+	чтобы хранение не переставало ограничиваться молча.
+	"""
+
+	CHECK_PERIOD = 60*60
+	DELETE_OLDER_THAN = 60*60*24*7  # in seconds
+	PRECREATE_DAYS = 3
+	DAY = 60*60*24
+	# Разбить на партиции непартиционированную таблицу. Это полная перестройка таблицы,
+	# поэтому по умолчанию выключено: лучше сделать это вручную в окно обслуживания.
+	PARTITION_EXISTING_TABLE = False
+	# как часто сообщать о работе, пока идёт ALTER TABLE. Должно быть меньше MAX_FROZEN_TIME ProcessAliver,
+	# иначе перестройка таблицы будет убиваться как зависание и начинаться заново.
+	HEARTBEAT_INTERVAL = 10
+
+	# метрики cleaner_* - от порционного DELETE для непартиционированной таблицы
+	METRICS = dict(LogDatabaseCleaner.METRICS, **{
+		'partitions': (GAUGE, "Partitions of the log table"),
+		'partitions_created_total': (COUNTER, "Daily partitions created"),
+		'partitions_dropped_total': (COUNTER, "Expired daily partitions dropped"),
+	})
+	STATUS_METRICS = ('partitions',)
+
+	db_name = 'logdb'
+	schema = 'android'
+	table = 'logs_android'
+	partition_column = 'packet_time'
+
+	def __init__(self):
+		super(LogPartitionManager, self).__init__()
+		self.fallback_cleaner = None  # LogDatabaseCleaner, пока таблица не партиционирована
+
+	def request_stop(self, signum=None, frame=None):
+		super(LogPartitionManager, self).request_stop(signum, frame)
+		if self.fallback_cleaner is not None:
+			self.fallback_cleaner.stopping = True
+
+	def run(self):
+		self.handle_stop_signal()
+		self.last_check_time = 0
+		while not self.stopping:
+			if (time() - self.last_check_time) > self.CHECK_PERIOD:
+				self.maintain()
+				self.last_check_time = time()
+
+			sleep(10)
+			self.working_tick(True)
+
+	@contextmanager
+	def heartbeat(self):
+		"""Пока выполняется тело (долгий запрос), сообщает о работе из отдельного потока"""
+		done = Event()
+
+		def beat():
+			while not done.wait(self.HEARTBEAT_INTERVAL):
+				self.working_tick(True)
+
+		thread = Thread(target=beat, daemon=True)
+		thread.start()
+		try:
+			yield
+		finally:
+			done.set()
+			thread.join()
+			self.working_tick(True)
+
+	@staticmethod
+	def day_start(timestamp):
+		"""Начало суток (UTC), в которые попадает timestamp"""
+		day = datetime.fromtimestamp(timestamp, timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+		return int(day.timestamp())
+
+	@staticmethod
+	def partition_name(day_start):
+		return datetime.fromtimestamp(day_start, timezone.utc).strftime('p%Y%m%d')
+
+	def partition_definition(self, day_start):
+		"""Партиция для суток, начинающихся в day_start"""
+		return "PARTITION {} VALUES LESS THAN ({})".format(self.partition_name(day_start),
+															day_start + self.DAY)
+
+	def get_partitions(self, cursor):
+		"""
+		:return: список (имя партиции, верхняя граница) по порядку. Для MAXVALUE граница None.
+		Пустой список, если таблица не партиционирована.
+		"""
+		cursor.execute("""SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+			WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY PARTITION_ORDINAL_POSITION""",
+						(self.schema, self.table))
+		partitions = []
+		for name, description in cursor.fetchall():
+			if name is None:
+				return []
+			partitions.append((name, None if description == 'MAXVALUE' else int(description)))
+		return partitions
+
+	def maintain(self):
+		with Database(self.db_name, persistent=True) as db:
+			cursor = db.cursor()
+			partitions = self.get_partitions(cursor)
+			if not partitions and self.PARTITION_EXISTING_TABLE and self.partition_table(cursor):
+				partitions = self.get_partitions(cursor)
+
+			if partitions:
+				self.create_partitions(cursor, partitions)
+				self.drop_partitions(cursor, partitions)
+				partitions = self.get_partitions(cursor)
+			self.metrics.set('partitions', len(partitions))
+
+		if not partitions:
+			logging.error("{} is not partitioned! Deleting expired rows with DELETE until it is.".format(
+				self.full_table_name()))
+			# DELETE идёт долго и берёт соединения сам, поэтому уже после with
+			self.delete_expired()
+
+	def delete_expired(self):
+		"""Удаляет старые строки непартиционированной таблицы порционным DELETE"""
+		if self.fallback_cleaner is None:
+			cleaner = self.fallback_cleaner = LogDatabaseCleaner()
+			cleaner.db_name = self.db_name
+			cleaner.table = self.full_table_name()
+			cleaner.time_column = self.partition_column
+			cleaner.DELETE_OLDER_THAN = self.DELETE_OLDER_THAN
+			# метрики и heartbeat - в слот этого процесса
+			cleaner.metrics = self.metrics
+		self.fallback_cleaner.stopping = self.stopping
+		self.fallback_cleaner.cleanup()
+
+	def full_table_name(self):
+		return "{}.{}".format(self.schema, self.table)
+
+	def unpartitionable_keys(self, cursor):
+		"""
+		Уникальные ключи (и PRIMARY), в которые не входит partition_column. С ними MySQL не даст
+		разбить таблицу на партиции, поэтому их надо проверить до ALTER, а не узнать о них по ошибке.
+		:return: список имён ключей
+		"""
+		cursor.execute("""SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS
+			WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND NON_UNIQUE = 0""", (self.schema, self.table))
+		keys = {}
+		for index_name, column_name in cursor.fetchall():
+			keys.setdefault(index_name, set()).add(column_name)
+		return sorted(name for name, columns in keys.items() if self.partition_column not in columns)
+
+	def partition_table(self, cursor):
+		"""
+		Разбивает существующую таблицу на партиции (долгая операция, перестраивает таблицу).
+		:return: True, если разбил
+		"""
+		keys = self.unpartitionable_keys(cursor)
+		if keys:
+			logging.error("Can't partition {}: unique keys {} don't include {}!".format(
+				self.full_table_name(), ", ".join(keys), self.partition_column))
+			return False
+
+		today = self.day_start(time())
+		first_day = self.day_start(time() - self.DELETE_OLDER_THAN)
+		days = range(first_day, today + (self.PRECREATE_DAYS + 1)*self.DAY, self.DAY)
+		definitions = [
+			# всё, что старше хранимого, - в одну партицию, она удалится первой
+			"PARTITION {} VALUES LESS THAN ({})".format(self.partition_name(first_day - self.DAY), first_day)
+		] + [self.partition_definition(day) for day in days] + ["PARTITION pmax VALUES LESS THAN MAXVALUE"]
+
+		logging.warning("Partitioning {}. This rebuilds the whole table!".format(self.full_table_name()))
+		with self.heartbeat():
+			cursor.execute("ALTER TABLE {} PARTITION BY RANGE ({}) ({})".format(
+				self.full_table_name(), self.partition_column, ", ".join(definitions)))
+		return True
+
+	def create_partitions(self, cursor, partitions):
+		"""Создаёт недостающие партиции до PRECREATE_DAYS суток вперёд, отщепляя их от pmax"""
+		if partitions[-1][1] is not None:
+			logging.error("{} has no MAXVALUE partition! Can't create new partitions.".format(self.full_table_name()))
+			return
+		last_bound = partitions[-2][1] if len(partitions) > 1 else self.day_start(time())
+		last_day = self.day_start(time()) + self.PRECREATE_DAYS*self.DAY
+
+		days = range(self.day_start(last_bound), last_day + 1, self.DAY)
+		if not days:
+			return
+		definitions = [self.partition_definition(day) for day in days]
+		logging.info("Creating partitions: {}".format(", ".join(self.partition_name(day) for day in days)))
+		# строки из pmax (например, с часами устройства в будущем) переносятся, это может быть долго
+		with self.heartbeat():
+			cursor.execute(
+				"ALTER TABLE {} REORGANIZE PARTITION {} INTO ({}, PARTITION {} VALUES LESS THAN MAXVALUE)".format(
+					self.full_table_name(), partitions[-1][0], ", ".join(definitions), partitions[-1][0]))
+		self.metrics.inc('partitions_created_total', len(definitions))
+
+	def drop_partitions(self, cursor, partitions):
+		"""Удаляет партиции, все строки которых старше DELETE_OLDER_THAN"""
+		threshold = time() - self.DELETE_OLDER_THAN
+		expired = [name for name, bound in partitions if bound is not None and bound <= threshold]
+		# последнюю ограниченную партицию не трогаем, чтобы было от чего считать новые
+		expired = expired[:len(partitions) - 2]
+		if not expired:
+			return
+		logging.info("Dropping expired partitions: {}".format(", ".join(expired)))
+		cursor.execute("ALTER TABLE {} DROP PARTITION {}".format(self.full_table_name(), ", ".join(expired)))
+		self.metrics.inc('partitions_dropped_total', len(expired))
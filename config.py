@@ -1,9 +1,11 @@
+import os
+
 DB_CONFIG = {
     'logdb': {
         'host': '178.21.13.216',
         'user': 'log_android',
         'passwd': 'tk20tk20',
-        'port': 3306
+        'port': 3306,
     },
 }
 
@@ -13,3 +15,21 @@ RABBIT_MQ_CONFIG = {
     'user': 'admin',
     'passwd': 'admin'
 }
+
+# Чем передавать данные от приёмщика загрузчику:
+# 'amqp' - через RabbitMQ (RABBIT_MQ_CONFIG),
+# 'disk' - через очередь на локальном диске (lib/disk_queue.py), если приёмщик и загрузчик на одной машине.
+QUEUE_TRANSPORT = 'amqp'
+# Каталог очереди на диске. Относительно каталога проекта, а не текущего: иначе приёмщик и загрузчик,
+# запущенные из разных каталогов, разминутся, а после перезапуска непрочитанное не найдётся.
+DISK_QUEUE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'queue')
+# Как часто приёмщики сбрасывают очередь на диске на диск (fdatasync), секунд: столько принятого
+# можно потерять при падении машины. 0 - после каждого сообщения (медленно), None - не сбрасывать, положиться на ОС.
+DISK_QUEUE_FSYNC_INTERVAL = 1.0
+
+# Каталог журнала загрузчиков на время недоступности базы (lib/spool.py). Тоже относительно каталога проекта.
+# None - не использовать журнал.
+SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool')
+
+# Адрес, на котором родительский процесс отдаёт метрики в формате Prometheus (GET /metrics). None - не отдавать.
+METRICS_ADDRESS = ('127.0.0.1', 9108)
@@ -1,22 +1,26 @@
 import logging
 from time import sleep, time
-from threading import Thread
-from multiprocessing import Queue as mqueue
-import subprocess
+from threading import Thread, Event
+
+from lib.metrics import MetricsSlot
 
 class ProcessAliver(Thread):
 	"""
 	Берёт классы компонентов (которые должны наследоваться от multiprocessing.Process),
 	запускает и следит за их выполнением.
 	Если процесс компонента упадёт, он будет перезапущен.
-	Если процесс зависнет (т.е. не будет присылать подтверждение работы в соответствующую очередь из tick_queues),
+	Если процесс зависнет (т.е. не будет обновлять heartbeat_time_seconds в своём слоте метрик, см. Node.working_tick),
 	он будет через определённое время (заданное в MAX_FROZEN_TIME) убит и перезапущен.
+	По stop() процессы получают SIGTERM и время STOP_TIMEOUT, чтобы сохранить принятые данные,
+	после чего оставшиеся убиваются.
 	"""
 
 	# максимальное время, которое процесс может не откликаться. Выше этого - он будет убит.
 	MAX_FROZEN_TIME = 30
-
-	port = 8000  # порт, куда подсоединяются устройства
+	# как часто писать в лог состояние компонентов (их STATUS_METRICS)
+	STATUS_LOG_PERIOD = 60
+	# сколько ждать корректного завершения процессов по stop(). Должно быть больше их SHUTDOWN_TIMEOUT.
+	STOP_TIMEOUT = 30
 
 	def __init__(self, components):
 		"""
@@ -30,15 +34,32 @@ class ProcessAliver(Thread):
 		self.handler_threads = [None]*len(self.component_classes)
 		# собственно процессы
 		self.component_processes = [None]*len(self.component_classes)
-		# время старта процесса или получения последнего сигнала о работе
+		# время старта процесса
 		self.freezekill_start_times = [0]*len(self.component_classes)
-		# сюда приходят сигналы о том, что процесс всё ещё работает
-		self.tick_queues = [None]*len(self.component_classes)
+		# Метрики компонентов в разделяемой памяти. Живут в этом процессе, поэтому переживают перезапуски.
+		# Там же время последней работы процесса (heartbeat_time_seconds).
+		self.metric_slots = [MetricsSlot(component.METRICS) for component in self.component_classes]
+		self.last_status_log_time = 0
+		self.stop_event = Event()
 
 		self.start()
 
+	def stop(self):
+		"""Останавливает компоненты и выходит из run(). Можно вызывать из обработчика сигнала."""
+		self.stop_event.set()
+
+	def collect_metrics(self):
+		""":return: список (метки, MetricsSlot) для MetricsServer"""
+		return [({'component': component.__name__, 'slot': n}, self.metric_slots[n])
+				for n, component in enumerate(self.component_classes)]
+
+	def idle_time(self, n):
+		"""Сколько секунд процесс компонента n не сообщал о работе"""
+		last_progress = max(self.freezekill_start_times[n], self.metric_slots[n].get('heartbeat_time_seconds'))
+		return time() - last_progress
+
 	def run(self):
-		while True:
+		while not self.stop_event.is_set():
 			for n, component in enumerate(self.component_classes):
 				# проверяем поток слежения
 				if not self.handler_threads[n] or not self.handler_threads[n].is_alive():
@@ -46,46 +67,61 @@ class ProcessAliver(Thread):
 					t.start()
 					self.handler_threads[n] = t
 
-				# проверяем, пришёл ли сигнал о работе процесса
-				if self.tick_queues[n] and not self.tick_queues[n].empty():
-					# очищаем очередь
-					while not self.tick_queues[n].empty():
-						self.tick_queues[n].get()
-					self.freezekill_start_times[n] = time()  # выставляем таймер
-
 				# проверяем, не завис ли процесс
-				if self.component_processes[n] and (time() - self.freezekill_start_times[n]) > self.MAX_FROZEN_TIME:
-					logging.warning("Process {} appears to be frozen! Killing!".format(self.component_processes[n]))
-					self.component_processes[n].terminate()
-
-				# Соединения с устройствами на уровне сервера почему-то не закрываются.
-				# В результате они накапливаются, программа упирается в лимит и выдаёт ошибку
-				# OSError: [Errno 24] Too many open files
-				# Значит будем отслеживать число соединений на этом порту и убивать приёмщик, когда их накопится много.
-				MAX_OPEN_CONNS = 500
-				if component.__name__ == "ProtocolHandler":
-					ps = subprocess.Popen(['lsof', '-i', 'TCP:{}'.format(self.port)], stdout=subprocess.PIPE)
-					out = ps.communicate()[0]
-					open_conns = len(out.decode().split('\n'))
-					logging.info("Open connections: {}".format(open_conns))
-					if open_conns > MAX_OPEN_CONNS:
-						logging.warning("Receiver has opened more than {} connections. Restarting!".format(MAX_OPEN_CONNS))
-						self.component_processes[n].terminate()
-
-
-			sleep(5)
+				if self.component_processes[n] and self.idle_time(n) > self.MAX_FROZEN_TIME:
+					logging.warning("Process {} appears to be frozen (no progress for {:.0f} s)! Killing!".format(
+						self.component_processes[n], self.idle_time(n)))
+					# SIGKILL: на SIGTERM компоненты завершаются сами, а зависший процесс этого не сделает
+					self.component_processes[n].kill()
+					self.metric_slots[n].inc('process_frozen_kills_total')
+
+			if time() - self.last_status_log_time > self.STATUS_LOG_PERIOD:
+				self.last_status_log_time = time()
+				self.log_status()
+
+			self.stop_event.wait(5)
+
+		self.stop_components()
+
+	def stop_components(self):
+		"""Шлёт всем процессам SIGTERM, ждёт до STOP_TIMEOUT и убивает тех, кто не завершился"""
+		logging.warning("Stopping components")
+		deadline = time() + self.STOP_TIMEOUT
+		for p in self.component_processes:
+			if p and p.is_alive():
+				p.terminate()
+		# потоки слежения заканчиваются, когда их процесс завершился
+		for t in self.handler_threads:
+			if t:
+				t.join(max(0, deadline - time()))
+		for p in self.component_processes:
+			if p and p.is_alive():
+				logging.error("Process {} did not stop in {} s! Killing!".format(p, self.STOP_TIMEOUT))
+				p.kill()
+				p.join()
+		logging.warning("All components stopped")
+
+	def log_status(self):
+		"""Пишет в лог, как давно каждый компонент работал, и его STATUS_METRICS"""
+		for n, component in enumerate(self.component_classes):
+			slot = self.metric_slots[n]
+			status = ", ".join("{}={:g}".format(name, slot.get(name)) for name in component.STATUS_METRICS)
+			logging.info("{} #{}: last progress {:.0f} s ago{}".format(
+				component.__name__, n, self.idle_time(n), "; " + status if status else ""))
 
 	def process_launcher(self, proc_class, proc_index):
-		while True:
+		metrics = self.metric_slots[proc_index]
+		while not self.stop_event.is_set():
 			p = proc_class()
-
-			# задаём очередь, через которую будет сообщаться о том, что процесс всё ещё на ходу
-			tick_queue = mqueue()
-			p.tick_queue = tick_queue  # присваеваем процессу
-			self.tick_queues[proc_index] = tick_queue  # сохраняем
+			p.metrics = metrics
 			self.freezekill_start_times[proc_index] = time()  # сбрасываем таймер зависаний
 
 			self.component_processes[proc_index] = p  # сохраняем handle на процесс
 			p.start()
+			metrics.set('process_up', 1)
 			p.join()
+			metrics.set('process_up', 0)
+			if self.stop_event.is_set():
+				break
 			sleep(1)
+			metrics.inc('process_restarts_total')
@@ -1,4 +1,8 @@
+import signal
 from multiprocessing import Process
+from time import time
+
+from lib.metrics import MetricsSlot, COUNTER, GAUGE
 
 
 def int_from_bits(data, count_bits, start_bit=0):
@@ -32,36 +36,76 @@ class Node(Process):
     Метод put - получает результат работы метода handle и что-то с ним делает.
     Это может быть передача результата на следующий вычислительный узел, а может быть сохранение в БД.
     Метод ack - отправляет подтверждение получения сообщения очереди RabbitMQ, если статус True
-    Метод working_tick - отправляет уведомление запускателю о том, что он всё ещё работает
+    Метод working_tick - сообщает запускателю о том, что он всё ещё работает
+    По SIGTERM выставляется stopping: run() дорабатывает текущее сообщение, выходит из цикла
+    и вызывает shutdown(), где компонент сохраняет и подтверждает всё, что успел принять.
     Не существует каких-либо ограничений на то, что делать этому методу с результатом обработки значения.
     """
 
+    # Метрики компонента: {имя: (тип, описание)}. Подклассы дополняют словарь своими.
+    # Метрики process_* пишет ProcessAliver из родительского процесса.
+    METRICS = {
+        'process_up': (GAUGE, "1, if the component process is running"),
+        'process_restarts_total': (COUNTER, "How many times the component process was restarted"),
+        'process_frozen_kills_total': (COUNTER, "How many times the component process was killed as frozen"),
+        'heartbeat_time_seconds': (GAUGE, "Unix time of the last progress reported by the component"),
+    }
+    # метрики, которые ProcessAliver периодически пишет в лог
+    STATUS_METRICS = ()
+
     def __init__(self):
         super(Node, self).__init__()
         self.read_rabbit_manager = None  # менеджер чтения очереди RabbitMQ (обычно ReaderRabbitManager)
-        # Очередь для сигналов менеджеру зависаний. multiprocessing.Queue. Задаём в инициализации подклассов.
-        self.tick_queue = None
+        # Метрики в разделяемой памяти. ProcessAliver подменяет слот своим, чтобы читать его и между перезапусками.
+        self.metrics = MetricsSlot(self.METRICS)
         # служебная информация RabbitMQ
         self.current_ch, self.current_method, self.current_properties = None, None, None
+        self.stopping = False  # получен SIGTERM, надо корректно завершиться
+
+    def handle_stop_signal(self):
+        """
+        Вызывать в начале run(): SIGTERM не убивает процесс, а выставляет stopping.
+        Обработчики родителя, унаследованные при fork, сбрасываются. SIGINT (Ctrl+C приходит всей группе процессов)
+        игнорируется: останавливает компоненты родитель, присылая SIGTERM, иначе KeyboardInterrupt оборвал бы
+        процесс, не дав ему сохранить принятое.
+        """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self.request_stop)
+
+    def request_stop(self, signum=None, frame=None):
+        self.stopping = True
 
     def run(self):
-        while True:
-            data = self.validate(self.get())
-            if data:
-                # данные валидны
-                self.working_tick(self.ack(self.put(self.handle(data))))
-            else:
-                # данные не валидны, validate() вернул None. Сбрасываем пакет
-                self.working_tick(self.ack(status=True, multiple=False))
-
-    def get(self, block=True):
+        self.handle_stop_signal()
+        try:
+            # цикл заканчивается исключением StopRequested из get(), чтобы не бросать недоразобранное сообщение
+            while True:
+                data = self.validate(self.get())
+                if data:
+                    # данные валидны
+                    self.working_tick(self.ack(self.put(self.handle(data))))
+                else:
+                    # данные не валидны, validate() вернул None. Сбрасываем пакет
+                    self.working_tick(self.ack(status=True, multiple=False))
+        except StopRequested:
+            pass
+        self.shutdown()
+
+    def shutdown(self):
+        """Вызывается после выхода из цикла run() по SIGTERM"""
+        pass
+
+    def get(self, block=True, timeout=None):
         """
         Получаем данные из очереди с помощью self.read_rabbit_manager. Данные возвращаем.
         Служебную информацию сохраняем в переменные instance'а.
+        :param timeout: сколько ждать данных при block=True (см. ReaderRabbitManager.read_one)
         :return: сырые данные
         """
+        if self.stopping:
+            raise StopRequested()
         self.current_ch, self.current_method, self.current_properties, body = self.read_rabbit_manager.read_one(
-            block=block)
+            block=block, timeout=timeout)
         return body
 
     def validate(self, data):
@@ -105,10 +149,34 @@ class Node(Process):
             self.read_rabbit_manager.ack(tag=_tag, multiple=multiple)
             return True
 
+    def ack_batch(self, tags, channel=None):
+        """
+        Подтверждает пачку сообщений одним ack с multiple=True по наибольшему тегу.
+        Теги одного канала растут монотонно, а сообщения обрабатываются по порядку, поэтому все сообщения
+        с меньшими тегами либо входят в эту пачку, либо уже подтверждены.
+        Вызывать только после того, как данные всех сообщений пачки сохранены.
+        :param tags: delivery tag'и пачки (None пропускаются)
+        :param channel: канал, через который пришли сообщения пачки. None - текущий.
+        :return: True, если было что подтверждать
+        """
+        last_tag = max((t for t in tags if t is not None), default=None)
+        if last_tag is None:
+            return False
+        self.read_rabbit_manager.ack(tag=last_tag, channel=channel, multiple=True)
+        return True
+
     def working_tick(self, status):
         if status:
-            # отправляем сигнал о работе менеджеру зависаний
-            self.tick_queue.put(1)
+            # время последней работы - в разделяемую память, менеджер зависаний читает его сам.
+            # Одна запись в память, без межпроцессных очередей, поэтому можно звать хоть на каждое сообщение.
+            self.metrics.set('heartbeat_time_seconds', time())
+
+    def get_header(self, name, default=None):
+        """Возвращает заголовок текущего сообщения RabbitMQ или default, если его нет."""
+        headers = self.current_properties.headers if self.current_properties else None
+        if not headers:
+            return default
+        return headers.get(name, default)
 
     def get_current_tag(self):
         """Возвращает номер сообщения очереди RabbitMQ. Нужно для подтверждения получения (ack)."""
@@ -117,3 +185,8 @@ class Node(Process):
 
 class ProtocolException(Exception):
     pass
+
+
+class StopRequested(Exception):
+    """Бросается из get(), если данных нет, а процессу пора завершаться (см. Node.stopping)"""
+    pass
@@ -1,43 +1,275 @@
+import logging
+import os
+import tempfile
+from threading import Condition, Lock
+from time import time, sleep
+
 import MySQLdb
 
 from config import DB_CONFIG
 
+# экранирование для LOAD DATA с FIELDS ESCAPED BY '\\'
+_LOAD_DATA_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\0': '\\0',
+    '\x1a': '\\Z',
+})
+
+
+def load_data_value(value):
+    """Представляет значение в виде поля TSV для LOAD DATA INFILE"""
+    if value is None:
+        return '\\N'
+    return str(value).translate(_LOAD_DATA_ESCAPES)
+
+
+# ошибка "база недоступна", для кода, которому не нужно импортировать MySQLdb
+OperationalError = MySQLdb.OperationalError
+
+# Коды ошибок, которыми отказывают в LOAD DATA LOCAL INFILE, когда local_infile выключен на сервере
+# (в MySQL 8 по умолчанию) или в клиенте: ER_NOT_ALLOWED_COMMAND, ER_CLIENT_LOCAL_FILES_DISABLED,
+# CR_LOAD_DATA_LOCAL_INFILE_REJECTED. Приходят как OperationalError, но база при этом доступна.
+LOCAL_INFILE_REJECTED_ERRORS = (1148, 3948, 2068)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Ограниченный пул соединений с одной базой. Соединение выдаётся в монопольное пользование
+    (checkout) и возвращается (checkin), поэтому пулом можно пользоваться из разных потоков.
+    Перед выдачей соединение проверяется: простоявшее дольше max_idle_time закрывается и открывается заново,
+    простоявшее дольше ping_interval проверяется ping'ом.
+    Открытие соединения повторяется с нарастающей паузой, пока база не станет доступна.
+    Статистика ожидания свободного соединения - в stats() (по всем пулам базы - в database_stats()).
+    """
+
+    _pools = dict()
+    _pools_lock = Lock()
+    _pools_pid = None
+
+    # кодировка сессии. utf8mb4, чтобы в текстах логов не ломались эмодзи и прочие 4-байтные символы
+    CHARSET = 'utf8mb4'
+    # паузы между попытками соединиться с базой
+    RECONNECT_MIN_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 30
+    RECONNECT_ATTEMPTS = 10
+
+    def __init__(self, db_name, max_size=4, max_idle_time=600, ping_interval=60, local_infile=False):
+        """
+
+        :param db_name: имя базы данных, так как оно прописано в config
+        :param local_infile: разрешить на соединениях LOAD DATA LOCAL INFILE (см. Database.bulk_load).
+        Только там, где это нужно: с ним сервер может прочитать любой доступный процессу файл.
+        :param max_size: наибольшее количество открытых соединений
+        :param max_idle_time: соединение, простоявшее без дела дольше (в секундах), переоткрывается
+        :param ping_interval: соединение, простоявшее дольше (в секундах), проверяется ping'ом.
+        Проверять каждый раз - лишний запрос на каждый слив.
+        """
+        super(ConnectionPool, self).__init__()
+        self.db_name = db_name
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.ping_interval = ping_interval
+        self.local_infile = local_infile
+
+        self._idle = []  # (соединение, когда вернули в пул)
+        self._size = 0  # сколько соединений открыто, включая выданные
+        self._condition = Condition()
+
+        self.checkouts = 0
+        self.wait_time_total = 0
+        self.wait_time_max = 0
+        self.reconnects = 0
+
+    @classmethod
+    def get(cls, db_name, local_infile=False):
+        """Возвращает пул для базы (свой в каждом процессе, отдельный для соединений с local_infile)"""
+        with cls._pools_lock:
+            if cls._pools_pid != os.getpid():
+                # после fork соединения родителя использовать нельзя
+                cls._pools = dict()
+                cls._pools_pid = os.getpid()
+            try:
+                return cls._pools[db_name, local_infile]
+            except KeyError:
+                pool = cls._pools[db_name, local_infile] = cls(db_name, local_infile=local_infile)
+                return pool
+
+    def open_connection(self, retry=True):
+        """
+        Открывает новое физическое соединение и один раз настраивает его сессию
+        (кодировка, autocommit), чтобы не делать этого на каждый запрос.
+        :param retry: повторять попытки с нарастающей паузой. Иначе сразу бросает OperationalError.
+        """
+        config = dict(DB_CONFIG[self.db_name])
+        config.setdefault('charset', self.CHARSET)
+        config.setdefault('use_unicode', True)
+        if self.local_infile:
+            config['local_infile'] = 1
+
+        delay = self.RECONNECT_MIN_DELAY
+        attempts = self.RECONNECT_ATTEMPTS if retry else 1
+        for attempt in range(attempts):
+            try:
+                conn = MySQLdb.connect(**config)
+                conn.autocommit(True)
+                return conn
+            except MySQLdb.OperationalError as e:
+                if attempt == attempts - 1:
+                    raise
+                logging.warning("Can't connect to {}: {}. Retrying in {} s".format(self.db_name, e, delay))
+                sleep(delay)
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+    def checkout(self, timeout=None, retry=True):
+        """
+        Выдаёт соединение. Если все max_size соединений заняты, ждёт освобождения.
+        :param timeout: сколько ждать, None - бесконечно. По истечении бросает PoolTimeout.
+        :param retry: см. open_connection
+        """
+        start = time()
+        with self._condition:
+            while not self._idle and self._size >= self.max_size:
+                remaining = None if timeout is None else timeout - (time() - start)
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout("No free connection to {} in {} s".format(self.db_name, timeout))
+                self._condition.wait(remaining)
+
+            if self._idle:
+                conn, returned_time = self._idle.pop()
+            else:
+                conn, returned_time = None, None
+                self._size += 1
+
+            waited = time() - start
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+        try:
+            return self._check(conn, returned_time, retry)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def _check(self, conn, returned_time, retry):
+        """Возвращает рабочее соединение: conn, если оно живо, или новое"""
+        if conn is not None:
+            idle_time = time() - returned_time
+            if idle_time > self.max_idle_time:
+                self._close(conn)
+                conn = None
+            elif idle_time > self.ping_interval:
+                try:
+                    conn.ping()
+                except MySQLdb.Error:
+                    logging.warning("Connection to {} is dead! Reconnecting.".format(self.db_name))
+                    self._close(conn)
+                    conn = None
+                    self.reconnects += 1
+        if conn is None:
+            conn = self.open_connection(retry=retry)
+        return conn
+
+    def checkin(self, conn, broken=False):
+        """
+        Возвращает соединение в пул.
+        :param broken: соединение сломано (например, запрос упал с OperationalError) - закрыть его
+        """
+        if broken:
+            self._close(conn)
+        with self._condition:
+            if broken:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time()))
+            self._condition.notify()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'idle': len(self._idle),
+            'checkouts': self.checkouts,
+            'wait_time_total': self.wait_time_total,
+            'wait_time_max': self.wait_time_max,
+            'reconnects': self.reconnects,
+        }
+
+    @classmethod
+    def database_stats(cls, db_name):
+        """Суммарная stats() пулов базы в этом процессе (с local_infile и без), пулы не создаёт"""
+        total = {'size': 0, 'idle': 0, 'checkouts': 0, 'wait_time_total': 0, 'wait_time_max': 0, 'reconnects': 0}
+        with cls._pools_lock:
+            if cls._pools_pid != os.getpid():
+                return total
+            pools = [pool for (name, _), pool in cls._pools.items() if name == db_name]
+        for pool in pools:
+            for key, value in pool.stats().items():
+                total[key] = max(total[key], value) if key == 'wait_time_max' else total[key] + value
+        return total
+
 
 class Database(object):
+    """
+    Соединение с базой. Используется как контекстный менеджер.
+    persistent=True - соединение берётся из ConnectionPool и возвращается в него при выходе из with.
+    Иначе открывается новое и закрывается при выходе.
+    """
 
-    persistent_connections = dict()
-    persistent_cursors = dict()
+    # базы, отказавшие этому процессу в LOAD DATA LOCAL INFILE: bulk_load в них сразу пишет через INSERT
+    bulk_load_refused = set()
 
-    def __init__(self, db_name='', persistent=False):
+    def __init__(self, db_name='', persistent=False, retry=True, local_infile=False):
         """
         
         :param db_name: имя базы данных, так как оно прописано в config 
         :param persistent:
         :type persistent: bool
+        :param retry: если база недоступна, повторять попытки соединиться (см. ConnectionPool.open_connection)
+        :param local_infile: соединение для bulk_load (LOAD DATA LOCAL INFILE)
         """
         super(Database, self).__init__()
         self.persistent = persistent
         self.db_name = db_name
         self._conn = None
+        self.retry = retry
+        self.local_infile = local_infile
+        self._pool = ConnectionPool.get(db_name, local_infile) if persistent else None
         self.connect()
 
     def connect(self):
         if self.persistent:
-            try:
-                self._conn = self.persistent_connections[self.db_name]
-            except KeyError:
-                self._conn = self.persistent_connections[self.db_name] = MySQLdb.connect(**DB_CONFIG[self.db_name])
-                self._conn.autocommit(True)
-                self.persistent_cursors[self.db_name] = self._conn.cursor()
+            self._conn = self._pool.checkout(retry=self.retry)
         else:
-            self._conn = MySQLdb.connect(**DB_CONFIG[self.db_name])
-            self._conn.autocommit(True)
+            # отдельное соединение мимо пула, но с теми же настройками сессии и повторами
+            self._conn = ConnectionPool.get(self.db_name, self.local_infile).open_connection(retry=self.retry)
 
         return self._conn
 
-    def close(self):
-        """Closes connection"""
-        self._conn.close()
+    def close(self, broken=False):
+        """Closes connection (persistent - returns it to the pool)"""
+        if self._conn is None:
+            return
+        if self.persistent:
+            self._pool.checkin(self._conn, broken=broken)
+        else:
+            self._conn.close()
+        self._conn = None
 
     def __call__(self, *args, **kwargs):
         return self
@@ -46,13 +278,85 @@ class Database(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not self.persistent:
-            self.close()
+        # соединение, на котором упал запрос к серверу, обратно в пул не кладём
+        self.close(broken=exc_type is not None and issubclass(exc_type, MySQLdb.OperationalError))
 
     def cursor(self):
-        if self.persistent:
-            cur = self.persistent_cursors[self.db_name]
-        else:
-            cur = self._conn.cursor()
+        return self._conn.cursor()
+
+    def bulk_load(self, table, fields, rows, ignore=True):
+        """
+        Заливает строки в таблицу через LOAD DATA LOCAL INFILE из временного TSV-файла.
+        Для этого Database должна быть открыта с local_infile=True, а на сервере - включен local_infile.
+        Строки, которые нельзя записать в utf-8 (например, с одиночными суррогатами из JSON),
+        не искажаются, а вставляются по одной обычным INSERT; если не выходит и так - пропускаются.
+        :param table: имя таблицы
+        :param fields: имена полей, в порядке значений в строках
+        :param rows: последовательность кортежей значений
+        :param ignore: пропускать строки с дублирующимися ключами (как INSERT IGNORE)
+        :return: количество залитых строк
+        """
+        if self.db_name in self.bulk_load_refused:
+            return self.insert_many(table, fields, rows, ignore)
+        query = ("LOAD DATA LOCAL INFILE %s {ignore} INTO TABLE {table} CHARACTER SET utf8mb4 "
+                 "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({fields})").format(
+            ignore="IGNORE" if ignore else "", table=table, fields=",".join(fields))
+
+        rejected = []
+        loaded = 0
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.tsv') as f:
+            for row in rows:
+                try:
+                    line = ('\t'.join(map(load_data_value, row)) + '\n').encode('utf-8')
+                except UnicodeEncodeError:
+                    rejected.append(row)
+                    continue
+                f.write(line)
+            f.flush()
+            if f.tell():
+                try:
+                    loaded = self.cursor().execute(query, (f.name,))
+                except MySQLdb.OperationalError as e:
+                    if e.args[0] not in LOCAL_INFILE_REJECTED_ERRORS:
+                        raise
+                    # база доступна, но LOAD DATA LOCAL запрещён - это не повод считать её упавшей
+                    logging.error("{} refuses LOAD DATA LOCAL INFILE ({}), falling back to INSERT".format(
+                        self.db_name, e))
+                    self.bulk_load_refused.add(self.db_name)
+                    return self.insert_many(table, fields, rows, ignore)
+
+        if rejected:
+            loaded += self.insert_rows(table, fields, rejected, ignore)
+        return loaded
 
-        return cur
\ No newline at end of file
+    @staticmethod
+    def insert_query(table, fields, ignore=True):
+        return "INSERT {ignore} INTO {table}({fields}) VALUES ({formatting})".format(
+            ignore="IGNORE" if ignore else "", table=table, fields=",".join(fields),
+            formatting=",".join('%s' for _ in fields))
+
+    def insert_many(self, table, fields, rows, ignore=True):
+        """
+        Вставляет строки одним executemany. Если какую-то из них вставить нельзя, вставляет по одной (insert_rows).
+        :return: количество вставленных строк
+        """
+        try:
+            return self.cursor().executemany(self.insert_query(table, fields, ignore), rows)
+        except (UnicodeError, MySQLdb.DataError, MySQLdb.IntegrityError, MySQLdb.ProgrammingError):
+            return self.insert_rows(table, fields, rows, ignore)
+
+    def insert_rows(self, table, fields, rows, ignore=True):
+        """
+        Вставляет строки по одной. Строку, которую не удалось вставить (не та кодировка, неверные данные),
+        пишет в лог и пропускает.
+        :return: количество вставленных строк
+        """
+        query = self.insert_query(table, fields, ignore)
+        inserted = 0
+        cursor = self.cursor()
+        for row in rows:
+            try:
+                inserted += cursor.execute(query, row)
+            except (UnicodeError, MySQLdb.DataError, MySQLdb.IntegrityError, MySQLdb.ProgrammingError) as e:
+                logging.error("Dropping row that can't be inserted into {} ({!r}): {!r}".format(table, e, row))
+        return inserted
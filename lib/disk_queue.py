@@ -0,0 +1,312 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+from queue import Queue
+from threading import Thread, Lock
+from time import sleep, time
+from types import SimpleNamespace
+
+from lib import json_codec
+
+
+class DiskQueue(object):
+    """
+    Очередь на локальном диске вместо RabbitMQ для установки на одной машине.
+    Очередь - каталог с сегментами NNNNNNNNNN.seg, в которые писатели дописывают записи
+    <длина заголовков, 4 байта><длина тела, 4 байта><заголовки в JSON><тело>.
+    Читатель запоминает, докуда подтверждено, в файле offset ("сегмент смещение")
+    и удаляет сегменты, которые подтверждены целиком.
+    """
+
+    SEGMENT_SUFFIX = '.seg'
+    OFFSET_FILE = 'offset'
+    WRITE_LOCK_FILE = 'write.lock'
+    READ_LOCK_FILE = 'read.lock'
+    RECORD_HEADER = struct.Struct('<II')
+
+    DEBUG = False
+    base_directory = 'queue'  # каталог, в котором лежат очереди
+    # как часто писатели сбрасывают записанное на диск (fdatasync), секунд.
+    # 0 - после каждого сообщения, None - никогда, этим занимается ОС (переживает падение процесса, но не машины)
+    fsync_interval = 1.0
+
+    def __init__(self, queue):
+        super(DiskQueue, self).__init__()
+        self.queue_name = queue + ("_test" if self.DEBUG else "")
+        self.directory = os.path.join(self.base_directory, self.queue_name)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, '{:010d}{}'.format(segment, self.SEGMENT_SUFFIX))
+
+    def list_segments(self):
+        return sorted(int(name[:-len(self.SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(self.SEGMENT_SUFFIX))
+
+
+class DiskQueuePublisher(object):
+    """
+    Замена ExchangePublisherRabbitManager: send_message дописывает сообщение в каждую из очередей queues
+    (аналог fanout-обменника). Писать в одну очередь могут несколько процессов - запись идёт под flock.
+    Записанное сбрасывается на диск не реже, чем раз в DiskQueue.fsync_interval секунд: при очередном
+    send_message или по вызову sync (ProtocolHandler вызывает его по таймеру, чтобы хвост не ждал следующего сообщения).
+    """
+
+    def __init__(self, exchange, queues, segment_bytes=64*1024**2, metrics=None, **kwargs):
+        """
+
+        :param exchange: не используется, для совместимости с ExchangePublisherRabbitManager
+        :param queues: имена очередей
+        :param segment_bytes: размер, при превышении которого писатель начинает новый сегмент
+        :param metrics: MetricsSlot с метриками receiver_* (см. ProtocolHandler.METRICS) или None
+        """
+        super(DiskQueuePublisher, self).__init__()
+        self.queues = [DiskQueue(q) for q in queues]
+        self.segment_bytes = segment_bytes
+        self.metrics = metrics
+        self._lock_files = {q.directory: open(os.path.join(q.directory, q.WRITE_LOCK_FILE), 'w') for q in self.queues}
+        self._segments = {}  # каталог очереди -> (номер сегмента, открытый на дописывание fd)
+        self.fsync_interval = DiskQueue.fsync_interval
+        self._unsynced = set()  # fd, записанные после последнего fdatasync
+        self._last_sync_time = time()
+
+    def _segment_fd(self, queue):
+        """fd сегмента, в который сейчас надо писать. Вызывается под блокировкой записи."""
+        segment, fd = self._segments.get(queue.directory, (None, None))
+        # другой процесс мог уже перейти на следующий сегмент - тогда в этот писать нельзя
+        if fd is not None and os.path.exists(queue.segment_path(segment + 1)):
+            self._close_segment(fd)
+            fd = None
+        if fd is None:
+            segments = queue.list_segments()
+            segment = segments[-1] if segments else 0
+            fd = os.open(queue.segment_path(segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size >= self.segment_bytes:
+            self._close_segment(fd)
+            segment += 1
+            fd = os.open(queue.segment_path(segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._segments[queue.directory] = (segment, fd)
+        return fd
+
+    def _close_segment(self, fd):
+        """Закрывает сегмент, из которого ушли писатели. Записанное в него сначала сбрасывается на диск."""
+        if fd in self._unsynced and self.fsync_interval is not None:
+            os.fdatasync(fd)
+        self._unsynced.discard(fd)
+        os.close(fd)
+
+    def sync(self):
+        """Сбрасывает на диск всё, что записано после прошлого вызова"""
+        for fd in self._unsynced:
+            os.fdatasync(fd)
+        self._unsynced.clear()
+        self._last_sync_time = time()
+
+    def send_message(self, message, headers=None):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        headers_data = json_codec.dumps(headers) if headers else b''
+        record = DiskQueue.RECORD_HEADER.pack(len(headers_data), len(message)) + headers_data + message
+
+        start_time = time()
+        for queue in self.queues:
+            lock_file = self._lock_files[queue.directory]
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # одна запись одним write - читатель не увидит чужих записей внутри
+                fd = self._segment_fd(queue)
+                os.write(fd, record)
+                self._unsynced.add(fd)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        if self.fsync_interval is not None and time() - self._last_sync_time >= self.fsync_interval:
+            self.sync()
+        if self.metrics:
+            self.metrics.inc('receiver_messages_published_total')
+            self.metrics.observe('receiver_publish_latency_seconds', time() - start_time)
+
+    def flush(self):
+        pass
+
+    def drain(self, timeout=None):
+        """Запись синхронная, остаётся только сбросить хвост на диск"""
+        if self.fsync_interval is not None:
+            self.sync()
+        return True
+
+
+class DiskQueueReader(Thread):
+    """
+    Замена ReaderRabbitManager: поток читает сегменты через mmap и кладёт сообщения в local_queue
+    в том же виде (ch, method, properties, body), что и ReaderRabbitManager.
+    delivery_tag растёт монотонно, ack(tag, multiple=True) сдвигает сохранённое смещение.
+    Неподтверждённые сообщения после перезапуска читаются снова.
+    Читатель у очереди может быть только один (блокировка flock).
+    Испорченная запись (недописанная при падении машины, мусор в заголовке) не останавливает чтение:
+    остаток сегмента пропускается, писатели переводятся на следующий сегмент.
+    Если поток всё же упал, read_one выбрасывает исключение, загрузчик завершается и его перезапускает aliver.
+    """
+
+    POLL_INTERVAL = 0.05  # как часто проверять, не дописали ли что-нибудь
+    MAX_RECORD_BYTES = 1024**3  # запись длиннее - точно мусор в заголовке
+
+    def __init__(self, queue, autostart=True, prefetch_count=None, **kwargs):
+        super(DiskQueueReader, self).__init__()
+        self.queue = DiskQueue(queue)
+        self.queue_name = self.queue.queue_name
+        self.local_queue = Queue(maxsize=prefetch_count or 1000)
+        self.daemon = True
+
+        self._lock_file = open(os.path.join(self.queue.directory, DiskQueue.READ_LOCK_FILE), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        self.committed = self._load_offset()  # (сегмент, смещение), до которого всё подтверждено
+        self._positions = dict()  # delivery_tag -> (сегмент, смещение конца записи)
+        self._positions_lock = Lock()
+        self._next_tag = 1
+        self.acked_tag = 0
+        self.error = None  # исключение, на котором остановился поток
+
+        if autostart:
+            self.start()
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.queue.directory, DiskQueue.OFFSET_FILE)) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except ValueError:
+            logging.error("Disk queue offset file in {} is corrupt, reading from the first segment".format(
+                self.queue.directory))
+        except OSError:
+            pass
+        segments = self.queue.list_segments()
+        return (segments[0] if segments else 0), 0
+
+    def _save_offset(self):
+        path = os.path.join(self.queue.directory, DiskQueue.OFFSET_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write("{} {}".format(*self.committed))
+        os.replace(path + '.tmp', path)
+
+    def run(self):
+        try:
+            self.read_forever()
+        except Exception as e:
+            logging.exception("Disk queue reader of {} stopped!".format(self.queue.directory))
+            self.error = e
+
+    def read_forever(self):
+        segment, offset = self.committed
+        while True:
+            path = self.queue.segment_path(segment)
+            if not os.path.exists(path):
+                later = [s for s in self.queue.list_segments() if s > segment]
+                if later:
+                    segment, offset = later[0], 0
+                else:
+                    sleep(self.POLL_INTERVAL)
+                continue
+
+            offset = self._read_segment(segment, offset)
+            if offset is None:
+                segment, offset = self._skip_segment(segment), 0
+                continue
+
+            if any(s > segment for s in self.queue.list_segments()):
+                # писатели перешли на следующий сегмент. Дочитываем этот (вдруг дописали) и переходим.
+                end = self._read_segment(segment, offset)
+                if end is not None and end < os.path.getsize(self.queue.segment_path(segment)):
+                    # писатель упал посреди записи, дописать её уже некому
+                    logging.error("Disk queue segment {} ends with a torn record at {}, skipping it".format(
+                        self.queue.segment_path(segment), end))
+                segment, offset = segment + 1, 0
+            else:
+                sleep(self.POLL_INTERVAL)
+
+    def _read_segment(self, segment, offset):
+        """
+        Читает все целые записи сегмента после offset. Возвращает смещение после последней
+        или None, если дальше в сегменте испорченная запись.
+        """
+        with open(self.queue.segment_path(segment), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return offset
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+                while offset + DiskQueue.RECORD_HEADER.size <= size:
+                    headers_length, body_length = DiskQueue.RECORD_HEADER.unpack_from(data, offset)
+                    start = offset + DiskQueue.RECORD_HEADER.size
+                    end = start + headers_length + body_length
+                    if headers_length + body_length > self.MAX_RECORD_BYTES:
+                        logging.error("Disk queue segment {} has a bad record header at {}".format(f.name, offset))
+                        return None
+                    if end > size:
+                        break  # запись ещё дописывается
+                    try:
+                        headers = json_codec.loads(data[start:start + headers_length]) if headers_length else None
+                    except ValueError:
+                        logging.error("Disk queue segment {} has a record with bad headers at {}".format(
+                            f.name, offset))
+                        return None
+                    body = data[start + headers_length:end]
+                    self._deliver(segment, end, headers, body)
+                    offset = end
+        return offset
+
+    def _skip_segment(self, segment):
+        """
+        Бросает остаток испорченного сегмента. Создаёт следующий сегмент, если его ещё нет:
+        писатели, увидев его, перестанут дописывать в испорченный. Возвращает номер следующего сегмента.
+        """
+        lock_file = open(os.path.join(self.queue.directory, DiskQueue.WRITE_LOCK_FILE), 'w')
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # всё, что писатели успели дописать до этого момента, тоже теряется
+            os.close(os.open(self.queue.segment_path(segment + 1), os.O_WRONLY | os.O_CREAT, 0o644))
+        logging.error("Skipped the rest of disk queue segment {}".format(self.queue.segment_path(segment)))
+        return segment + 1
+
+    def _deliver(self, segment, end, headers, body):
+        with self._positions_lock:
+            tag = self._next_tag
+            self._next_tag += 1
+            self._positions[tag] = (segment, end)
+        method = SimpleNamespace(delivery_tag=tag)
+        properties = SimpleNamespace(headers=headers)
+        # ждём, если загрузчик не успевает - аналог prefetch_count
+        self.local_queue.put((None, method, properties, body))
+
+    def read_one(self, block=False, timeout=None):
+        if self.error is not None and self.local_queue.empty():
+            # новых сообщений не будет, а загрузчик считал бы, что очередь просто пуста
+            raise RuntimeError("Disk queue reader of {} has stopped".format(self.queue.directory)) from self.error
+        return self.local_queue.get(block=block, timeout=timeout)
+
+    def is_current(self, channel):
+        """Переподключений не бывает, подтверждать можно всегда"""
+        return True
+
+    def ack(self, tag, channel=None, multiple=True):
+        """Подтверждает сообщения до tag включительно"""
+        if tag <= self.acked_tag:
+            return
+        if not multiple and tag != self.acked_tag + 1:
+            # смещение одно на всю очередь: одиночный ack не по порядку подтвердил бы и предыдущие.
+            # Откладываем - это сообщение подтвердится следующим ack с multiple=True.
+            return
+        with self._positions_lock:
+            position = self._positions[tag]
+            for t in range(self.acked_tag + 1, tag + 1):
+                self._positions.pop(t, None)
+        self.acked_tag = tag
+        self.committed = position
+        self._save_offset()
+
+        # удаляем сегменты, прочитанные и подтверждённые целиком
+        for segment in self.queue.list_segments():
+            if segment >= position[0]:
+                break
+            os.remove(self.queue.segment_path(segment))
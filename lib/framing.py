@@ -0,0 +1,108 @@
+import logging
+
+
+class LineFramer(object):
+    """
+    Буфер, нарезающий поток байт от устройства на строки, разделённые `delimiter`.
+    Данные копятся в одном bytearray, прочитанная часть отмечается смещением read_offset,
+    поэтому на каждую строку приходится один find() и одна копия самой строки,
+    а не копия всего оставшегося буфера.
+    Если строка без разделителя становится длиннее max_line_length, она сбрасывается
+    (вместе с её продолжением до ближайшего разделителя), чтобы устройство, не присылающее
+    перевод строки, не могло раздуть память процесса.
+    """
+
+    def __init__(self, max_line_length=1024*1024, delimiter=b'\n'):
+        """
+
+        :param max_line_length: максимальная длина строки в байтах (без разделителя)
+        :param delimiter: разделитель строк
+        """
+        super(LineFramer, self).__init__()
+        self.max_line_length = max_line_length
+        self.delimiter = delimiter
+        self._buffer = bytearray()
+        self._read_offset = 0
+        # с какой позиции продолжать поиск разделителя, чтобы не сканировать уже просмотренное
+        self._scan_offset = 0
+        # строка оказалась слишком длинной, пропускаем данные до ближайшего разделителя
+        self._discarding = False
+        self.dropped_lines = 0
+
+    def __len__(self):
+        """Количество байт недочитанной (неполной) строки в буфере"""
+        return len(self._buffer) - self._read_offset
+
+    @property
+    def discarding(self):
+        """Идёт пропуск слишком длинной строки: в буфере пусто, но строка ещё не закончилась"""
+        return self._discarding
+
+    def feed(self, data):
+        """
+        Добавляет данные в буфер и возвращает список полных строк (bytes, без разделителя).
+        :param data: bytes, полученные от устройства
+        :return: list
+        """
+        self._buffer += data
+        lines = []
+        delimiter_length = len(self.delimiter)
+
+        while True:
+            index = self._buffer.find(self.delimiter, self._scan_offset)
+            if index < 0:
+                break
+            if self._discarding:
+                # конец слишком длинной строки, саму её уже выбросили
+                self._discarding = False
+            elif index - self._read_offset > self.max_line_length:
+                self._drop_line()
+            else:
+                lines.append(bytes(memoryview(self._buffer)[self._read_offset:index]))
+            self._read_offset = self._scan_offset = index + delimiter_length
+
+        if len(self) > self.max_line_length:
+            # разделителя нет, а строка уже превысила лимит - дальше не копим
+            if not self._discarding:
+                self._drop_line()
+                self._discarding = True
+            self._read_offset = len(self._buffer)
+        # следующий поиск продолжаем с места, где разделитель ещё мог начаться
+        self._scan_offset = max(self._read_offset, len(self._buffer) - delimiter_length + 1)
+
+        self._compact()
+        return lines
+
+    def flush(self):
+        """
+        Возвращает остаток буфера (неполную строку) и очищает буфер.
+        :return: bytes или None, если буфер пуст
+        """
+        rest = None
+        if len(self) and not self._discarding:
+            rest = bytes(memoryview(self._buffer)[self._read_offset:])
+        self.clear()
+        return rest
+
+    def clear(self):
+        self._buffer = bytearray()
+        self._read_offset = self._scan_offset = 0
+        self._discarding = False
+
+    def _drop_line(self):
+        self.dropped_lines += 1
+        logging.warning("Line is longer than {} bytes! Dropping!".format(self.max_line_length))
+
+    def _compact(self):
+        """Выкидывает из начала буфера уже прочитанные данные"""
+        if not self._read_offset:
+            return
+        if self._read_offset == len(self._buffer):
+            self._buffer = bytearray()
+        elif self._read_offset > len(self._buffer) // 2:
+            # сдвигаем, только когда прочитано больше половины - амортизированно линейно
+            del self._buffer[:self._read_offset]
+        else:
+            return
+        self._scan_offset -= self._read_offset
+        self._read_offset = 0
@@ -0,0 +1,44 @@
+"""
+Быстрый JSON для горячих путей приёмщика и загрузчика.
+Берёт первую доступную библиотеку из orjson, ujson, simdjson, иначе стандартный json.
+    loads(data) - принимает bytes или str
+    dumps(obj) - всегда возвращает bytes (utf-8)
+    DecodeError - исключение при неразбираемых данных (все бэкенды бросают наследников ValueError)
+    backend - имя выбранной библиотеки
+"""
+import json
+
+DecodeError = ValueError
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+try:
+    import orjson
+
+    backend = 'orjson'
+    loads = orjson.loads
+    dumps = orjson.dumps
+except ImportError:
+    try:
+        import ujson
+
+        backend = 'ujson'
+        loads = ujson.loads
+
+        def dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+    except ImportError:
+        try:
+            import simdjson
+
+            # simdjson умеет только разбирать
+            backend = 'simdjson'
+            loads = simdjson.loads
+            dumps = _json_dumps
+        except ImportError:
+            backend = 'json'
+            loads = json.loads
+            dumps = _json_dumps
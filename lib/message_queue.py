@@ -2,10 +2,10 @@ import logging
 import os
 from queue import Queue, Empty
 from threading import Thread, Lock
-from time import sleep
+from time import sleep, time
 
 import pika
-from pika.exceptions import ConnectionClosed, ChannelClosed
+from pika.exceptions import ConnectionClosed, ChannelClosed, AMQPError
 
 from config import RABBIT_MQ_CONFIG
 
@@ -25,7 +25,13 @@ class AbstractRabbitManager(Thread):
 
     _lock = Lock()
 
-    def __init__(self, persistent=None, channel_confirm_delivery=False):
+    # пауза между попытками переподключиться к RabbitMQ растёт от MIN до MAX
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 30
+    # как часто во время переподключения вызывать on_reconnect_wait. Меньше ProcessAliver.MAX_FROZEN_TIME.
+    RECONNECT_TICK_INTERVAL = 5
+
+    def __init__(self, persistent=None, channel_confirm_delivery=False, on_reconnect_wait=None):
         """
         
         :param persistent: если не None, сохраняет глобальное соединение под заданным здесь именем.
@@ -34,10 +40,17 @@ class AbstractRabbitManager(Thread):
         Это необходимо для избежания потерь, но говорят, что он слегка замедляет работу очереди.
         Желательно в компонентах, которые получают данные непосредственно от других систем и не могут 
         слать подтверждения о получении (т.к. у этих систем подтверждений не предусмотрено)
+        :param on_reconnect_wait: функция без аргументов, которая вызывается, пока длится переподключение
+        (не реже раза в RECONNECT_TICK_INTERVAL). Компонент передаёт сюда working_tick: ожидание брокера -
+        не зависание, и менеджер зависаний не должен убивать процесс, пока брокер недоступен.
         """
         super(AbstractRabbitManager, self).__init__()
         self.persistent = persistent
         self.channel_confirm_delivery = channel_confirm_delivery
+        self.on_reconnect_wait = on_reconnect_wait
+        # номер подключения: растёт при каждом переподключении
+        self.generation = 0
+        self._reconnect_lock = Lock()
 
         self.initialize()
 
@@ -97,25 +110,85 @@ class AbstractRabbitManager(Thread):
                                     auto_delete=False,
                                     )
 
+    def declare_topology(self):
+        """Объявляет обменники и очереди менеджера. Вызывается и после переподключения."""
+        pass
+
+    def on_reconnect(self):
+        """Вызывается после переподключения, когда топология уже объявлена"""
+        pass
+
+    def reconnect(self, generation):
+        """
+        Переподключается к RabbitMQ, пока не получится, увеличивая паузу между попытками.
+        Если за это время другой поток уже переподключился (generation изменился), ничего не делает.
+        :param generation: номер подключения, на котором случилась ошибка
+        """
+        with self._reconnect_lock:
+            if self.generation != generation:
+                return
+            if self.persistent is None:
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass  # соединение и так мертво
+
+            delay = self.RECONNECT_MIN_DELAY
+            while True:
+                self.reconnect_tick()
+                try:
+                    self.initialize()
+                    self.declare_topology()
+                    break
+                except (AMQPError, OSError) as e:
+                    logging.error("Не удалось переподключиться к RabbitMQ ({!r}), повтор через {} с".format(e, delay))
+                    self.reconnect_sleep(delay)
+                    delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+            self.generation += 1
+            self.on_reconnect()
+            logging.warning("Переподключился к RabbitMQ (подключение #{})".format(self.generation))
+
+    def reconnect_tick(self):
+        if self.on_reconnect_wait is not None:
+            self.on_reconnect_wait()
+
+    def reconnect_sleep(self, delay):
+        """Пауза между попытками переподключения, с вызовами on_reconnect_wait"""
+        deadline = time() + delay
+        while True:
+            self.reconnect_tick()
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            sleep(min(remaining, self.RECONNECT_TICK_INTERVAL))
+
     def catch_disconnect(self, f, *args, **kwargs):
+        """
+        Вызывает f. Если соединение с RabbitMQ потеряно, переподключается на месте и вызывает f снова.
+        f должна сама брать канал из self._channel, а не получать его в аргументах.
+        """
+        attribute_error_reconnected = False
         while True:
+            generation = self.generation
             try:
                 result = f(*args, **kwargs)
                 break
-            except (BrokenPipeError, ConnectionClosed, ChannelClosed):
-                # бывает, что ошибка возникает по нескольку раз.
-                # На НЕперсистентных соединениях могут возникать дублирующиеся соединения без каналов (не знаю, почему)
-                # это не страшно, дохлые безканальные соединения закрываются сами через несколько минут
-                logging.critical("Соединение с RabbitMQ потеряно! Перезапускаю процесс!")
-                os._exit(1)
-                sleep(1)
+            except (BrokenPipeError, ConnectionClosed, ChannelClosed) as e:
+                logging.critical("Соединение с RabbitMQ потеряно ({!r})! Переподключаюсь.".format(e))
+                self.reconnect(generation)
             except AttributeError:
-                # та самая "странная" ошибка
-                logging.critical("Неизвестная ошибка (скорее всего связанная с глюком многопоточности "
-                                 "при работе с pika)! "
-                                 "Убиваю процесс!")
-                os._exit(1)
-                sleep(1)
+                # та самая "странная" ошибка (скорее всего связанная с глюком многопоточности при работе с pika).
+                # Переподключаемся один раз: если и на новом соединении то же самое, переподключаться по кругу
+                # бесполезно. Завершаем процесс, как раньше: исключение тихо остановило бы поток чтения,
+                # а процесс продолжил бы работать с пустой очередью, и ProcessAliver его не перезапустил бы.
+                if attribute_error_reconnected:
+                    logging.critical("Ошибка повторилась после переподключения к RabbitMQ! Перезапускаю процесс!",
+                                     exc_info=True)
+                    os._exit(1)
+                logging.exception("Неизвестная ошибка при работе с RabbitMQ! Переподключаюсь.")
+                self.reconnect(generation)
+                attribute_error_reconnected = True
             except KeyboardInterrupt:
                 logging.warning("Завершаю чтение очереди")
 
@@ -142,6 +215,9 @@ class ExchangePublisherRabbitManager(AbstractRabbitManager):
         # кортеж имён очередей
         self.queue_names = tuple(q + ("_test" if self.DEBUG else "") for q in queues)
 
+        self.declare_topology()
+
+    def declare_topology(self):
         self.declare_exchange(self.exchange_name)
         self.declare_and_bind_queues(self.exchange_name, self.queue_names)
 
@@ -161,20 +237,209 @@ class ExchangePublisherRabbitManager(AbstractRabbitManager):
             self.declare_queue(q)
             self.bind_queue(exchange_name, q)
 
-    def _send_message(self, message):
+    def _send_message(self, message, headers=None):
         self._channel.basic_publish(exchange=self.exchange_name,
                                     body=message,
                                     routing_key='',
-                                    properties=pika.BasicProperties(delivery_mode=2),
+                                    properties=pika.BasicProperties(delivery_mode=2, headers=headers),
                                     )
 
-    def send_message(self, message):
-        self.catch_disconnect(self._send_message, message)
+    def send_message(self, message, headers=None):
+        """
+        Публикует сообщение в обменник.
+        :param message: тело сообщения
+        :param headers: словарь заголовков AMQP (например, server_time) или None
+        """
+        self.catch_disconnect(self._send_message, message, headers=headers)
 
     def run(self):
         pass
 
 
+class OutboxPublisherRabbitManager(ExchangePublisherRabbitManager):
+    """
+    Публикатор для цикла событий asyncio. send_message не ходит в RabbitMQ, а кладёт сообщение
+    в ограниченную очередь (outbox), которую разгребает поток этого менеджера.
+    Поэтому медленный брокер не останавливает цикл, обслуживающий все устройства.
+    Когда в outbox набирается high_water сообщений, вызывается on_pause; когда поток опустошит его
+    до low_water - on_resume. Оба вызываются в цикле событий loop, и флаг paused меняется только там,
+    поэтому запоздавшее возобновление не может снять новую паузу.
+    Если outbox всё же заполнится до max_size, send_message будет ждать.
+    """
+
+    # как часто обслуживать соединение (heartbeat), если публиковать нечего
+    IDLE_PROCESS_INTERVAL = 5
+
+    def __init__(self, exchange, queues, loop, persistent=None, channel_confirm_delivery=False,
+                 max_size=10000, high_water=None, low_water=None, on_pause=None, on_resume=None, metrics=None):
+        """
+
+        :param loop: цикл событий asyncio, из которого вызывается send_message
+        :param max_size: жёсткое ограничение размера outbox
+        :param high_water: при таком размере outbox вызывается on_pause. По умолчанию 80% от max_size
+        :param low_water: при таком размере outbox вызывается on_resume. По умолчанию 20% от max_size
+        :param on_pause: функция без аргументов
+        :param on_resume: функция без аргументов
+        :param metrics: MetricsSlot с метриками receiver_* (см. ProtocolHandler.METRICS) или None
+        """
+        super(OutboxPublisherRabbitManager, self).__init__(exchange=exchange, queues=queues,
+                                                           persistent=persistent,
+                                                           channel_confirm_delivery=channel_confirm_delivery,
+                                                           )
+        self.loop = loop
+        self.outbox = Queue(maxsize=max_size)
+        self.high_water = high_water if high_water is not None else max_size * 4 // 5
+        self.low_water = low_water if low_water is not None else max_size // 5
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+        self.metrics = metrics
+        self.paused = False  # меняется только в цикле событий
+        self._resume_scheduled = False
+
+        self.daemon = True
+        self.start()
+
+    def send_message(self, message, headers=None):
+        self.outbox.put((message, headers, time()))
+
+        if not self.paused and self.outbox.qsize() >= self.high_water:
+            self.paused = True
+            logging.warning("RabbitMQ outbox is full ({} messages)! Pausing receiving.".format(self.outbox.qsize()))
+            if self.on_pause:
+                self.on_pause()
+
+    def _resume(self):
+        """Вызывается в цикле событий по просьбе потока публикации"""
+        self._resume_scheduled = False
+        # пока вызов шёл до цикла, outbox мог снова наполниться - тогда пауза остаётся
+        if not self.paused or self.outbox.qsize() >= self.high_water:
+            return
+        self.paused = False
+        logging.warning("RabbitMQ outbox drained. Resuming receiving.")
+        if self.on_resume:
+            self.on_resume()
+
+    def run(self):
+        while True:
+            try:
+                message, headers, queued_time = self.outbox.get(timeout=self.IDLE_PROCESS_INTERVAL)
+            except Empty:
+                # BlockingConnection обслуживает heartbeat только внутри своих вызовов
+                self.catch_disconnect(self._process_data_events)
+                continue
+
+            self.catch_disconnect(self._send_message, message, headers=headers)
+            self.outbox.task_done()
+            if self.metrics:
+                self.metrics.inc('receiver_messages_published_total')
+                self.metrics.observe('receiver_publish_latency_seconds', time() - queued_time)
+                self.metrics.set('receiver_outbox_size', self.outbox.qsize())
+
+            if self.paused and not self._resume_scheduled and self.outbox.qsize() <= self.low_water:
+                self._resume_scheduled = True
+                self.loop.call_soon_threadsafe(self._resume)
+
+    def _process_data_events(self):
+        # не self._conn.process_data_events напрямую: после переподключения _conn уже другой
+        self._conn.process_data_events()
+
+    def drain(self, timeout=None):
+        """
+        Ждёт, пока всё, что положено в outbox, будет опубликовано.
+        :param timeout: сколько ждать, секунд. None - без ограничения
+        :return: True, если outbox опустел
+        """
+        deadline = time() + timeout if timeout is not None else None
+        with self.outbox.all_tasks_done:
+            while self.outbox.unfinished_tasks:
+                remaining = deadline - time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.outbox.all_tasks_done.wait(remaining)
+        return True
+
+
+class MessageBatcher(object):
+    """
+    Копит сообщения, пришедшие за один проход цикла событий asyncio, и публикует их одним сообщением AMQP.
+    Сообщения склеиваются через BATCH_DELIMITER, в заголовок batch_size пишется их количество.
+    Пачка уходит в конце текущего прохода цикла (или через max_delay секунд после первого сообщения),
+    либо сразу, как только наберётся max_lines сообщений или max_bytes байт.
+    Заголовки пачки берутся от первого сообщения в ней.
+    Сами сообщения не должны содержать BATCH_DELIMITER.
+    """
+
+    BATCH_DELIMITER = b'\n'
+    BATCH_SIZE_HEADER = 'batch_size'
+
+    def __init__(self, publisher, loop, max_lines=500, max_bytes=512*1024, max_delay=0):
+        """
+
+        :param publisher: менеджер, которым публикуются пачки (должен иметь send_message(message, headers))
+        :param loop: цикл событий asyncio, в котором вызывается send_message
+        :param max_lines: максимальное количество сообщений в пачке
+        :param max_bytes: максимальный размер пачки в байтах
+        :param max_delay: сколько секунд пачка может ждать досылки. 0 - до конца текущего прохода цикла.
+        """
+        super(MessageBatcher, self).__init__()
+        self.publisher = publisher
+        self.loop = loop
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self._messages = []
+        self._bytes = 0
+        self._headers = None
+        self._flush_handle = None
+
+    def send_message(self, message, headers=None):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+
+        if not self._messages:
+            self._headers = headers
+        self._messages.append(message)
+        self._bytes += len(message) + len(self.BATCH_DELIMITER)
+
+        if len(self._messages) >= self.max_lines or self._bytes >= self.max_bytes:
+            self.flush()
+        elif self._flush_handle is None:
+            if self.max_delay:
+                self._flush_handle = self.loop.call_later(self.max_delay, self.flush)
+            else:
+                self._flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Публикует накопленную пачку"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._messages:
+            return
+
+        headers = dict(self._headers or {})
+        headers[self.BATCH_SIZE_HEADER] = len(self._messages)
+        body = self.BATCH_DELIMITER.join(self._messages)
+        self._messages = []
+        self._bytes = 0
+        self._headers = None
+
+        self.publisher.send_message(body, headers=headers)
+
+    @classmethod
+    def split(cls, body, headers):
+        """
+        Разбирает сообщение AMQP обратно на отдельные сообщения.
+        :param body: тело сообщения
+        :param headers: заголовки сообщения (может быть None)
+        :return: список сообщений
+        """
+        if headers and headers.get(cls.BATCH_SIZE_HEADER):
+            return body.split(cls.BATCH_DELIMITER)
+        return [body]
+
+
 class QueueSenderRabbitManager(AbstractRabbitManager):
     """
     Менеджер очередей RabbitMQ, способный отправлять данные только непосредственно в очередь,
@@ -185,6 +450,9 @@ class QueueSenderRabbitManager(AbstractRabbitManager):
                                                        )
         self.queue_name = queue + ("_test" if self.DEBUG else "")
 
+        self.declare_topology()
+
+    def declare_topology(self):
         self.declare_queue(self.queue_name)
 
     def _send_message(self, message):
@@ -204,15 +472,55 @@ class ReaderRabbitManager(AbstractRabbitManager):
     Менеджер очередей RabbitMQ, способный только считывать данные,
     но не отправлять.
     """
-    def __init__(self, queue, persistent=None, autostart=True, auto_ack=False):
-        super(ReaderRabbitManager, self).__init__(persistent=persistent)
+    def __init__(self, queue, persistent=None, autostart=True, auto_ack=False, prefetch_count=None,
+                 on_reconnect_wait=None):
+        """
+
+        :param queue: имя очереди
+        :param persistent:
+        :param autostart: сразу запустить поток чтения
+        :param auto_ack: подтверждать сообщения сразу при получении
+        :param prefetch_count: сколько неподтверждённых сообщений брокер может отдать этому читателю.
+        None - без ограничения. Когда читателей одной очереди несколько, брокер делит сообщения между ними.
+        :param on_reconnect_wait: см. AbstractRabbitManager
+        """
+        super(ReaderRabbitManager, self).__init__(persistent=persistent, on_reconnect_wait=on_reconnect_wait)
         self.queue_name = queue + ("_test" if self.DEBUG else "")
-        self.local_queue = Queue(maxsize=1000)
+        # больше prefetch_count сообщений в локальной очереди оказаться не может
+        self.local_queue = Queue(maxsize=prefetch_count or 1000)
         self.auto_ack = auto_ack
+        self.prefetch_count = prefetch_count
+        # наибольший тег, подтверждённый с multiple=True. Всё до него включительно уже подтверждено.
+        self.acked_tag = 0
+
+        self.declare_topology()
 
         if autostart:
             self.start_queue_reading()
 
+    def declare_topology(self):
+        # очередь объявляет и публикатор, но после перезапуска брокера читатель может подключиться раньше
+        self.declare_queue(self.queue_name)
+
+    def on_reconnect(self):
+        # Неподтверждённые сообщения старого канала брокер отдаст заново, а их теги на новом канале
+        # ничего не значат. Поэтому выкидываем их из локальной очереди и начинаем счёт тегов заново.
+        dropped = 0
+        while True:
+            try:
+                self.local_queue.get(block=False)
+                dropped += 1
+            except Empty:
+                break
+        self.acked_tag = 0
+        if dropped:
+            logging.warning("Dropped {} prefetched messages of the closed channel, "
+                            "they will be redelivered".format(dropped))
+
+    def is_current(self, channel):
+        """Пришли ли сообщения канала channel через текущее подключение (их ещё можно подтвердить)"""
+        return channel is None or channel is self._channel
+
     def start_queue_reading(self):
         """
         Запускает поток, обрабатывающий очередь
@@ -228,6 +536,8 @@ class ReaderRabbitManager(AbstractRabbitManager):
         self.consume_queue()
 
     def _consume_queue(self):
+        if self.prefetch_count:
+            self._channel.basic_qos(prefetch_count=self.prefetch_count)
         self._channel.basic_consume(self._queue_callback, queue=self.queue_name)
         self._channel.start_consuming()
 
@@ -249,20 +559,40 @@ class ReaderRabbitManager(AbstractRabbitManager):
             self.ack(tag=method.delivery_tag)
 
     def ack(self, tag, channel=None, multiple=True):
-        self.catch_disconnect(self._ack, tag, channel=channel, multiple=multiple)
+        """
+        Подтверждает сообщение.
+        :param channel: канал, через который пришло сообщение. None - текущий.
+        Если с тех пор было переподключение, подтверждение пропускается: сообщение придёт заново.
+        """
+        # канал запоминаем до вызова: если catch_disconnect переподключится и повторит вызов,
+        # тег старого канала не должен подтвердить чужое сообщение нового
+        self.catch_disconnect(self._ack, tag, channel=channel or self._channel, multiple=multiple)
 
     def _ack(self, tag, channel=None, multiple=True):
         if not channel:
             channel = self._channel
+        if channel is not self._channel:
+            logging.debug("Skipping ack of tag {} of a closed channel".format(tag))
+            return
+        if tag <= self.acked_tag:
+            # уже подтверждено предыдущим multiple ack. Повторный ack закроет канал с ошибкой.
+            return
         channel.basic_ack(tag, multiple=multiple)
+        if multiple:
+            self.acked_tag = tag
 
-    def read_one(self, block=False):
+    def read_one(self, block=False, timeout=None):
         """
         Прочитать один блок данных из локальной очереди.
         :param block: 
+        :param timeout: сколько секунд ждать данных при block=True. None - ждать бесконечно.
+        Если данных так и не пришло, бросает queue.Empty.
         :return: 
         """
-        result = self.local_queue.get(block=block)
+        if self.ident is not None and not self.is_alive() and self.local_queue.empty():
+            # поток чтения упал: новых сообщений не будет, а компонент считал бы, что очередь просто пуста
+            raise RuntimeError("RabbitMQ reader of {} has stopped".format(self.queue_name))
+        result = self.local_queue.get(block=block, timeout=timeout)
         return result
 
     def read_all(self, block=False):
@@ -0,0 +1,134 @@
+import logging
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from multiprocessing.sharedctypes import RawArray
+from threading import Thread
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'  # сумма и количество наблюдений (например, длительностей)
+
+PREFIX = 'logdb_'
+
+
+class MetricsSlot(object):
+    """
+    Метрики одного компонента в разделяемой памяти (RawArray из double).
+    Слот создаётся в родительском процессе до запуска компонента, процесс компонента пишет в него
+    без блокировок и без обращения к родителю, а родитель читает его при запросе метрик.
+    Каждую метрику должен менять только один поток, иначе inc() может терять приращения.
+    """
+
+    def __init__(self, definitions):
+        """
+
+        :param definitions: словарь {имя метрики: (COUNTER/GAUGE/SUMMARY, описание)}
+        """
+        super(MetricsSlot, self).__init__()
+        self.definitions = definitions
+        # имя метрики -> номер ячейки. У SUMMARY две ячейки: сумма и количество.
+        self._index = {}
+        cells = 0
+        for name, (kind, _) in definitions.items():
+            self._index[name] = cells
+            cells += 2 if kind == SUMMARY else 1
+        self._values = RawArray('d', cells or 1)
+
+    def inc(self, name, value=1):
+        self._values[self._index[name]] += value
+
+    def set(self, name, value):
+        self._values[self._index[name]] = value
+
+    def observe(self, name, value):
+        """Добавляет наблюдение в SUMMARY"""
+        index = self._index[name]
+        self._values[index] += value
+        self._values[index + 1] += 1
+
+    def get(self, name):
+        return self._values[self._index[name]]
+
+    def samples(self):
+        """:return: список (имя метрики, тип, описание, суффикс, значение)"""
+        result = []
+        for name, (kind, help_text) in self.definitions.items():
+            index = self._index[name]
+            if kind == SUMMARY:
+                result.append((name, kind, help_text, '_sum', self._values[index]))
+                result.append((name, kind, help_text, '_count', self._values[index + 1]))
+            else:
+                result.append((name, kind, help_text, '', self._values[index]))
+        return result
+
+
+def escape_label_value(value):
+    """Значение метки в кавычках формата Prometheus: экранируются обратная косая черта, кавычка и перевод строки"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def escape_help(text):
+    """В описании метрики экранируются только обратная косая черта и перевод строки"""
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def render(slots):
+    """
+    Метрики в текстовом формате Prometheus.
+    :param slots: список (словарь меток, MetricsSlot)
+    :return: str
+    """
+    families = {}  # имя метрики -> (тип, описание, строки значений); dict хранит порядок
+    for labels, slot in slots:
+        label_text = ",".join('{}="{}"'.format(key, escape_label_value(value)) for key, value in labels.items())
+        for name, kind, help_text, suffix, value in slot.samples():
+            family = families.setdefault(name, (kind, help_text, []))
+            family[2].append("{}{}{}{{{}}} {!r}".format(PREFIX, name, suffix, label_text, value))
+
+    lines = []
+    for name, (kind, help_text, values) in families.items():
+        lines.append("# HELP {}{} {}".format(PREFIX, name, escape_help(help_text)))
+        lines.append("# TYPE {}{} {}".format(PREFIX, name, kind))
+        lines.extend(values)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(Thread):
+    """
+    HTTP-сервер в родительском процессе, отдающий метрики всех компонентов по GET /metrics
+    в текстовом формате Prometheus.
+    """
+
+    def __init__(self, address, collect):
+        """
+
+        :param address: (host, port), на котором слушать
+        :param collect: функция без аргументов, возвращающая список (словарь меток, MetricsSlot)
+        """
+        super(MetricsServer, self).__init__()
+        self.collect = collect
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render(server.collect()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # каждый опрос в лог не пишем
+                pass
+
+        self.http_server = HTTPServer(address, Handler)
+        logging.info("Serving metrics on http://{}:{}/metrics".format(*address))
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        self.http_server.serve_forever()
@@ -0,0 +1,213 @@
+import fcntl
+import logging
+import os
+import struct
+from itertools import count
+from time import time
+
+from lib import json_codec
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class Spool(object):
+    """
+    Локальный журнал пачек строк (только дописывание) на случай, когда база недоступна.
+    Пачки пишутся в сегменты NNNNNNNNNN.seg записями вида <длина, 4 байта><пачка в JSON>.
+    sync() делает один fsync на все записи с прошлого вызова: после него пачки переживут падение процесса
+    и машины, и сообщения RabbitMQ можно подтверждать.
+    replay() отдаёт пачки по порядку, запоминая в файле offset, докуда дошёл. Полностью отданные
+    сегменты удаляются. Общий размер ограничен max_bytes, при превышении append() бросает SpoolFull.
+    Каталог журнала блокируется (flock), так что одним журналом пользуется один процесс.
+    Пачки, которые невозможно загрузить (а не просто база недоступна), откладываются quarantine()
+    в файл QUARANTINE_FILE, чтобы одна плохая пачка не останавливала доливку всего журнала.
+    """
+
+    SEGMENT_SUFFIX = '.seg'
+    OFFSET_FILE = 'offset'
+    LOCK_FILE = 'lock'
+    QUARANTINE_FILE = 'quarantine.jsonl'
+    RECORD_HEADER = struct.Struct('<I')
+
+    def __init__(self, directory, max_bytes=1024**3, segment_bytes=64*1024**2):
+        """
+
+        :param directory: каталог журнала
+        :param max_bytes: наибольший общий размер сегментов
+        :param segment_bytes: размер, при превышении которого начинается новый сегмент
+        """
+        super(Spool, self).__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, self.LOCK_FILE), 'w')
+        # бросит BlockingIOError, если журналом уже пользуется другой процесс
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        self.segments = sorted(int(name[:-len(self.SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                               if name.endswith(self.SEGMENT_SUFFIX))
+        self.read_offset = self._load_offset()  # смещение в первом сегменте, до которого всё уже отдано
+        self._write_file = None
+        self._dirty = False
+        if self.segments:
+            self._recover(self.segments[-1])
+        self.size = sum(os.path.getsize(self._path(segment)) for segment in self.segments)
+
+    @classmethod
+    def acquire(cls, base_directory, **kwargs):
+        """
+        Открывает первый свободный журнал в base_directory/0, base_directory/1, ...
+        Так у каждого из нескольких процессов-загрузчиков свой журнал, а журнал упавшего процесса
+        подхватывает тот, кто его перезапустил.
+        """
+        for n in count():
+            try:
+                return cls(os.path.join(base_directory, str(n)), **kwargs)
+            except BlockingIOError:
+                continue
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '{:010d}{}'.format(segment, self.SEGMENT_SUFFIX))
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.directory, self.OFFSET_FILE)) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return 0
+
+    def _save_offset(self):
+        path = os.path.join(self.directory, self.OFFSET_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(self.read_offset))
+        os.replace(path + '.tmp', path)
+
+    def _records(self, segment, offset=0):
+        """Записи сегмента, начиная с offset: (пачка, смещение конца записи). Недописанный хвост пропускается."""
+        with open(self._path(segment), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(self.RECORD_HEADER.size)
+                if len(header) < self.RECORD_HEADER.size:
+                    return
+                length, = self.RECORD_HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield data, f.tell()
+
+    def _recover(self, segment):
+        """Обрезает запись, недописанную в последний сегмент при падении"""
+        end = 0
+        for _, end in self._records(segment):
+            pass
+        if end != os.path.getsize(self._path(segment)):
+            logging.warning("Spool segment {} has a torn record, truncating".format(self._path(segment)))
+            with open(self._path(segment), 'r+b') as f:
+                f.truncate(end)
+
+    def _segment_size(self, segment):
+        if self._write_file is not None and segment == self.segments[-1]:
+            return self._write_file.tell()
+        return os.path.getsize(self._path(segment))
+
+    def empty(self):
+        """Всё ли записанное уже отдано через replay()"""
+        if not self.segments:
+            return True
+        return len(self.segments) == 1 and self.read_offset >= self._segment_size(self.segments[0])
+
+    def append(self, rows):
+        """
+        Дописывает пачку в журнал. До sync() запись может не пережить падение.
+        :param rows: список строк (кортежей значений)
+        """
+        data = json_codec.dumps(rows)
+        record_size = self.RECORD_HEADER.size + len(data)
+        if self.size + record_size > self.max_bytes:
+            raise SpoolFull("Spool {} is full ({} bytes)".format(self.directory, self.size))
+
+        if self._write_file is None or self._write_file.tell() >= self.segment_bytes:
+            self._roll()
+        self._write_file.write(self.RECORD_HEADER.pack(len(data)))
+        self._write_file.write(data)
+        self.size += record_size
+        self._dirty = True
+
+    def _roll(self):
+        """Начинает дописывать в новый сегмент"""
+        if self._write_file is not None:
+            self.sync()
+            self._write_file.close()
+        segment = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(segment)
+        self._write_file = open(self._path(segment), 'ab')
+        # fsync каталога, чтобы новый файл не потерялся при падении машины
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def sync(self):
+        """Сбрасывает на диск всё дописанное с прошлого вызова"""
+        if self._dirty:
+            self._write_file.flush()
+            os.fsync(self._write_file.fileno())
+            self._dirty = False
+
+    def replay(self, load, limit=None):
+        """
+        Отдаёт накопленные пачки по порядку. Если load бросит исключение, пачка останется в журнале
+        и будет отдана при следующем вызове.
+        :param load: функция, принимающая список строк (кортежей) и сохраняющая их
+        :param limit: сколько пачек отдать за вызов, None - все
+        :return: количество отданных строк
+        """
+        self.sync()
+        replayed = 0
+        records = 0
+        while self.segments:
+            segment = self.segments[0]
+            for data, end in self._records(segment, self.read_offset):
+                if limit is not None and records >= limit:
+                    return replayed
+                rows = [tuple(row) for row in json_codec.loads(data)]
+                load(rows)
+                replayed += len(rows)
+                records += 1
+                self.read_offset = end
+                self._save_offset()
+
+            if self._write_file is not None and len(self.segments) == 1:
+                if self._write_file.tell() > self.read_offset:
+                    break  # пока читали, дописали ещё
+                self._write_file.close()
+                self._write_file = None
+            self._remove_segment(segment)
+        return replayed
+
+    def quarantine(self, rows, error):
+        """
+        Откладывает пачку, которую не удалось загрузить, в QUARANTINE_FILE (по строке JSON на пачку)
+        для ручного разбора. После возврата пачка на диске.
+        """
+        record = json_codec.dumps({'time': time(), 'error': repr(error), 'rows': rows})
+        path = os.path.join(self.directory, self.QUARANTINE_FILE)
+        with open(path, 'ab') as f:
+            f.write(record + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        logging.error("Spool batch of {} rows can't be loaded ({!r}), moved to {}".format(len(rows), error, path))
+
+    def _remove_segment(self, segment):
+        """Удаляет полностью отданный сегмент"""
+        self.size -= self._segment_size(segment)
+        os.remove(self._path(segment))
+        self.segments.pop(0)
+        self.read_offset = 0
+        self._save_offset()
@@ -0,0 +1,80 @@
+from time import monotonic
+
+
+class TimerWheel(object):
+    """
+    Хешированное колесо таймеров: дедлайны множества объектов (например, соединений) в одном цикле событий
+    asyncio через один call_later на всё колесо, а не по таймеру на объект.
+    Колесо - кольцо из slots ячеек по resolution секунд. Объект лежит в ячейке своего дедлайна;
+    раз в resolution секунд колесо поворачивается, и для объектов текущей ячейки заново спрашивается
+    дедлайн (get_deadline): если он ещё не наступил (объект был активен), объект перекладывается в новую ячейку,
+    иначе вызывается on_expire. Поэтому активность объекта ничего не стоит, пока дедлайн не становится ближе.
+    Дедлайны дальше, чем на slots * resolution секунд, проверяются раньше и перекладываются.
+    """
+
+    def __init__(self, loop, get_deadline, on_expire, resolution=1, slots=1024):
+        """
+
+        :param loop: цикл событий asyncio
+        :param get_deadline: функция (объект) -> текущий дедлайн объекта (по monotonic()) или None, если его нет
+        :param on_expire: функция (объект), вызывается, когда дедлайн наступил. Объект из колеса уже убран.
+        :param resolution: точность срабатывания, секунд
+        :param slots: количество ячеек
+        """
+        super(TimerWheel, self).__init__()
+        self.loop = loop
+        self.get_deadline = get_deadline
+        self.on_expire = on_expire
+        self.resolution = resolution
+        self._slots = [set() for _ in range(slots)]
+        self._scheduled = {}  # объект -> (номер ячейки, дедлайн)
+        self._current = 0  # ячейка, которая сработает следующей
+        self._current_time = monotonic() + resolution  # когда она сработает
+        self._handle = loop.call_later(resolution, self._tick)
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def schedule(self, item, deadline):
+        """
+        Ставит объект на дедлайн. Если объект уже стоит на более ранний дедлайн, ничего не делает:
+        при срабатывании всё равно будет спрошен get_deadline.
+        """
+        scheduled = self._scheduled.get(item)
+        if scheduled is not None:
+            if scheduled[1] <= deadline:
+                return
+            self._slots[scheduled[0]].discard(item)
+
+        ticks = int((deadline - self._current_time) // self.resolution) + 1
+        ticks = max(0, min(ticks, len(self._slots) - 1))
+        index = (self._current + ticks) % len(self._slots)
+        self._slots[index].add(item)
+        self._scheduled[item] = (index, deadline)
+
+    def discard(self, item):
+        scheduled = self._scheduled.pop(item, None)
+        if scheduled is not None:
+            self._slots[scheduled[0]].discard(item)
+
+    def close(self):
+        self._handle.cancel()
+
+    def _tick(self):
+        slot = self._slots[self._current]
+        self._slots[self._current] = set()
+        self._current = (self._current + 1) % len(self._slots)
+        self._current_time += self.resolution
+        # от накопившегося опоздания не отстаём: следующий поворот по расписанию, а не через resolution
+        self._handle = self.loop.call_later(max(0, self._current_time - monotonic()), self._tick)
+
+        now = monotonic()
+        for item in slot:
+            del self._scheduled[item]
+            deadline = self.get_deadline(item)
+            if deadline is None:
+                continue
+            if deadline <= now:
+                self.on_expire(item)
+            else:
+                self.schedule(item, deadline)
@@ -1,16 +1,111 @@
 import logging
+import os
 from time import time, sleep
-from queue import Empty
+from queue import Queue, Empty
+from collections import deque
+from threading import Thread
 
-from lib.common import Node
-from lib.message_queue import ReaderRabbitManager
-from lib.database import Database
+from lib.common import Node, StopRequested
+from lib.metrics import COUNTER, GAUGE, SUMMARY
+from lib.message_queue import ReaderRabbitManager, MessageBatcher
+from lib.disk_queue import DiskQueueReader
+from lib.database import ConnectionPool, Database, OperationalError
+from lib.spool import Spool
+from loaders.batch_controller import AdaptiveBatchController
+from config import QUEUE_TRANSPORT, SPOOL_DIR
+
+
+class BatchWriter(Thread):
+	"""
+	Поток, который пишет пачки загрузчика в базу, пока основной поток загрузчика читает очередь.
+	Пачки пишутся строго по порядку. Результат каждой (теги для подтверждения или исключение)
+	кладётся в committed_queue, подтверждает их основной поток.
+	"""
+
+	def __init__(self, loader, max_inflight):
+		"""
+
+		:param loader: AbstractLoader, чей write_batch вызывается
+		:param max_inflight: сколько пачек может ждать записи
+		"""
+		super(BatchWriter, self).__init__()
+		self.loader = loader
+		self.write_queue = Queue(maxsize=max_inflight)
+		self.committed_queue = Queue()
+		self.daemon = True
+		self.start()
+
+	def run(self):
+		failed = False
+		while True:
+			try:
+				rows, tags, channel, bulk, oldest_server_time = self.write_queue.get(
+					timeout=self.loader.spool_replay_wait())
+			except Empty:
+				# писать нечего - самое время доливать журнал
+				if not failed:
+					try:
+						self.loader.replay_spool()
+					except Exception:
+						logging.exception("Spool replay failed!")
+				continue
+			if failed:
+				# после упавшей пачки следующие не пишем и не подтверждаем, только освобождаем очередь,
+				# чтобы основной поток не завис на ней и увидел ошибку
+				continue
+			try:
+				self.loader.write_batch(rows, bulk, channel)
+			except Exception as e:
+				logging.exception("Batch write failed!")
+				failed = True
+				self.committed_queue.put((tags, channel, oldest_server_time, e))
+				continue
+			self.committed_queue.put((tags, channel, oldest_server_time, None))
 
 
 class AbstractLoader(Node):
 	"""
 	
 	"""
+
+	# Сколько неподтверждённых строк RabbitMQ держит на одном загрузчике (в памяти и в local_queue;
+	# после падения загрузчика все они придут заново). Брокер считает сообщения, а в сообщении - пачка
+	# до MESSAGE_MAX_ROWS строк, поэтому prefetch_count = PREFETCH_ROWS // MESSAGE_MAX_ROWS сообщений.
+	PREFETCH_ROWS = 50000
+	# наибольшее количество строк в одном сообщении (ProtocolHandler.BATCH_MAX_LINES, выставляет logdb_server)
+	MESSAGE_MAX_ROWS = 500
+	# сколько секунд по SIGTERM можно дописывать буфер и пачки в полёте, прежде чем выйти
+	SHUTDOWN_TIMEOUT = 10
+
+	METRICS = dict(Node.METRICS, **{
+		'loader_messages_total': (COUNTER, "Messages read from the queue"),
+		'loader_rows_total': (COUNTER, "Rows read from the queue"),
+		'loader_local_queue_depth': (GAUGE, "Messages prefetched and waiting in the local queue"),
+		'loader_buffer_rows': (GAUGE, "Rows in the buffer at the last flush"),
+		'loader_buffer_peak_rows': (GAUGE, "Largest buffer size between the last two flushes"),
+		'loader_buffer_full_flushes_total': (COUNTER, "Flushes forced because the buffer reached MAX_BUFFER_ROWS"),
+		'loader_batch_rows': (SUMMARY, "Rows per batch submitted to the database"),
+		'loader_inflight_batches': (GAUGE, "Batches submitted but not yet written"),
+		'loader_insert_seconds': (SUMMARY, "Duration of a batch INSERT or LOAD DATA"),
+		'loader_rows_inserted_total': (COUNTER, "Rows written to the database"),
+		'loader_rows_spooled_total': (COUNTER, "Rows written to the local spool while the database was unavailable"),
+		'loader_rows_replayed_total': (COUNTER, "Rows loaded from the local spool into the database"),
+		'loader_rows_quarantined_total': (COUNTER, "Spooled rows that failed to load and were set aside"),
+		'loader_ack_lag_seconds': (GAUGE, "Time from receiving the oldest row of the last acked batch to its ack"),
+		'loader_batch_size_target': (GAUGE, "Batch size chosen by the batch controller"),
+		'loader_flush_interval_seconds': (GAUGE, "Buffer flush interval chosen by the batch controller"),
+		'loader_stale_rows_dropped_total': (COUNTER, "Buffered rows dropped after reconnecting to RabbitMQ"),
+		'loader_stale_batch_rows_skipped_total': (COUNTER,
+												"Rows of batches not written because RabbitMQ reconnected"),
+		'loader_db_pool_connections': (GAUGE, "Open database connections, including checked out ones"),
+		'loader_db_pool_checkouts_total': (COUNTER, "Database connections taken from the pool"),
+		'loader_db_pool_wait_seconds_total': (COUNTER, "Time spent waiting for a free database connection"),
+		'loader_db_pool_wait_max_seconds': (GAUGE, "Longest wait for a free database connection"),
+		'loader_db_reconnects_total': (COUNTER, "Dead pooled database connections reopened"),
+	})
+	STATUS_METRICS = ('loader_rows_total', 'loader_rows_inserted_total', 'loader_local_queue_depth',
+						'loader_ack_lag_seconds')
+
 	def __init__(self, protocol_name, loader_type):
 		"""
 		
@@ -21,10 +116,55 @@ class AbstractLoader(Node):
 
 		# Максимальное количество блоков данных, которое можно залить в базу за один запрос.
 		self.MAX_DATABLOCKS_PER_QUERY = 100
-		self.BUFFER_FLUSH_TIMEOUT = 1  # сливаем буффер в базу через это время
+		self.BUFFER_FLUSH_TIMEOUT = 1  # сливаем буффер в базу через это время после попадания в него первой строки
+		# Подстраивает MAX_DATABLOCKS_PER_QUERY и BUFFER_FLUSH_TIMEOUT под нагрузку после каждого слива.
+		# None - значения выше не меняются.
+		self.batch_controller = AdaptiveBatchController(initial_batch=self.MAX_DATABLOCKS_PER_QUERY,
+														initial_interval=self.BUFFER_FLUSH_TIMEOUT)
+		# сколько ждать данных при пустом буфере, прежде чем отправить тик о работе
+		self.MAX_IDLE_WAIT = 5
 		self.last_flush_time = time()
-		self.buffer = []  # сюда пишутся обработанные данные для последующего группового слива в базу
-		self.tag_buffer = []
+		self.flush_deadline = None  # когда нужно слить буфер. None - буфер пуст
+		# server_time самой старой строки в буфере и задержка от приёма строки до записи в базу при последнем сливе
+		self.oldest_server_time = None
+		self.last_flush_latency = None
+		# Когда локальная очередь заполнена на такую долю prefetch_count (догоняем отставание),
+		# буфер копится до MAX_BULK_ROWS строк и заливается через LOAD DATA LOCAL INFILE.
+		self.BULK_BACKLOG_FRACTION = 0.5
+		self.MAX_BULK_ROWS = 10000
+		# Сколько строк может лежать в буфере, какие бы размеры пачек ни выбрал batch_controller.
+		# При достижении буфер сливается, даже если время не пришло.
+		self.MAX_BUFFER_ROWS = 10000
+		self.buffer = deque()  # сюда пишутся обработанные данные для последующего группового слива в базу
+		# delivery tag сообщения, которое можно подтвердить после слива соответствующей строки буфера, или None.
+		# Сообщение может содержать пачку строк, тогда тег ставится только последней из них.
+		# Строка, которую handle() отбросил, хранится в буфере как None - ради тега.
+		self.tag_buffer = deque()
+		self.buffer_peak = 0  # наибольший размер буфера с прошлого слива
+		# Сколько сообщений RabbitMQ ждут слива буфера. Когда их prefetch_count, брокер больше ничего не пришлёт,
+		# пока их не подтвердят, поэтому буфер сливается, не дожидаясь таймаута.
+		self.buffer_messages = 0
+		# Сколько пачек может писаться в базу, пока основной цикл продолжает читать очередь.
+		# 0 - писать синхронно в основном потоке.
+		self.MAX_INFLIGHT_BATCHES = 2
+		# как часто проверять, записаны ли пачки в полёте
+		self.COMMITTED_POLL_INTERVAL = 0.05
+		self.batch_writer = None  # BatchWriter, создаётся при первом сливе
+		# Локальный журнал на время недоступности базы: пачки пишутся туда, сообщения подтверждаются,
+		# а когда база вернётся, журнал доливается в неё через LOAD DATA. None - не использовать журнал.
+		self.SPOOL_DIR = SPOOL_DIR
+		self.SPOOL_MAX_BYTES = 1024**3
+		self.SPOOL_REPLAY_INTERVAL = 10  # через сколько секунд после отказа базы пробовать её снова
+		self.SPOOL_REPLAY_BATCHES = 20  # сколько пачек журнала доливать за раз
+		self.spool = None
+		# до какого времени считать базу недоступной: пачки сразу идут в журнал, не дожидаясь отказа соединения
+		self.database_retry_time = 0
+		self.inflight_batches = 0
+		self.pending_messages = deque()  # ещё не обработанные строки текущей пачки
+		self.current_is_last = True  # текущая строка - последняя в своём сообщении RabbitMQ
+		# Канал RabbitMQ, через который пришли строки буфера. Если с тех пор было переподключение,
+		# теги этих строк недействительны, а сами сообщения брокер отдаст заново.
+		self.buffer_channel = None
 		self.db_name = ''  # имя базы, как прописано в config.py
 		self.table = ''  # имя таблицы для записи пакета
 		self.fields = ()  # поля таблицы,
@@ -33,73 +173,352 @@ class AbstractLoader(Node):
 		self.rabbit_queue_name = "_".join((protocol_name, "loader", loader_type))
 		logging.info("loader queue {}".format(self.rabbit_queue_name))#debug
 
+	def prefetch_count(self):
+		"""prefetch_count RabbitMQ в сообщениях, см. PREFETCH_ROWS"""
+		return max(1, self.PREFETCH_ROWS // self.MESSAGE_MAX_ROWS)
+
 	def run(self):
 		# нужно задать менеджер здесь, иначе локальная очередь окажется в разных процессах
-		self.read_rabbit_manager = ReaderRabbitManager(queue=self.rabbit_queue_name,
+		if QUEUE_TRANSPORT == 'disk':
+			self.read_rabbit_manager = DiskQueueReader(queue=self.rabbit_queue_name,
 														autostart=True,
-														auto_ack=False,)
+														prefetch_count=self.prefetch_count(),)
+		else:
+			# пока брокер недоступен, основной поток стоит в ack() и не сообщает о работе - за него это делает
+			# переподключение, иначе aliver убьёт загрузчик через MAX_FROZEN_TIME
+			self.read_rabbit_manager = ReaderRabbitManager(queue=self.rabbit_queue_name,
+															autostart=True,
+															auto_ack=False,
+															prefetch_count=self.prefetch_count(),
+															on_reconnect_wait=lambda: self.working_tick(True),)
+		if self.SPOOL_DIR:
+			self.spool = Spool.acquire(os.path.join(self.SPOOL_DIR, self.rabbit_queue_name),
+										max_bytes=self.SPOOL_MAX_BYTES)
+			if not self.spool.empty():
+				logging.warning("Spool {} has unloaded batches, will replay them".format(self.spool.directory))
 		super(AbstractLoader, self).run()
 
 	def flush(self):
 		"""
-		Сливает буффер в базу
+		Сливает буффер в базу: нарезает его на пачки и отдаёт их на запись.
+		При MAX_INFLIGHT_BATCHES > 0 пачки пишет поток BatchWriter, а этот метод возвращается,
+		как только пачки поставлены в очередь на запись (или ждёт, пока в ней освободится место).
 		:return:
 		"""
+		self.metrics.set('loader_buffer_rows', len(self.buffer))
+		self.metrics.set('loader_buffer_peak_rows', self.buffer_peak)
+
+		if not self.read_rabbit_manager.is_current(self.buffer_channel):
+			# после переподключения к RabbitMQ сообщения этих строк придут заново
+			logging.warning("Dropping {} buffered rows of a closed channel, they will be redelivered".format(
+				len(self.buffer)))
+			self.metrics.inc('loader_stale_rows_dropped_total', len(self.buffer))
+			self.buffer.clear()
+			self.tag_buffer.clear()
+
+		oldest_server_time = self.oldest_server_time
+		while self.buffer:
+			bulk = len(self.buffer) > self.MAX_DATABLOCKS_PER_QUERY and self.bulk_mode()
+			rows, tags = self.pop_buffer(self.MAX_BULK_ROWS if bulk else self.MAX_DATABLOCKS_PER_QUERY)
+			# задержку считаем по первой пачке слива: в ней самая старая строка
+			self.submit_batch(rows, tags, self.buffer_channel, bulk, oldest_server_time)
+			oldest_server_time = None
+
+		self.last_flush_time = time()
+		self.flush_deadline = None
+		self.oldest_server_time = None
+		self.buffer_peak = 0
+		self.buffer_messages = 0
+
+		queue_depth = self.read_rabbit_manager.local_queue.qsize()
+		self.metrics.set('loader_local_queue_depth', queue_depth)
+		if self.batch_controller:
+			self.batch_controller.observe_queue_depth(queue_depth)
+			self.MAX_DATABLOCKS_PER_QUERY = self.batch_controller.batch_size
+			self.BUFFER_FLUSH_TIMEOUT = self.batch_controller.flush_interval
+		self.metrics.set('loader_batch_size_target', self.MAX_DATABLOCKS_PER_QUERY)
+		self.metrics.set('loader_flush_interval_seconds', self.BUFFER_FLUSH_TIMEOUT)
+		self.update_pool_metrics()
+
+	def update_pool_metrics(self):
+		"""Переносит статистику пула соединений (ConnectionPool.stats) в метрики"""
+		stats = ConnectionPool.database_stats(self.db_name)
+		self.metrics.set('loader_db_pool_connections', stats['size'])
+		self.metrics.set('loader_db_pool_checkouts_total', stats['checkouts'])
+		self.metrics.set('loader_db_pool_wait_seconds_total', stats['wait_time_total'])
+		self.metrics.set('loader_db_pool_wait_max_seconds', stats['wait_time_max'])
+		self.metrics.set('loader_db_reconnects_total', stats['reconnects'])
+
+	def submit_batch(self, rows, tags, channel, bulk, oldest_server_time):
+		"""
+		Записывает пачку в базу сразу или отдаёт потоку записи
+		:param channel: канал RabbitMQ, через который пришли сообщения пачки (см. ReaderRabbitManager.is_current)
+		"""
+		self.metrics.observe('loader_batch_rows', len(rows))
+		if not self.MAX_INFLIGHT_BATCHES:
+			self.write_batch(rows, bulk, channel)
+			self.commit_batch(tags, channel, oldest_server_time)
+			return
+
+		if self.batch_writer is None:
+			self.batch_writer = BatchWriter(self, self.MAX_INFLIGHT_BATCHES)
+		self.inflight_batches += 1
+		self.metrics.set('loader_inflight_batches', self.inflight_batches)
+		# если в очереди на запись нет места, ждём здесь - это и есть ограничение числа пачек в полёте
+		self.batch_writer.write_queue.put((rows, tags, channel, bulk, oldest_server_time))
+		self.process_committed()
+
+	def write_batch(self, rows, bulk, channel=None):
+		"""
+		Записывает строки пачки в базу, а если база недоступна - в журнал.
+		Вызывается из потока записи, если он используется.
+		:param rows: строки
+		:param bulk: заливать через LOAD DATA LOCAL INFILE
+		:param channel: канал RabbitMQ сообщений пачки. Если он уже закрыт, пачка не пишется:
+		её сообщения всё равно придут заново, и строки задвоились бы.
+		"""
+		if not rows:
+			return
+		if not self.read_rabbit_manager.is_current(channel):
+			logging.warning("Skipping batch of {} rows of a closed channel, they will be redelivered".format(len(rows)))
+			self.metrics.inc('loader_stale_batch_rows_skipped_total', len(rows))
+			return
+		if self.spool is None:
+			self.insert_batch(rows, bulk)
+			return
 
-		with Database(self.db_name, persistent=True) as db:
+		if time() < self.database_retry_time:
+			self.spool_batch(rows)
+			return
+		try:
+			self.insert_batch(rows, bulk, retry=False)
+		except OperationalError as e:
+			logging.error("Database is unavailable ({}), spooling {} rows".format(e, len(rows)))
+			self.database_retry_time = time() + self.SPOOL_REPLAY_INTERVAL
+			self.spool_batch(rows)
+			return
+		# База отвечает: новые пачки пишутся напрямую, а журнал доливается рядом с ними.
+		# Если бы новые пачки шли в журнал, пока он не пуст, при потоке больше скорости долива он бы только рос.
+		self.replay_spool()
+
+	def spool_batch(self, rows):
+		"""Пишет пачку в журнал. После возврата пачка на диске и её сообщения можно подтверждать."""
+		self.spool.append(rows)
+		self.spool.sync()
+		self.metrics.inc('loader_rows_spooled_total', len(rows))
+
+	def spool_replay_wait(self):
+		"""Сколько потоку записи ждать новых пачек, прежде чем доливать журнал"""
+		if self.spool is None or self.spool.empty():
+			return self.SPOOL_REPLAY_INTERVAL
+		# пока база доступна, журнал доливается непрерывно
+		return max(0, self.database_retry_time - time())
+
+	def replay_spool(self):
+		"""Доливает в базу до SPOOL_REPLAY_BATCHES пачек журнала, если он не пуст и база не отказывала недавно"""
+		if self.spool is None or self.spool.empty() or time() < self.database_retry_time:
+			return
+		rows_quarantined = 0
+
+		def load(rows):
+			nonlocal rows_quarantined
+			try:
+				db.bulk_load(self.table, self.fields, rows)
+			except OperationalError:
+				raise  # база недоступна - пачка останется в журнале
+			except Exception as e:
+				# с пачкой что-то не так, повторять бесполезно: откладываем, иначе журнал встанет на ней навсегда
+				self.spool.quarantine(rows, e)
+				rows_quarantined += len(rows)
+
+		try:
+			with Database(self.db_name, persistent=True, retry=False, local_infile=True) as db:
+				rows_loaded = self.spool.replay(load, limit=self.SPOOL_REPLAY_BATCHES) - rows_quarantined
+			logging.info("Replayed {} rows from spool".format(rows_loaded))
+			self.metrics.inc('loader_rows_replayed_total', rows_loaded)
+			self.metrics.inc('loader_rows_quarantined_total', rows_quarantined)
+			if self.spool.empty():
+				logging.warning("Spool {} is fully replayed".format(self.spool.directory))
+		except OperationalError as e:
+			logging.warning("Database is still unavailable ({}), spool is kept".format(e))
+			self.database_retry_time = time() + self.SPOOL_REPLAY_INTERVAL
+
+	def insert_batch(self, rows, bulk, retry=True):
+		"""
+		Записывает строки пачки в базу.
+		:param retry: если база недоступна, ждать её (иначе сразу OperationalError)
+		"""
+		# LOAD DATA LOCAL INFILE разрешён только на соединениях для bulk_load
+		with Database(self.db_name, persistent=True, retry=retry, local_infile=bulk) as db:
+			# кодировку Database выставляет один раз при открытии соединения
 			cursor = db.cursor()
 
-			# выставляем кодировку, иначе будет глючить на latin-1
-			db._conn.set_character_set('utf8')
-			cursor.execute('SET NAMES utf8;')
-			cursor.execute('SET CHARACTER SET utf8;')
-			cursor.execute('SET character_set_connection=utf8;')
-
-			while self.buffer:
-				data_to_flush = self.buffer[:self.MAX_DATABLOCKS_PER_QUERY]
-				tags_to_flush = self.tag_buffer[:self.MAX_DATABLOCKS_PER_QUERY]
-				self.buffer = self.buffer[self.MAX_DATABLOCKS_PER_QUERY:]
-				self.tag_buffer = self.tag_buffer[self.MAX_DATABLOCKS_PER_QUERY:]
-				# logging.info("rows flushed: {}".format(len(data_to_flush)))#debug
+			if self.batch_controller and self.batch_controller.max_allowed_packet is None:
+				cursor.execute('SELECT @@max_allowed_packet;')
+				self.batch_controller.set_max_allowed_packet(int(cursor.fetchone()[0]))
+
+			insert_start = time()
+			if bulk:
+				rows_inserted = db.bulk_load(self.table, self.fields, rows)
+				logging.debug("rows_loaded {}".format(rows_inserted))
+			else:
 				# logging.info("query: {}".format(self.query))#debug
-				# logging.info("data_to_flush {}".format(data_to_flush))#debug
-				rows_inserted = cursor.executemany(self.query, data_to_flush)
-				logging.info("rows_inserted {}".format(rows_inserted))#debug
-				for t in tags_to_flush:
-					self.ack(status=True, multiple=False, tag=t)
-				self.working_tick(True)  # отправляем подтверждение успешной обработки пакета
+				rows_inserted = cursor.executemany(self.query, rows)
+				logging.debug("rows_inserted {}".format(rows_inserted))
+				if self.batch_controller:
+					self.batch_controller.observe_insert(len(rows), time() - insert_start, self.estimate_size(rows))
+			self.metrics.observe('loader_insert_seconds', time() - insert_start)
+			self.metrics.inc('loader_rows_inserted_total', len(rows))
+
+	def commit_batch(self, tags, channel, oldest_server_time):
+		"""Пачка записана (autocommit) - подтверждаем все её сообщения одним ack"""
+		self.ack_batch(tags, channel)
+		self.working_tick(True)  # отправляем подтверждение успешной обработки пакета
+		if oldest_server_time:
+			self.last_flush_latency = time() - oldest_server_time
+			logging.debug("Receive to insert latency: {:.3f} s".format(self.last_flush_latency))
+			self.metrics.set('loader_ack_lag_seconds', self.last_flush_latency)
+
+	def process_committed(self):
+		"""
+		Подтверждает пачки, которые поток записи уже записал. Подтверждения идут из основного потока,
+		в порядке записи пачек. Если запись упала, бросает её исключение.
+		"""
+		while self.inflight_batches:
+			try:
+				tags, channel, oldest_server_time, error = self.batch_writer.committed_queue.get(block=False)
+			except Empty:
+				break
+			self.inflight_batches -= 1
+			self.metrics.set('loader_inflight_batches', self.inflight_batches)
+			if error is not None:
+				raise error
+			self.commit_batch(tags, channel, oldest_server_time)
+
+	@staticmethod
+	def estimate_size(rows):
+		"""Примерный объём строк в запросе, байт"""
+		return sum(len(value) if isinstance(value, (str, bytes)) else 8 for row in rows for value in row)
+
+	def pop_buffer(self, count):
+		"""
+		Забирает из начала буфера до count строк.
+		:return: (строки для записи в базу без отброшенных, теги этих строк)
+		"""
+		count = min(count, len(self.buffer))
+		rows = []
+		tags = []
+		for _ in range(count):
+			row = self.buffer.popleft()
+			if row is not None:
+				rows.append(row)
+			tags.append(self.tag_buffer.popleft())
+		return rows, tags
+
+	def bulk_mode(self):
+		"""Накопилось ли отставание, при котором выгоднее заливать через LOAD DATA (и разрешает ли его база)"""
+		if self.db_name in Database.bulk_load_refused:
+			return False
+		return self.read_rabbit_manager.local_queue.qsize() >= self.prefetch_count() * self.BULK_BACKLOG_FRACTION
+
+	def flush_size(self):
+		"""Сколько строк должно накопиться в буфере, чтобы слить его, не дожидаясь таймаута"""
+		return self.MAX_BULK_ROWS if self.bulk_mode() else self.MAX_DATABLOCKS_PER_QUERY
 
 	def check_flush(self):
 		"""
-		Проверяет, не пора ли слить буфер в базу.
+		Проверяет, не пора ли слить буфер в базу: набралось flush_size() строк, вышло время
+		или в буфере строки всех сообщений, которые брокер отдал без подтверждения.
+		В любом случае буфер не растёт больше MAX_BUFFER_ROWS.
 		:return: 
 		"""
-		time_since_flush = time() - self.last_flush_time
-		# буфер не пуст и время пришло
-		if self.buffer and time_since_flush > self.BUFFER_FLUSH_TIMEOUT:
+		if len(self.buffer) >= self.MAX_BUFFER_ROWS:
+			self.metrics.inc('loader_buffer_full_flushes_total')
+			self.flush()
+		elif self.buffer and (len(self.buffer) >= self.flush_size() or time() >= self.flush_deadline or
+							self.buffer_messages >= self.prefetch_count()):
 			# logging.info("flushing! Buffer: {}".format(self.buffer))#debug
 			self.flush()
-			self.last_flush_time = time()
 
 	def get(self, block=False):
-		while True:
+		"""
+		Возвращает очередную строку. Сообщения-пачки от MessageBatcher разбираются на отдельные строки,
+		служебная информация RabbitMQ у всех строк пачки общая.
+		Ждёт данные ровно до момента, когда придёт время сливать буфер.
+		"""
+		while not self.pending_messages:
+			if self.stopping:
+				# новых сообщений не берём: то, что уже в локальной очереди, брокер отдаст заново
+				raise StopRequested()
 			self.check_flush()
+			self.process_committed()
+			if self.flush_deadline is not None:
+				timeout = max(0, self.flush_deadline - time())
+			else:
+				timeout = self.MAX_IDLE_WAIT
+			if self.inflight_batches:
+				# пачки в полёте надо подтвердить вскоре после записи
+				timeout = min(timeout, self.COMMITTED_POLL_INTERVAL)
+			if self.batch_writer is None:
+				# потока записи нет - журнал доливает основной поток, пока нет данных
+				timeout = min(timeout, self.spool_replay_wait())
 			try:
 				# получаем данные (служебная инфа RabbitMQ записывается в переменные self.*)
-				data = super(AbstractLoader, self).get(block=False)
-				break
+				body = super(AbstractLoader, self).get(block=True, timeout=timeout)
 			except Empty:
-				sleep(1)
+				if self.batch_writer is None:
+					self.replay_spool()
+				if not self.buffer and not self.inflight_batches:
+					# данных нет, но процесс жив
+					self.working_tick(True)
+				continue
+			if self.buffer and self.current_ch is not self.buffer_channel:
+				# сообщение пришло уже через новое подключение, строки старого в буфере не смешиваем с ним
+				self.flush()
+			headers = self.current_properties.headers if self.current_properties else None
+			lines = MessageBatcher.split(body, headers)
+			self.pending_messages.extend(lines)
+			self.metrics.inc('loader_messages_total')
+			self.metrics.inc('loader_rows_total', len(lines))
 
+		data = self.pending_messages.popleft()
+		self.current_is_last = not self.pending_messages
 		return data
 
-	def put(self, data):
-		if data:
-			self.buffer.append(data)
-			self.tag_buffer.append(self.get_current_tag())
+	def shutdown(self):
+		"""Сливает буфер, дожидается записи пачек в полёте и подтверждает их, но не дольше SHUTDOWN_TIMEOUT"""
+		deadline = time() + self.SHUTDOWN_TIMEOUT
+		logging.warning("Stopping loader: {} buffered rows, {} batches in flight".format(
+			len(self.buffer), self.inflight_batches))
+		try:
+			if self.buffer:
+				self.flush()
+			while self.inflight_batches and time() < deadline:
+				self.process_committed()
+				if self.inflight_batches:
+					sleep(self.COMMITTED_POLL_INTERVAL)
+		except Exception:
+			logging.exception("Failed to write the buffer on shutdown!")
+		if self.inflight_batches:
+			logging.error("{} batches were not written in {} s, their messages will be redelivered".format(
+				self.inflight_batches, self.SHUTDOWN_TIMEOUT))
 		else:
-			return True
+			logging.warning("Loader stopped, everything received is written and acked")
 
+	def put(self, data):
+		# сообщение RabbitMQ можно подтвердить только после слива его последней строки
+		tag = self.get_current_tag() if self.current_is_last else None
+		if data or tag is not None:
+			if not self.buffer:
+				self.flush_deadline = time() + self.BUFFER_FLUSH_TIMEOUT
+				self.oldest_server_time = self.get_header('server_time')
+				self.buffer_channel = self.current_ch
+			self.buffer.append(data or None)
+			self.tag_buffer.append(tag)
+			if tag is not None:
+				self.buffer_messages += 1
+			self.buffer_peak = max(self.buffer_peak, len(self.buffer))
+			self.check_flush()
 
 		return False  # пока не отправляем подтверждение. Слив в базу происходит во flush
 
@@ -0,0 +1,142 @@
+import logging
+from time import time
+
+
+class AdaptiveBatchController(object):
+	"""
+	Подбирает размер пачки строк на один INSERT и интервал слива буфера загрузчика.
+	Размер пачки - такой, чтобы один запрос укладывался в target_latency секунд
+	(по наблюдаемому времени вставки одной строки) и в max_allowed_packet базы.
+	Пока в очереди есть отставание, допустимая длительность запроса растёт с её глубиной (backlog_factor):
+	большие пачки вставляются быстрее в пересчёте на строку, а задержка тут уже определяется очередью.
+	Интервал слива - короткий, пока в очереди есть отставание, и растёт, пока очередь пуста.
+	Все решения держатся в пределах заданных границ и доступны через metrics().
+	"""
+
+	# коэффициент сглаживания наблюдений (экспоненциальное скользящее среднее)
+	SMOOTHING = 0.2
+	# какую часть max_allowed_packet можно занимать одним запросом
+	PACKET_USAGE = 0.8
+	# во сколько раз размер пачки может измениться за одно решение
+	MAX_STEP = 2
+	# во сколько раз растёт интервал слива, пока очередь пуста
+	INTERVAL_GROWTH = 1.5
+	# на каждые BACKLOG_DEPTH_STEP сообщений в очереди допустимая длительность запроса растёт на target_latency,
+	# но не больше чем в MAX_BACKLOG_FACTOR раз
+	BACKLOG_DEPTH_STEP = 10
+	MAX_BACKLOG_FACTOR = 4
+	# как часто писать решения в лог
+	LOG_PERIOD = 60
+
+	def __init__(self, min_batch=50, max_batch=5000, min_interval=0.2, max_interval=5,
+				target_latency=0.25, initial_batch=100, initial_interval=1):
+		"""
+
+		:param min_batch: наименьший размер пачки, строк
+		:param max_batch: наибольший размер пачки, строк
+		:param min_interval: наименьший интервал слива, секунд
+		:param max_interval: наибольший интервал слива, секунд
+		:param target_latency: желаемая длительность одного INSERT, секунд
+		:param initial_batch: начальный размер пачки
+		:param initial_interval: начальный интервал слива
+		"""
+		super(AdaptiveBatchController, self).__init__()
+		self.min_batch = min_batch
+		self.max_batch = max_batch
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.target_latency = target_latency
+
+		self.batch_size = self._clamp(initial_batch, min_batch, max_batch)
+		self.flush_interval = self._clamp(initial_interval, min_interval, max_interval)
+
+		self.max_allowed_packet = None
+		self.row_latency = None  # секунд на строку
+		self.row_bytes = None  # байт на строку
+		self.last_insert_latency = None
+		self.last_queue_depth = 0
+		self.limited_by = None  # что ограничило размер пачки при последнем решении
+		self.last_log_time = time()
+
+	@staticmethod
+	def _clamp(value, low, high):
+		return max(low, min(high, value))
+
+	def _smooth(self, old, new):
+		return new if old is None else old + self.SMOOTHING * (new - old)
+
+	def set_max_allowed_packet(self, size):
+		""":param size: значение @@max_allowed_packet сервера, байт"""
+		self.max_allowed_packet = size
+		self._update_batch_size()
+
+	def observe_insert(self, rows, seconds, size):
+		"""
+		Учитывает результат очередного INSERT.
+		:param rows: количество строк в запросе
+		:param seconds: длительность запроса
+		:param size: примерный объём данных запроса, байт
+		"""
+		if not rows:
+			return
+		self.last_insert_latency = seconds
+		self.row_latency = self._smooth(self.row_latency, seconds / rows)
+		self.row_bytes = self._smooth(self.row_bytes, size / rows)
+		self._update_batch_size()
+
+	def observe_queue_depth(self, depth):
+		"""
+		Учитывает количество сообщений, ждущих обработки. Вызывается после каждого слива.
+		:param depth: размер очереди
+		"""
+		self.last_queue_depth = depth
+		self._update_batch_size()
+		if depth:
+			# есть отставание - сливаем часто, пачки всё равно наберутся полными
+			self.flush_interval = self.min_interval
+		else:
+			# очередь пуста - сливаем реже, собирая больше строк в один запрос
+			self.flush_interval = self._clamp(self.flush_interval * self.INTERVAL_GROWTH,
+											self.min_interval, self.max_interval)
+		self._log()
+
+	def backlog_factor(self):
+		"""Во сколько раз при текущей глубине очереди можно превысить target_latency"""
+		return min(1 + self.last_queue_depth / self.BACKLOG_DEPTH_STEP, self.MAX_BACKLOG_FACTOR)
+
+	def _update_batch_size(self):
+		limits = {}
+		if self.row_latency:
+			limits['latency'] = self.target_latency * self.backlog_factor() / self.row_latency
+		if self.max_allowed_packet and self.row_bytes:
+			limits['max_allowed_packet'] = self.max_allowed_packet * self.PACKET_USAGE / self.row_bytes
+		if not limits:
+			return
+
+		self.limited_by, wanted = min(limits.items(), key=lambda item: item[1])
+		# не даём размеру прыгать слишком резко от одного наблюдения
+		wanted = self._clamp(wanted, self.batch_size / self.MAX_STEP, self.batch_size * self.MAX_STEP)
+		batch_size = int(self._clamp(wanted, self.min_batch, self.max_batch))
+		if 'max_allowed_packet' in limits:
+			# превышение max_allowed_packet - ошибка запроса, поэтому это ограничение важнее min_batch
+			batch_size = max(1, min(batch_size, int(limits['max_allowed_packet'])))
+		self.batch_size = batch_size
+
+	def metrics(self):
+		"""Текущие решения и наблюдения контроллера"""
+		return {
+			'batch_size': self.batch_size,
+			'flush_interval': self.flush_interval,
+			'row_latency': self.row_latency,
+			'row_bytes': self.row_bytes,
+			'last_insert_latency': self.last_insert_latency,
+			'queue_depth': self.last_queue_depth,
+			'backlog_factor': self.backlog_factor(),
+			'max_allowed_packet': self.max_allowed_packet,
+			'limited_by': self.limited_by,
+		}
+
+	def _log(self):
+		if time() - self.last_log_time > self.LOG_PERIOD:
+			self.last_log_time = time()
+			logging.info("Batch controller: {}".format(self.metrics()))
@@ -1,7 +1,8 @@
 import logging
-import json
 
+from lib import json_codec
 from loaders.abstract_loader import AbstractLogLoader
+from protocols.android_log_protocol import AndroidLogProtocol
 
 
 class AndroidLogLoader(AbstractLogLoader):
@@ -20,12 +21,19 @@ class AndroidLogLoader(AbstractLogLoader):
 		)
 
 	def handle(self, value):
-		parse = json.loads(value.decode('utf-8'))
+		# приёмщик в режиме PASS_THROUGH строку не разбирает, поэтому проверяем её здесь
+		try:
+			parse = json_codec.loads(value)
+		except json_codec.DecodeError:
+			logging.warning("Got unparseable packet! Dropping!")
+			return None
+		if not isinstance(parse, dict) or parse.get('type') != "log" or not AndroidLogProtocol.validate(parse):
+			return None
 
 		try:
 			device_id = int(parse.get("id", 1))
 			packet_time = int(parse.get("time", 0))
-			server_time = int(parse.get("server_time", 0))
+			server_time = int(self.get_header("server_time", parse.get("server_time", 0)))
 		except ValueError:
 			return None
 
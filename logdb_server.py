@@ -8,6 +8,7 @@ monkeypatch_os_fork_functions()
 
 import logging
 import argparse
+import signal
 
 from lib.message_queue import AbstractRabbitManager
 from lib.aliver import ProcessAliver
@@ -17,6 +18,22 @@ parser = argparse.ArgumentParser()
 parser.add_argument('host')
 parser.add_argument('port')
 parser.add_argument('--loglevel', choices=['DEBUG', 'INFO', 'WARNING'])
+parser.add_argument('--receivers', type=int, default=1,
+					help="Количество процессов-приёмщиков на одном порту (SO_REUSEPORT).")
+parser.add_argument('--loaders', type=int, default=1,
+					help="Количество процессов-загрузчиков, читающих одну очередь.")
+parser.add_argument('--prefetch', type=int, default=None,
+					help="Сколько неподтверждённых строк (не сообщений!) RabbitMQ держит на каждом загрузчике. "
+						"prefetch_count = это число / размер пачки приёмщика (ProtocolHandler.BATCH_MAX_LINES).")
+parser.add_argument('--max-connections', type=int, default=None, dest='max_connections',
+					help="Сколько соединений с устройствами может держать один приёмщик.")
+parser.add_argument('--idle-timeout', type=float, default=None, dest='idle_timeout',
+					help="Через сколько секунд без данных закрывать соединение с устройством.")
+parser.add_argument('--partial-line-timeout', type=float, default=None, dest='partial_line_timeout',
+					help="Через сколько секунд закрывать соединение, не дославшее начатую строку.")
+parser.add_argument('--retention', choices=['partition', 'delete'], default='partition',
+					help="Как удалять старые логи: сбросом суточных партиций "
+						"или порционным DELETE (для таблиц без партиций).")
 parser.add_argument('--test-queue', action='store_true', dest='test_queue',
 					help="Создаёт тестовые очереди и обменники RabbitMQ "
 						"(с постфиксом _test) и использует их.")
@@ -24,8 +41,6 @@ args = parser.parse_args()
 host = args.host
 port = args.port
 
-ProcessAliver.port = port
-
 # настройки лога
 numeric_level = getattr(logging, args.loglevel)
 logging.basicConfig(format=u'[%(asctime)s] %(pathname)s:%(filename)s[LINE:%(lineno)d]# %(levelname)-8s  %(message)s',
@@ -33,21 +48,77 @@ logging.basicConfig(format=u'[%(asctime)s] %(pathname)s:%(filename)s[LINE:%(line
 
 AbstractRabbitManager.DEBUG = args.test_queue
 
+from config import QUEUE_TRANSPORT, DISK_QUEUE_DIR, DISK_QUEUE_FSYNC_INTERVAL
+from lib.disk_queue import DiskQueue
+DiskQueue.DEBUG = args.test_queue
+DiskQueue.base_directory = DISK_QUEUE_DIR
+DiskQueue.fsync_interval = DISK_QUEUE_FSYNC_INTERVAL
+if QUEUE_TRANSPORT == 'disk' and args.loaders > 1:
+	# у очереди на диске может быть только один читатель
+	logging.warning("Disk queue transport supports only one loader, ignoring --loaders {}".format(args.loaders))
+	args.loaders = 1
+
 # настраиваем протоколы
 from protocols.android_log_protocol import AndroidLogProtocol
 protocol = AndroidLogProtocol
+if args.max_connections:
+	protocol.MAX_CONNECTIONS = args.max_connections
+if args.idle_timeout:
+	protocol.IDLE_TIMEOUT = args.idle_timeout
+if args.partial_line_timeout:
+	protocol.PARTIAL_LINE_TIMEOUT = args.partial_line_timeout
 
 from protocols.protocol_handler import ProtocolHandler
 protocol_handler = ProtocolHandler
 protocol_handler.protocol = protocol
 protocol_handler.host = host
 protocol_handler.port = port
+# несколько приёмщиков слушают один порт, ядро раскидывает соединения между ними
+protocol_handler.reuse_port = args.receivers > 1
 
 from loaders.logdb_loader import AndroidLogLoader
 log_packet_loader = AndroidLogLoader
+log_packet_loader.MESSAGE_MAX_ROWS = protocol_handler.BATCH_MAX_LINES
+if args.prefetch:
+	log_packet_loader.PREFETCH_ROWS = args.prefetch
+
+# удаление старых логов
+if args.retention == 'partition':
+	# сбрасываем устаревшие суточные партиции таблицы
+	from cleaners.partition_manager import LogPartitionManager
+	retention_manager = LogPartitionManager
+else:
+	# удаляем порциями, притормаживая под нагрузку
+	from cleaners.log_base_cleaner import LogDatabaseCleaner
+	retention_manager = LogDatabaseCleaner
 
 # собираем классы доступных компонентов системы в кортеж
-component_classes = tuple(filter(None, (protocol_handler, log_packet_loader,)))
+component_classes = tuple(filter(None, (protocol_handler,)*args.receivers + (log_packet_loader,)*args.loaders +
+								(retention_manager,)))
 print("component_classes", component_classes)#debug
+
+# по SIGTERM (и Ctrl+C) компоненты дописывают принятое и завершаются, см. ProcessAliver.stop.
+# Обработчики ставятся до запуска компонентов: ProcessAliver начинает их запускать уже в конструкторе.
+# Сигнал, пришедший раньше, чем появился aliver, запоминается.
+aliver = None
+stop_signals = []
+
+
+def stop_components(signum, frame):
+	stop_signals.append(signum)
+	if aliver is not None:
+		aliver.stop()
+
+
+signal.signal(signal.SIGTERM, stop_components)
+signal.signal(signal.SIGINT, stop_components)
 aliver = ProcessAliver(component_classes)
+if stop_signals:
+	aliver.stop()
+
+from config import METRICS_ADDRESS
+if METRICS_ADDRESS:
+	from lib.metrics import MetricsServer
+	metrics_server = MetricsServer(METRICS_ADDRESS, aliver.collect_metrics)
+
 aliver.join()
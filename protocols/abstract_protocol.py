@@ -1,7 +1,10 @@
 import asyncio
 import logging
+from time import monotonic
 
 from lib.message_queue import ExchangePublisherRabbitManager
+from lib.framing import LineFramer
+from lib.timer_wheel import TimerWheel
 #TODO: соединение с устройствами иногда (очень редко) вылетает по timeout и приводит к падению программы. Попробовать отловить (https://mail.google.com/mail/#inbox/15c3e5fa6a5a84f0)
 
 
@@ -9,19 +12,44 @@ class AbstractProtocol(asyncio.Protocol):
     """
     Абстрактный протокол. Создается на каждое соединение с сервером.
         client_id - идентификатор клиента
-        buffer - буфер для хранения данных, пришедших от клиента
+        buffer - буфер для хранения данных, пришедших от клиента (LineFramer)
         is_auth - клиент аутентифицирован
         transport - объект представляющий соединение с клиентом
     """
 
     protocol_manager = None
 
+    # Реестр живых соединений этого процесса. Нужен, чтобы разом останавливать и возобновлять чтение,
+    # ограничивать число соединений и закрывать зависшие.
+    connections = set()
+    # чтение приостановлено, потому что очередь на отправку в RabbitMQ переполнена
+    reading_paused = False
+
+    # сколько соединений может держать один процесс-приёмщик. Сверх этого новые соединения сразу закрываются.
+    MAX_CONNECTIONS = 1000
+    # соединение, от которого столько секунд ничего не приходило, закрывается. None - не закрывать.
+    IDLE_TIMEOUT = 300
+    # Соединение, которое столько секунд не может дослать начатую строку (медленная отправка по байту,
+    # slowloris), закрывается, даже если данные понемногу идут. None - не закрывать.
+    PARTIAL_LINE_TIMEOUT = 60
+    # точность таймаутов, секунд
+    TIMEOUT_RESOLUTION = 1
+    # как часто сообщать менеджеру зависаний, что цикл событий жив
+    TICK_INTERVAL = 10
+    # TimerWheel с таймаутами всех соединений процесса. Создаётся в start_timers()
+    timers = None
+
+    # максимальная длина одной строки от устройства. Более длинные строки сбрасываются.
+    MAX_LINE_LENGTH = 1024*1024
+
     def __init__(self, rabbit_exchange, rabbit_queues):
         self.client_id = 1
         self.client_id_bytes = self.client_id.to_bytes(1, 'little')
-        self.buffer = b''
+        self.buffer = LineFramer(max_line_length=self.MAX_LINE_LENGTH)
         self.is_auth = True
         self.transport = None
+        self.last_activity = monotonic()  # когда от устройства последний раз что-то приходило
+        self.partial_since = None  # когда пришло начало недочитанной строки, None - её нет
 
         # менеджер очередей задан через Protocol handler.
         # Надо сделать более вмемяемую схему, на самом деле, чтобы меньше взаимосвязей.
@@ -53,8 +81,20 @@ class AbstractProtocol(asyncio.Protocol):
         :param transport: соединение с клиентом
         :return:
         """
-        logging.info("Установлено соединение с новым устройством!")
         self.transport = transport
+        if len(self.connections) >= self.MAX_CONNECTIONS:
+            logging.warning("Too many connections ({})! Closing new connection from {}".format(
+                len(self.connections), transport.get_extra_info('peername')))
+            self.protocol_manager.metrics.inc('receiver_connections_rejected_total')
+            transport.abort()
+            return
+        logging.info("Установлено соединение с новым устройством!")
+        self.last_activity = monotonic()
+        self.connections.add(self)
+        self.protocol_manager.metrics.set('receiver_connections', len(self.connections))
+        self.schedule_timeout()
+        if self.reading_paused:
+            transport.pause_reading()
 
     def process_data(self, data):
         """
@@ -72,10 +112,25 @@ class AbstractProtocol(asyncio.Protocol):
         :param data: "какие-нибудь данные"
         :return:
         """
+        self.last_activity = monotonic()
+        self.protocol_manager.metrics.inc('receiver_bytes_total', len(data))
+        buffered = len(self.buffer)
         status = self.process_data(data)
         if status:
             self.freeze_tick()  # менеджеру зависаний
 
+        if self.buffer.discarding:
+            # слишком длинная строка выбрасывается, но так и не дослана: отсчёт PARTIAL_LINE_TIMEOUT не сбрасываем
+            if self.partial_since is None:
+                self.partial_since = self.last_activity
+                self.schedule_timeout()
+        elif not len(self.buffer):
+            self.partial_since = None
+        elif self.partial_since is None or len(self.buffer) < buffered + len(data):
+            # из буфера что-то ушло, значит, недочитанная строка началась в этих данных
+            self.partial_since = self.last_activity
+            self.schedule_timeout()
+
     def connection_lost(self, exc):
         """
         Вызывается, когда теряется соединение с клиентом.
@@ -83,3 +138,86 @@ class AbstractProtocol(asyncio.Protocol):
         :return:
         """
         logging.info("Соединение с клиентом {} потеряно!".format(self.client_id))
+        self.connections.discard(self)
+        self.protocol_manager.metrics.set('receiver_connections', len(self.connections))
+        if self.timers is not None:
+            self.timers.discard(self)
+
+    def timeout_deadline(self):
+        """Когда соединение надо закрыть, если от него ничего не придёт (по monotonic()), или None"""
+        deadlines = []
+        if self.IDLE_TIMEOUT is not None:
+            deadlines.append(self.last_activity + self.IDLE_TIMEOUT)
+        if self.PARTIAL_LINE_TIMEOUT is not None and self.partial_since is not None:
+            deadlines.append(self.partial_since + self.PARTIAL_LINE_TIMEOUT)
+        return min(deadlines, default=None)
+
+    def schedule_timeout(self):
+        if self.timers is None:
+            return
+        deadline = self.timeout_deadline()
+        if deadline is not None:
+            self.timers.schedule(self, deadline)
+
+    def reset_timeout(self):
+        """Отсчитывает таймауты соединения заново с текущего момента"""
+        self.last_activity = monotonic()
+        if self.partial_since is not None:
+            self.partial_since = self.last_activity
+        self.schedule_timeout()
+
+    def timeout_expired(self):
+        """Вызывается колесом таймеров, когда наступил timeout_deadline()"""
+        if self.transport.is_closing():
+            return
+        if self.reading_paused:
+            # данные не приходят, потому что мы сами их не читаем - отсчёт начинаем заново
+            self.reset_timeout()
+            return
+        metrics = self.protocol_manager.metrics
+        if self.partial_since is not None and self.PARTIAL_LINE_TIMEOUT is not None and \
+                monotonic() >= self.partial_since + self.PARTIAL_LINE_TIMEOUT:
+            logging.info("Closing connection that has not finished a line for {} s".format(self.PARTIAL_LINE_TIMEOUT))
+            metrics.inc('receiver_connections_partial_line_closed_total')
+        else:
+            logging.info("Closing connection idle for more than {} s".format(self.IDLE_TIMEOUT))
+            metrics.inc('receiver_connections_idle_closed_total')
+        # abort, а не close: устройство, которое не читает, не даст дописать буфер отправки
+        self.transport.abort()
+
+    @classmethod
+    def pause_reading_all(cls):
+        """Перестаёт читать данные со всех устройств (TCP сам притормозит их отправку)"""
+        cls.reading_paused = True
+        for protocol in cls.connections:
+            protocol.transport.pause_reading()
+
+    @classmethod
+    def resume_reading_all(cls):
+        cls.reading_paused = False
+        for protocol in cls.connections:
+            # пока чтение стояло, таймауты не шли
+            protocol.reset_timeout()
+            protocol.transport.resume_reading()
+
+    @classmethod
+    def close_all(cls):
+        """Закрывает все соединения (при остановке процесса), отправив недочитанные строки как законченные"""
+        for protocol in list(cls.connections):
+            if len(protocol.buffer):
+                protocol.process_data(protocol.buffer.delimiter)
+            protocol.transport.close()
+
+    @classmethod
+    def start_timers(cls, loop):
+        """
+        Запускает в цикле событий loop таймауты соединений (одно колесо таймеров на все соединения процесса)
+        и периодический тик менеджеру зависаний, чтобы процесс без данных от устройств не считался зависшим.
+        """
+        cls.timers = TimerWheel(loop, cls.timeout_deadline, cls.timeout_expired, resolution=cls.TIMEOUT_RESOLUTION)
+
+        def tick():
+            cls.protocol_manager.working_tick(True)
+            loop.call_later(cls.TICK_INTERVAL, tick)
+
+        loop.call_later(cls.TICK_INTERVAL, tick)
@@ -1,8 +1,7 @@
 import logging
 from time import time
-import json
-from json.decoder import JSONDecodeError
 
+from lib import json_codec
 from protocols.abstract_protocol import AbstractProtocol
 
 
@@ -12,36 +11,63 @@ class AndroidLogProtocol(AbstractProtocol):
 	rabbit_queues = ("android_loader_log",)
 	rabbit_manager = None
 
+	# Режим без пересериализации: строка устройства уходит в очередь без изменений,
+	# а server_time передаётся в заголовках сообщения AMQP.
+	# Строка при этом не разбирается, а проверяется дешёво (looks_like_json_object и LOG_TYPE_MARKER),
+	# полностью её разбирает и проверяет (validate) загрузчик.
+	PASS_THROUGH = True
+	# строки без этой подстроки - точно не логи ("type": "log"), их в режиме PASS_THROUGH не пересылаем
+	LOG_TYPE_MARKER = b'"log"'
+
 	def __init__(self):
 		super(AndroidLogProtocol, self).__init__(rabbit_exchange=self.rabbit_exchange,
 												rabbit_queues=self.rabbit_queues)
 
 	def process_data(self, data):
-		self.buffer += data
-
-		while b'\n' in self.buffer:
-			index = self.buffer.index(b'\n')+1
-			decoded_data = self.buffer[:index].decode('utf-8')
-			self.buffer = self.buffer[index:]
+		metrics = self.protocol_manager.metrics
+		lines = self.buffer.feed(data)
+		metrics.inc('receiver_lines_total', len(lines))
+		for line in lines:
+			# logging.info("Got data {}".format(line))#debug
 
-			# logging.info("Got data {}".format(decoded_data))#debug
+			if self.PASS_THROUGH:
+				# строку не разбираем: полностью её проверит загрузчик
+				if not self.looks_like_json_object(line):
+					metrics.inc('receiver_parse_failures_total')
+					logging.warning("Got unparseable packet! Dropping!")
+				elif self.LOG_TYPE_MARKER in line:
+					# отправляем байты устройства как есть, время сервера - в заголовке
+					self.put_to_queue(line, headers={'server_time': int(time())})
+				continue
 
 			try:
-				parse = json.loads(decoded_data)
+				parse = json_codec.loads(line)
 
 				if parse.get('type', None) == "log":
 					if self.validate(parse):
 						parse['server_time'] = int(time())
-						data_to_send = json.dumps(parse)
-						self.put_to_queue(data_to_send)
-			except JSONDecodeError:
-				logging.warning("Got unparseable packet! Dropping!".format(decoded_data))
+						self.put_to_queue(json_codec.dumps(parse))
+					else:
+						metrics.inc('receiver_invalid_lines_total')
+			except json_codec.DecodeError:
+				metrics.inc('receiver_parse_failures_total')
+				logging.warning("Got unparseable packet! Dropping!".format(line))
 
 		return True
 
-	def validate(self, data):
+	@staticmethod
+	def looks_like_json_object(line):
+		"""
+		Дешёвая проверка строки без разбора: похожа на JSON-объект (от { до }, пробелы по краям не в счёт).
+		Строка, которая её прошла, всё равно может оказаться неправильной - такие отбрасывает загрузчик.
+		"""
+		line = line.strip()
+		return len(line) >= 2 and line[0] == 0x7b and line[-1] == 0x7d  # { и }
+
+	@staticmethod
+	def validate(data):
 		"""
-		Проверяет, что данные правильные
+		Проверяет, что данные правильные. Используется и загрузчиком (AndroidLogLoader.handle).
 		:param data: 
 		:return: 
 		"""
@@ -61,10 +87,11 @@ class AndroidLogProtocol(AbstractProtocol):
 			logging.warning("Fields missing!")
 			return False
 
-	def put_to_queue(self, data):
+	def put_to_queue(self, data, headers=None):
 		"""
 		Вызывается, чтобы передать данные от приемщика на дальнейшую обработку.
 		:param data: сами данные
+		:param headers: заголовки сообщения AMQP
 		:return:
 		"""
-		self.rabbit_manager.send_message(data)
+		self.rabbit_manager.send_message(data, headers=headers)
@@ -1,8 +1,14 @@
 from lib.common import Node
+from lib.metrics import COUNTER, GAUGE, SUMMARY
 import logging
 import asyncio
+import resource
+import signal
+from time import time
 
-from lib.message_queue import ExchangePublisherRabbitManager
+from lib.message_queue import OutboxPublisherRabbitManager, MessageBatcher
+from lib.disk_queue import DiskQueuePublisher
+from config import QUEUE_TRANSPORT
 
 class ProtocolHandler(Node):
 	"""
@@ -13,35 +19,124 @@ class ProtocolHandler(Node):
 	host = '127.0.0.1'
 	port = 11111
 	protocol = None
+	reuse_port = False  # SO_REUSEPORT, чтобы несколько процессов-приёмщиков слушали один порт
 
-	def __init__(self):
-		super(ProtocolHandler, self).__init__()
-		# передаём protocol_handler, чтобы протоколы могли передавать тики о работе
-		self.protocol.protocol_manager = self
+	# ограничения пачки строк, публикуемой одним сообщением RabbitMQ
+	BATCH_MAX_LINES = 500
+	BATCH_MAX_BYTES = 512*1024
+	BATCH_MAX_DELAY = 0  # 0 - пачка уходит в конце прохода цикла событий
+	# сколько пачек может ждать отправки в RabbitMQ
+	OUTBOX_MAX_SIZE = 1000
+	# сколько открытых файлов оставить под всё, кроме соединений с устройствами
+	RESERVED_FILES = 100
+	# сколько секунд по SIGTERM можно отправлять в очередь то, что уже принято, прежде чем выйти
+	SHUTDOWN_TIMEOUT = 10
+
+	METRICS = dict(Node.METRICS, **{
+		'receiver_bytes_total': (COUNTER, "Bytes received from devices"),
+		'receiver_lines_total': (COUNTER, "Lines received from devices"),
+		'receiver_parse_failures_total': (COUNTER, "Lines that are not valid JSON"),
+		'receiver_invalid_lines_total': (COUNTER, "Log lines with missing or malformed fields"),
+		'receiver_messages_published_total': (COUNTER, "Batches of lines published to the queue"),
+		'receiver_publish_latency_seconds': (SUMMARY, "Time from handing a batch to the publisher until it is published"),
+		'receiver_outbox_size': (GAUGE, "Batches waiting to be published to RabbitMQ"),
+		'receiver_connections': (GAUGE, "Open device connections"),
+		'receiver_connections_rejected_total': (COUNTER, "Device connections closed because of MAX_CONNECTIONS"),
+		'receiver_connections_idle_closed_total': (COUNTER, "Device connections closed because of IDLE_TIMEOUT"),
+		'receiver_connections_partial_line_closed_total': (COUNTER,
+														"Device connections closed because of PARTIAL_LINE_TIMEOUT"),
+	})
+	STATUS_METRICS = ('receiver_connections', 'receiver_lines_total', 'receiver_outbox_size')
+
+	def limit_connections(self):
+		"""Не даёт MAX_CONNECTIONS протокола превысить лимит открытых файлов процесса"""
+		soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+		if soft_limit == resource.RLIM_INFINITY:
+			return
+		# файлы нужны ещё для логов, соединений с RabbitMQ и т.п.
+		max_connections = soft_limit - self.RESERVED_FILES
+		if self.protocol.MAX_CONNECTIONS > max_connections:
+			logging.warning("Open files limit is {}, lowering max connections from {} to {}".format(
+				soft_limit, self.protocol.MAX_CONNECTIONS, max_connections))
+			self.protocol.MAX_CONNECTIONS = max_connections
 
 	def run(self):
-		# запускаем цикл событий
+		# SIGTERM дальше перехватывает цикл событий, см. stop()
+		self.handle_stop_signal()
 
-		self.protocol.rabbit_manager = ExchangePublisherRabbitManager(exchange="android_log_exchange", queues=("android_loader_log",),
-															 persistent="protocol",
-															 channel_confirm_delivery=False,
-															 )
+		# передаём protocol_handler, чтобы протоколы могли передавать тики о работе и писать метрики.
+		# Только здесь, в процессе приёмщика: все экземпляры (--receivers N) создаются в родителе заранее,
+		# и присвоение в __init__ оставило бы каждому процессу последний созданный, с чужим слотом метрик.
+		self.protocol.protocol_manager = self
+
+		# запускаем цикл событий
 
 		# автоматически loop создаётся только в главном процессе. В остальных его надо создать явно.
 		loop = asyncio.new_event_loop()
 		asyncio.set_event_loop(loop)
 
-		coro = loop.create_server(self.protocol, self.host, self.port)
+		if QUEUE_TRANSPORT == 'disk':
+			# запись в локальную очередь быстрая, отдельный поток не нужен
+			publisher = DiskQueuePublisher(exchange="android_log_exchange", queues=("android_loader_log",),
+											metrics=self.metrics)
+			if publisher.fsync_interval:
+				# хвост, записанный перед паузой в данных, не должен ждать следующего сообщения
+				def sync():
+					publisher.sync()
+					loop.call_later(publisher.fsync_interval, sync)
+				loop.call_later(publisher.fsync_interval, sync)
+		else:
+			# публикация идёт в отдельном потоке, чтобы брокер не тормозил цикл событий.
+			# Если брокер не успевает, перестаём читать данные с устройств.
+			publisher = OutboxPublisherRabbitManager(exchange="android_log_exchange", queues=("android_loader_log",),
+														loop=loop,
+														persistent="protocol",
+														channel_confirm_delivery=False,
+														max_size=self.OUTBOX_MAX_SIZE,
+														on_pause=self.protocol.pause_reading_all,
+														on_resume=self.protocol.resume_reading_all,
+														metrics=self.metrics,
+														)
+		# строки, пришедшие за один проход цикла, уходят в RabbitMQ одним сообщением
+		self.protocol.rabbit_manager = MessageBatcher(publisher, loop,
+													max_lines=self.BATCH_MAX_LINES,
+													max_bytes=self.BATCH_MAX_BYTES,
+													max_delay=self.BATCH_MAX_DELAY,
+													)
+
+		self.limit_connections()
+		self.protocol.start_timers(loop)
+
+		coro = loop.create_server(self.protocol, self.host, self.port, reuse_port=self.reuse_port or None)
 		server = loop.run_until_complete(coro)
 		logging.info('Serving on {}'.format(server.sockets[0].getsockname()))
 
-		# обрабатываем, пока не будет нажато  Ctrl+C
+		def stop():
+			logging.warning("Stopping receiver")
+			self.request_stop()
+			loop.stop()
+
+		# обрабатываем, пока не придёт SIGTERM (на Ctrl+C его присылает ProcessAliver)
+		loop.add_signal_handler(signal.SIGTERM, stop)
 		try:
 			loop.run_forever()
 		except KeyboardInterrupt:
 			pass
 
-		# закрываем сервер
+		self.drain(loop, server, publisher)
+
+	def drain(self, loop, server, publisher):
+		"""
+		Перестаёт принимать соединения, дочитывает недочитанные строки, закрывает соединения
+		и ждёт, пока всё принятое уйдёт в очередь, но не дольше SHUTDOWN_TIMEOUT.
+		"""
+		deadline = time() + self.SHUTDOWN_TIMEOUT
 		server.close()
+		self.protocol.close_all()
 		loop.run_until_complete(server.wait_closed())
+		self.protocol.rabbit_manager.flush()
+		if publisher.drain(timeout=max(0, deadline - time())):
+			logging.warning("Receiver stopped, everything received is published")
+		else:
+			logging.error("Not everything received was published in {} s!".format(self.SHUTDOWN_TIMEOUT))
 		loop.close()
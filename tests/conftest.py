@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# тесты запускаются из корня проекта (python -m pytest), но и просто pytest должен находить lib/, loaders/ и т.п.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    """Менеджеры RabbitMQ подключаются к брокеру в памяти (tests/fake_broker.py)"""
+    from lib.message_queue import AbstractRabbitManager
+    from tests.fake_broker import FakeBroker
+
+    fake = FakeBroker()
+    monkeypatch.setattr(AbstractRabbitManager, 'connect', lambda self: fake.connect())
+    monkeypatch.setattr(AbstractRabbitManager, 'persistent_connections', dict())
+    yield fake
+    # отпускаем потоки менеджеров, которые могли остаться ждать брокер
+    fake.publish_gate.set()
@@ -0,0 +1,162 @@
+"""
+Брокер RabbitMQ в памяти для тестов менеджеров из lib/message_queue.py.
+Повторяет ту часть BlockingConnection/BlockingChannel pika 0.x, которой пользуются менеджеры.
+"""
+from threading import Condition, Event
+from types import SimpleNamespace
+
+from pika.exceptions import ConnectionClosed, ChannelClosed, AMQPConnectionError
+
+
+class FakeBroker(object):
+
+    def __init__(self):
+        super(FakeBroker, self).__init__()
+        self.condition = Condition()
+        self.exchanges = {}  # имя обменника -> множество привязанных очередей
+        self.queues = {}  # имя очереди -> список (тело, заголовки)
+        self.connections = []
+        self.connect_attempts = 0
+        self.down = False  # брокер недоступен: connect() падает
+        # пока не выставлено, basic_publish ждёт (имитация медленного брокера)
+        self.publish_gate = Event()
+        self.publish_gate.set()
+        self.acks = []  # (канал, тег, multiple) всех basic_ack
+
+    def connect(self):
+        self.connect_attempts += 1
+        if self.down:
+            raise AMQPConnectionError("fake broker is down")
+        connection = FakeConnection(self)
+        self.connections.append(connection)
+        return connection
+
+    def published(self, queue):
+        """Тела сообщений, лежащих в очереди"""
+        with self.condition:
+            return [body for body, _ in self.queues.get(queue, ())]
+
+    def disconnect(self):
+        """Обрывает все соединения, как при перезапуске брокера: неподтверждённое возвращается в очереди"""
+        for connection in list(self.connections):
+            connection.close()
+
+    def unacked(self):
+        """Сколько сообщений выдано потребителям и не подтверждено"""
+        with self.condition:
+            return sum(len(channel.unacked) for connection in self.connections for channel in connection.channels)
+
+
+class FakeConnection(object):
+
+    def __init__(self, broker):
+        super(FakeConnection, self).__init__()
+        self.broker = broker
+        self.is_open = True
+        self.channels = []
+
+    def channel(self):
+        self._check()
+        channel = FakeChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def close(self):
+        with self.broker.condition:
+            if not self.is_open:
+                return
+            self.is_open = False
+            for channel in self.channels:
+                channel.requeue()
+            self.broker.condition.notify_all()
+
+    def process_data_events(self):
+        self._check()
+
+    def _check(self):
+        if not self.is_open:
+            raise ConnectionClosed(320, "fake connection closed")
+
+
+class FakeChannel(object):
+
+    def __init__(self, connection):
+        super(FakeChannel, self).__init__()
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch_count = 0
+        self.consumer = None  # (очередь, callback)
+        self.unacked = {}  # тег -> (очередь, тело, заголовки)
+        self.last_tag = 0
+
+    def confirm_delivery(self):
+        self.connection._check()
+
+    def exchange_declare(self, exchange, **kwargs):
+        self.connection._check()
+        with self.broker.condition:
+            self.broker.exchanges.setdefault(exchange, set())
+
+    def queue_declare(self, queue, **kwargs):
+        self.connection._check()
+        with self.broker.condition:
+            self.broker.queues.setdefault(queue, [])
+
+    def queue_bind(self, exchange, queue):
+        self.connection._check()
+        with self.broker.condition:
+            self.broker.exchanges[exchange].add(queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.publish_gate.wait()
+        self.connection._check()
+        headers = properties.headers if properties else None
+        with self.broker.condition:
+            queues = self.broker.exchanges[exchange] if exchange else (routing_key,)
+            for queue in queues:
+                self.broker.queues[queue].append((body, headers))
+            self.broker.condition.notify_all()
+
+    def basic_qos(self, prefetch_count=0):
+        self.connection._check()
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, consumer_callback, queue):
+        self.connection._check()
+        self.consumer = (queue, consumer_callback)
+
+    def start_consuming(self):
+        """Отдаёт сообщения потребителю, пока соединение не закроют, с учётом prefetch_count"""
+        queue, callback = self.consumer
+        while True:
+            with self.broker.condition:
+                while self.connection.is_open and not (
+                        self.broker.queues[queue] and
+                        (not self.prefetch_count or len(self.unacked) < self.prefetch_count)):
+                    self.broker.condition.wait(0.05)
+                self.connection._check()
+                body, headers = self.broker.queues[queue].pop(0)
+                self.last_tag += 1
+                tag = self.last_tag
+                self.unacked[tag] = (queue, body, headers)
+            callback(self, SimpleNamespace(delivery_tag=tag), SimpleNamespace(headers=headers), body)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.connection._check()
+        with self.broker.condition:
+            self.broker.acks.append((self, delivery_tag, multiple))
+            if delivery_tag not in self.unacked:
+                # RabbitMQ закрывает канал с PRECONDITION_FAILED, здесь для простоты закрывается всё соединение
+                self.connection.close()
+                raise ChannelClosed(406, "unknown delivery tag {}".format(delivery_tag))
+            tags = [tag for tag in self.unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+            for tag in tags:
+                del self.unacked[tag]
+            self.broker.condition.notify_all()
+
+    def requeue(self):
+        """Возвращает неподтверждённые сообщения в начало их очередей. Вызывается под condition."""
+        for tag in sorted(self.unacked, reverse=True):
+            queue, body, headers = self.unacked[tag]
+            self.broker.queues[queue].insert(0, (body, headers))
+        self.unacked.clear()
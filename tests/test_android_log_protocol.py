@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+import pytest
+
+from lib import json_codec
+from lib.metrics import MetricsSlot
+from protocols.android_log_protocol import AndroidLogProtocol
+from protocols.protocol_handler import ProtocolHandler
+
+
+class Publisher(object):
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, message, headers=None):
+        self.messages.append((message, headers))
+
+
+@pytest.fixture
+def protocol(monkeypatch):
+    monkeypatch.setattr(AndroidLogProtocol, 'protocol_manager',
+                        SimpleNamespace(metrics=MetricsSlot(ProtocolHandler.METRICS), working_tick=lambda status: None))
+    monkeypatch.setattr(AndroidLogProtocol, 'rabbit_manager', Publisher())
+    return AndroidLogProtocol()
+
+
+def test_pass_through_forwards_device_bytes(protocol):
+    line = b'{"type": "log", "id": "42", "time": 1500000000, "text": "\xd0\xbf\xd1\x80\xd0\xb8"}'
+    protocol.data_received(line + b'\n')
+    (message, headers), = protocol.rabbit_manager.messages
+    assert message == line
+    assert isinstance(headers['server_time'], int)
+
+
+def test_pass_through_drops_without_parsing(protocol, monkeypatch):
+    def loads(data):
+        raise AssertionError("receiver must not parse lines in PASS_THROUGH mode")
+    monkeypatch.setattr(json_codec, 'loads', loads)
+
+    protocol.data_received(b'not json\n{"type": "ping"}\n {"type":"log"} \r\n')
+    assert [message for message, _ in protocol.rabbit_manager.messages] == [b' {"type":"log"} \r']
+    assert protocol.protocol_manager.metrics.get('receiver_parse_failures_total') == 1
+
+
+def test_full_validation_mode(protocol, monkeypatch):
+    monkeypatch.setattr(AndroidLogProtocol, 'PASS_THROUGH', False)
+    protocol.data_received(b'{"type": "log", "id": "42", "time": 1, "text": "a"}\n'
+                           b'{"type": "log", "id": 42, "time": 1, "text": "a"}\nnot json\n')
+    (message, headers), = protocol.rabbit_manager.messages
+    assert json_codec.loads(message)['server_time']
+    metrics = protocol.protocol_manager.metrics
+    assert metrics.get('receiver_invalid_lines_total') == 1
+    assert metrics.get('receiver_parse_failures_total') == 1
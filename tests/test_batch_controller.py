@@ -0,0 +1,39 @@
+from loaders.batch_controller import AdaptiveBatchController
+
+
+def make_controller():
+    controller = AdaptiveBatchController(min_batch=10, max_batch=10000, target_latency=0.1, initial_batch=100)
+    # 1 мс на строку: в target_latency укладывается 100 строк
+    for _ in range(20):
+        controller.observe_insert(100, 0.1, 100 * 200)
+    return controller
+
+
+def test_batch_size_follows_latency():
+    controller = make_controller()
+    assert controller.batch_size == 100
+    assert controller.limited_by == 'latency'
+
+
+def test_batch_size_grows_with_backlog_and_shrinks_back():
+    controller = make_controller()
+    sizes = []
+    for depth in (10, 30, 1000, 1000):
+        controller.observe_queue_depth(depth)
+        sizes.append(controller.batch_size)
+    assert sizes == [200, 400, 400, 400]  # MAX_BACKLOG_FACTOR = 4
+    assert controller.flush_interval == controller.min_interval
+
+    controller.observe_queue_depth(0)
+    assert controller.batch_size == 200  # не больше чем вдвое за решение
+    controller.observe_queue_depth(0)
+    assert controller.batch_size == 100
+    assert controller.flush_interval > controller.min_interval
+
+
+def test_max_allowed_packet_wins_over_backlog():
+    controller = make_controller()
+    controller.set_max_allowed_packet(100 * 200)
+    controller.observe_queue_depth(1000)
+    assert controller.batch_size == 80  # PACKET_USAGE = 0.8
+    assert controller.limited_by == 'max_allowed_packet'
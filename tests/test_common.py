@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+from lib.common import Node
+
+
+class Reader(object):
+    def __init__(self):
+        self.acks = []
+
+    def ack(self, tag, channel=None, multiple=True):
+        self.acks.append((tag, channel, multiple))
+
+
+def make_node():
+    node = Node()
+    node.read_rabbit_manager = Reader()
+    return node
+
+
+def test_ack_batch_acks_highest_tag_once():
+    node = make_node()
+    channel = object()
+    assert node.ack_batch([None, 3, None, 5, 4], channel)
+    assert node.read_rabbit_manager.acks == [(5, channel, True)]
+
+
+def test_ack_batch_without_tags():
+    node = make_node()
+    assert not node.ack_batch([None, None])
+    assert not node.ack_batch([])
+    assert node.read_rabbit_manager.acks == []
+
+
+def test_get_header():
+    node = make_node()
+    assert node.get_header('server_time', 7) == 7
+    node.current_properties = SimpleNamespace(headers={'server_time': 1})
+    assert node.get_header('server_time') == 1
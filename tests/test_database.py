@@ -0,0 +1,190 @@
+import threading
+
+import pytest
+
+MySQLdb = pytest.importorskip("MySQLdb")
+
+from lib import database
+from lib.database import ConnectionPool, Database, PoolTimeout, load_data_value
+
+
+class Cursor(object):
+    def __init__(self, executed, local_infile=True):
+        self.executed = executed
+        self.local_infile = local_infile
+
+    def execute(self, query, args=None):
+        if query.startswith("LOAD DATA"):
+            if not self.local_infile:
+                raise MySQLdb.OperationalError(3948, "Loading local data is disabled")
+            with open(args[0], 'rb') as f:
+                self.executed.append(('load', f.read()))
+            return 1
+        self.executed.append(('insert', args))
+        return 1
+
+    def executemany(self, query, rows):
+        self.executed.append(('insert many', list(rows)))
+        return len(rows)
+
+
+class Connection(object):
+    local_infile = True  # разрешён ли LOAD DATA LOCAL на "сервере"
+
+    def __init__(self, **config):
+        self.config = config
+        self.executed = []
+        self.alive = True
+        self.closed = False
+
+    def autocommit(self, value):
+        pass
+
+    def cursor(self):
+        return Cursor(self.executed, self.local_infile)
+
+    def ping(self):
+        if not self.alive:
+            raise MySQLdb.OperationalError(2006, "MySQL server has gone away")
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+
+    def connect(**config):
+        opened.append(Connection(**config))
+        return opened[-1]
+    monkeypatch.setattr(database, 'DB_CONFIG', {'logdb': {'host': 'localhost'}})
+    monkeypatch.setattr(database.MySQLdb, 'connect', connect)
+    monkeypatch.setattr(ConnectionPool, '_pools_pid', None)
+    monkeypatch.setattr(Database, 'bulk_load_refused', set())
+    return opened
+
+
+def test_load_data_value():
+    assert load_data_value(None) == '\\N'
+    assert load_data_value('a\tb\nc\\d\0') == 'a\\tb\\nc\\\\d\\0'
+    assert load_data_value(5) == '5'
+
+
+def test_local_infile_only_on_bulk_connections(connections):
+    with Database('logdb', persistent=True):
+        pass
+    with Database('logdb', persistent=True, local_infile=True):
+        pass
+    assert [c.config.get('local_infile') for c in connections] == [None, 1]
+
+
+def test_unencodable_rows_are_inserted_one_by_one(connections):
+    with Database('logdb', persistent=True, local_infile=True) as db:
+        loaded = db.bulk_load('logs', ('id', 'text'), [(1, 'ok'), (2, 'bad \ud800'), (3, 'тоже ok')])
+    assert loaded == 2
+    assert connections[0].executed == [('load', '1\tok\n3\tтоже ok\n'.encode('utf-8')),
+                                       ('insert', (2, 'bad \ud800'))]
+
+
+def test_refused_local_infile_falls_back_to_insert(connections, monkeypatch):
+    monkeypatch.setattr(Connection, 'local_infile', False)
+    rows = [(1, 'a'), (2, 'b')]
+    with Database('logdb', persistent=True, local_infile=True) as db:
+        # база доступна, просто запрещает LOAD DATA LOCAL: не OperationalError, а обычная вставка
+        assert db.bulk_load('logs', ('id', 'text'), rows) == 2
+        assert db.bulk_load('logs', ('id', 'text'), rows) == 2
+    # после первого отказа LOAD DATA больше не пробуется
+    assert connections[0].executed == [('insert many', rows), ('insert many', rows)]
+    assert 'logdb' in Database.bulk_load_refused
+
+
+def test_other_operational_errors_are_raised(connections, monkeypatch):
+    def execute(self, query, args=None):
+        raise MySQLdb.OperationalError(2013, "Lost connection to MySQL server during query")
+    monkeypatch.setattr(Cursor, 'execute', execute)
+    with pytest.raises(MySQLdb.OperationalError):
+        with Database('logdb', persistent=True, local_infile=True) as db:
+            db.bulk_load('logs', ('id',), [(1,)])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(database, 'time', lambda: now[0])
+    return now
+
+
+def test_pool_is_bounded(connections):
+    pool = ConnectionPool('logdb', max_size=2)
+    first, second = pool.checkout(), pool.checkout()
+    with pytest.raises(PoolTimeout):
+        pool.checkout(timeout=0.05)
+
+    # занятый пул блокирует checkout до возврата соединения
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.checkout()))
+    waiter.start()
+    waiter.join(0.1)
+    assert waiter.is_alive()
+    pool.checkin(first)
+    waiter.join(1)
+    assert got == [first]
+    assert len(connections) == 2
+    stats = pool.stats()
+    assert stats['size'] == 2 and stats['checkouts'] == 3
+    assert stats['wait_time_max'] >= 0.1
+
+
+def test_idle_connection_is_reopened(connections, clock):
+    pool = ConnectionPool('logdb', max_idle_time=600, ping_interval=60)
+    conn = pool.checkout()
+    pool.checkin(conn)
+    clock[0] += 601
+    assert pool.checkout() is connections[1]
+    assert conn.closed
+    assert pool.stats()['size'] == 1
+
+
+def test_dead_connection_is_reopened_after_ping(connections, clock):
+    pool = ConnectionPool('logdb', max_idle_time=600, ping_interval=60)
+    conn = pool.checkout()
+    pool.checkin(conn)
+
+    # до ping_interval соединение выдаётся без проверки
+    clock[0] += 30
+    assert pool.checkout() is conn
+    pool.checkin(conn)
+
+    conn.alive = False
+    clock[0] += 61
+    assert pool.checkout() is connections[1]
+    assert conn.closed
+    assert pool.stats()['reconnects'] == 1
+
+
+def test_broken_connection_is_discarded(connections):
+    pool = ConnectionPool('logdb', max_size=1)
+    conn = pool.checkout()
+    pool.checkin(conn, broken=True)
+    assert conn.closed
+    assert pool.stats()['size'] == 0
+    assert pool.checkout(timeout=0.05) is connections[1]
+
+
+def test_pools_are_reset_after_fork(connections, monkeypatch):
+    pool = ConnectionPool.get('logdb')
+    assert ConnectionPool.get('logdb') is pool
+    assert ConnectionPool.get('logdb', local_infile=True) is not pool
+
+    monkeypatch.setattr(database.os, 'getpid', lambda: -1)
+    assert ConnectionPool.get('logdb') is not pool
+
+
+def test_database_stats_sums_pools(connections):
+    assert ConnectionPool.database_stats('logdb')['size'] == 0
+    with Database('logdb', persistent=True):
+        with Database('logdb', persistent=True, local_infile=True):
+            pass
+    stats = ConnectionPool.database_stats('logdb')
+    assert stats['size'] == 2 and stats['checkouts'] == 2
@@ -0,0 +1,90 @@
+from queue import Empty
+
+import pytest
+
+from lib import disk_queue
+from lib.disk_queue import DiskQueue, DiskQueuePublisher, DiskQueueReader
+
+
+@pytest.fixture(autouse=True)
+def queue_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(DiskQueue, 'base_directory', str(tmp_path))
+    monkeypatch.setattr(DiskQueueReader, 'POLL_INTERVAL', 0.01)
+    return tmp_path
+
+
+def read(reader, count):
+    messages = [reader.read_one(block=True, timeout=5) for _ in range(count)]
+    return [(method.delivery_tag, properties.headers, bytes(body)) for _, method, properties, body in messages]
+
+
+def close(reader):
+    """Отпускает блокировку читателя, как при завершении процесса"""
+    reader._lock_file.close()
+
+
+def test_fanout_and_headers():
+    publisher = DiskQueuePublisher(exchange=None, queues=('one', 'two'))
+    publisher.send_message(b'first', headers={'server_time': 1})
+    publisher.send_message('второе')
+    for queue in ('one', 'two'):
+        assert read(DiskQueueReader(queue), 2) == [(1, {'server_time': 1}, b'first'),
+                                                   (2, None, 'второе'.encode('utf-8'))]
+
+
+def test_unacked_messages_are_redelivered():
+    publisher = DiskQueuePublisher(exchange=None, queues=('q',), segment_bytes=30)
+    for n in range(6):
+        publisher.send_message(str(n).encode() * 10)
+    reader = DiskQueueReader('q')
+    read(reader, 6)
+    reader.ack(4)
+    close(reader)
+    # подтверждённые целиком сегменты удалены
+    assert len(reader.queue.list_segments()) < 6
+
+    reader = DiskQueueReader('q')
+    assert [body for _, _, body in read(reader, 2)] == [b'4' * 10, b'5' * 10]
+
+
+def test_corrupt_record_skips_the_rest_of_segment():
+    publisher = DiskQueuePublisher(exchange=None, queues=('q',))
+    publisher.send_message(b'good')
+    queue = DiskQueue('q')
+    with open(queue.segment_path(0), 'ab') as f:
+        f.write(DiskQueue.RECORD_HEADER.pack(5, 0) + b'{not}')
+    publisher.send_message(b'lost')
+
+    reader = DiskQueueReader('q')
+    assert read(reader, 1)[0][2] == b'good'
+    with pytest.raises(Empty):
+        reader.read_one(block=True, timeout=0.3)
+    # писатели ушли из испорченного сегмента, новое читается
+    publisher.send_message(b'after')
+    assert read(reader, 1)[0][2] == b'after'
+    assert reader.is_alive()
+
+
+def test_stopped_reader_fails_the_loader(monkeypatch):
+    DiskQueuePublisher(exchange=None, queues=('q',)).send_message(b'one')
+
+    def broken(self, segment, offset):
+        raise OSError("disk is gone")
+    monkeypatch.setattr(DiskQueueReader, '_read_segment', broken)
+    reader = DiskQueueReader('q')
+    reader.join(5)
+    with pytest.raises(RuntimeError):
+        reader.read_one(block=True, timeout=1)
+
+
+@pytest.mark.parametrize('interval, syncs', [(0, 3), (None, 0), (3600, 1)])
+def test_fsync_interval(monkeypatch, interval, syncs):
+    synced = []
+    monkeypatch.setattr(disk_queue.os, 'fdatasync', synced.append, raising=False)
+    monkeypatch.setattr(DiskQueue, 'fsync_interval', interval)
+    publisher = DiskQueuePublisher(exchange=None, queues=('q',))
+    for n in range(3):
+        publisher.send_message(b'x')
+    # при выходе хвост сбрасывается на диск, если сброс вообще включён
+    publisher.drain()
+    assert len(synced) == syncs
@@ -0,0 +1,72 @@
+from lib.framing import LineFramer
+
+
+def test_lines_split_across_chunks():
+    framer = LineFramer()
+    assert framer.feed(b'{"a":1}\n{"b"') == [b'{"a":1}']
+    assert len(framer) == 4
+    assert framer.feed(b':2}\n\n{"c":3}\n') == [b'{"b":2}', b'', b'{"c":3}']
+    assert len(framer) == 0
+
+
+def test_delimiter_split_across_chunks():
+    framer = LineFramer(delimiter=b'\r\n')
+    assert framer.feed(b'one\r') == []
+    assert framer.feed(b'\ntwo\r\n') == [b'one', b'two']
+
+
+def test_flush_returns_partial_line():
+    framer = LineFramer()
+    framer.feed(b'done\npartial')
+    assert framer.flush() == b'partial'
+    assert framer.flush() is None
+
+
+def test_long_line_is_dropped_with_its_tail():
+    framer = LineFramer(max_line_length=8)
+    assert framer.feed(b'0123456789') == []
+    assert len(framer) == 0
+    assert framer.discarding
+    # продолжение слишком длинной строки тоже выбрасывается, до разделителя включительно
+    assert framer.feed(b'abc\nok\n') == [b'ok']
+    assert not framer.discarding
+    assert framer.dropped_lines == 1
+
+
+def test_long_line_with_delimiter_in_same_chunk():
+    framer = LineFramer(max_line_length=4)
+    assert framer.feed(b'short\nok\n') == [b'ok']
+    assert framer.dropped_lines == 1
+
+
+def test_buffer_is_compacted():
+    framer = LineFramer()
+    for _ in range(1000):
+        framer.feed(b'x' * 100 + b'\n' + b'y' * 10)
+        framer.feed(b'\n')
+    assert len(framer._buffer) < 1000
+
+
+def test_line_of_max_length_is_kept():
+    framer = LineFramer(max_line_length=4)
+    assert framer.feed(b'1234') == []
+    assert not framer.discarding
+    assert framer.feed(b'\n12345\n') == [b'1234']
+    assert framer.dropped_lines == 1
+
+
+def test_byte_by_byte_feed():
+    framer = LineFramer(delimiter=b'\r\n')
+    lines = []
+    for byte in b'one\r\ntwo\rthree\r\n\r\n':
+        lines.extend(framer.feed(bytes([byte])))
+    assert lines == [b'one', b'two\rthree', b'']
+    assert len(framer) == 0
+
+
+def test_flush_does_not_return_tail_of_long_line():
+    framer = LineFramer(max_line_length=4)
+    framer.feed(b'0123456789')
+    assert framer.flush() is None
+    assert not framer.discarding
+    assert framer.feed(b'ok\n') == [b'ok']
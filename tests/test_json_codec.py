@@ -0,0 +1,18 @@
+import pytest
+
+from lib import json_codec
+
+
+def test_round_trip():
+    data = {'type': 'log', 'id': 'abc', 'time': 1500000000.5, 'text': 'Привет 😀 "кавычки" \\ \n'}
+    encoded = json_codec.dumps(data)
+    assert isinstance(encoded, bytes)
+    assert json_codec.loads(encoded) == data
+    assert json_codec.loads(encoded.decode('utf-8')) == data
+
+
+def test_decode_error():
+    with pytest.raises(json_codec.DecodeError):
+        json_codec.loads(b'{"type": "log"')
+    with pytest.raises(json_codec.DecodeError):
+        json_codec.loads(b'\xff\xfe')
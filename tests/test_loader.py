@@ -0,0 +1,226 @@
+from queue import Queue, Empty
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("MySQLdb")
+
+from lib.common import Node
+from lib.message_queue import MessageBatcher
+from loaders.abstract_loader import AbstractLogLoader
+
+
+class FakeReader(object):
+    """Вместо ReaderRabbitManager: отдаёт заранее заданные сообщения и записывает подтверждения"""
+
+    def __init__(self, loader, messages):
+        """:param messages: список сообщений, каждое - список строк"""
+        self.loader = loader
+        self.channel = object()
+        self.local_queue = Queue()
+        for tag, lines in enumerate(messages, 1):
+            headers = {MessageBatcher.BATCH_SIZE_HEADER: len(lines)} if len(lines) > 1 else None
+            self.local_queue.put((self.channel, SimpleNamespace(delivery_tag=tag), SimpleNamespace(headers=headers),
+                                  MessageBatcher.BATCH_DELIMITER.join(lines)))
+        self.acks = []  # (тег, записанные к моменту подтверждения строки)
+
+    def read_one(self, block=False, timeout=None):
+        try:
+            return self.local_queue.get(block=False)
+        except Empty:
+            # всё прочитано - завершаемся, как по SIGTERM
+            self.loader.stopping = True
+            raise
+
+    def is_current(self, channel):
+        return channel is None or channel is self.channel
+
+    def ack(self, tag, channel=None, multiple=True):
+        assert self.is_current(channel)
+        self.acks.append((tag, list(self.loader.committed)))
+
+
+class Loader(AbstractLogLoader):
+
+    def __init__(self):
+        super(Loader, self).__init__(protocol_name='test')
+        self.batch_controller = None
+        self.SPOOL_DIR = None
+        self.committed = []  # строки, записанные в базу
+        self.batches = []  # размеры записанных пачек
+
+    def handle(self, value):
+        return None if value == b'drop' else (value.decode(),)
+
+    def insert_batch(self, rows, bulk, retry=True):
+        self.committed.extend(row for row, in rows)
+        self.batches.append(len(rows))
+
+
+@pytest.fixture(autouse=True)
+def no_signal_handlers(monkeypatch):
+    monkeypatch.setattr(Node, 'handle_stop_signal', lambda self: None)
+
+
+def run_loader(loader, messages):
+    """Прогоняет основной цикл загрузчика по сообщениям до конца"""
+    loader.read_rabbit_manager = FakeReader(loader, messages)
+    Node.run(loader)
+    return loader.read_rabbit_manager
+
+
+def test_flush_when_prefetch_is_exhausted():
+    loader = Loader()
+    loader.PREFETCH_ROWS = 10
+    loader.MESSAGE_MAX_ROWS = 5
+    loader.BUFFER_FLUSH_TIMEOUT = 1000
+    loader.MAX_INFLIGHT_BATCHES = 0
+    # prefetch_count - 2 сообщения: больше брокер без подтверждения не отдаст, ждать таймаута нельзя
+    reader = run_loader(loader, [[b'1'], [b'2'], [b'3'], [b'4']])
+    assert [tag for tag, _ in reader.acks] == [2, 4]
+
+
+def test_buffer_is_bounded():
+    loader = Loader()
+    loader.MAX_BUFFER_ROWS = 3
+    loader.MAX_DATABLOCKS_PER_QUERY = 100
+    loader.MAX_INFLIGHT_BATCHES = 0
+    reader = run_loader(loader, [[str(n).encode() for n in range(7)]])
+    assert loader.batches == [3, 3, 1]
+    assert loader.metrics.get('loader_buffer_full_flushes_total') == 2
+    # сообщение подтверждается один раз, после записи последней строки
+    assert reader.acks == [(1, [str(n) for n in range(7)])]
+
+
+@pytest.mark.parametrize('inflight', [0, 2])
+def test_message_is_acked_only_after_its_rows_are_written(inflight):
+    loader = Loader()
+    loader.MAX_DATABLOCKS_PER_QUERY = 2
+    loader.MAX_INFLIGHT_BATCHES = inflight
+    messages = [[b'a1', b'a2', b'a3'], [b'drop'], [b'c1'], [b'drop', b'd1'], [b'e1', b'e2', b'e3', b'e4', b'e5']]
+    reader = run_loader(loader, messages)
+
+    assert reader.acks, "nothing was acked"
+    for tag, committed in reader.acks:
+        # multiple=True подтверждает все сообщения до tag включительно - все их строки должны быть уже в базе
+        expected = [line.decode() for lines in messages[:tag] for line in lines if line != b'drop']
+        assert committed[:len(expected)] == expected
+    assert reader.acks[-1][0] == len(messages)
+    # подтверждений меньше, чем строк: одно на записанную пачку
+    assert len(reader.acks) < sum(map(len, messages))
+
+
+@pytest.mark.parametrize('inflight', [0, 2])
+def test_stop_drains_buffer_and_leaves_unread_messages(inflight):
+    loader = Loader()
+    loader.BUFFER_FLUSH_TIMEOUT = 1000
+    loader.MAX_DATABLOCKS_PER_QUERY = 1000
+    loader.MAX_INFLIGHT_BATCHES = inflight
+    messages = [[b'a1', b'a2'], [b'b1', b'b2', b'b3'], [b'c1'], [b'd1'], [b'e1']]
+    handle = loader.handle
+
+    def handle_until_sigterm(value):
+        if value == b'b2':
+            # SIGTERM посреди пачки: её всё равно надо разобрать до конца
+            loader.request_stop()
+        return handle(value)
+    loader.handle = handle_until_sigterm
+    reader = run_loader(loader, messages)
+
+    # буфер не потерян: всё прочитанное записано и подтверждено
+    assert loader.committed == ['a1', 'a2', 'b1', 'b2', 'b3']
+    assert reader.acks[-1] == (2, loader.committed)
+    assert not loader.buffer and not loader.inflight_batches
+    # непрочитанные сообщения не подтверждены - брокер отдаст их заново, и это не дубликаты
+    assert reader.local_queue.qsize() == 3
+
+
+class BrokenDatabase(object):
+    """Database, на которой пачка с b'bad' падает не из-за соединения"""
+
+    loaded = []  # строки, долитые во все экземпляры
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def bulk_load(self, table, fields, rows):
+        if ('bad',) in rows:
+            raise ValueError("Incorrect string value")
+        BrokenDatabase.loaded.extend(rows)
+
+
+def test_bad_spool_batch_is_quarantined(tmp_path, monkeypatch):
+    from lib.spool import Spool
+    from loaders import abstract_loader
+
+    BrokenDatabase.loaded = []
+    monkeypatch.setattr(abstract_loader, 'Database', BrokenDatabase)
+    loader = Loader()
+    loader.spool = Spool(str(tmp_path))
+    for rows in ([('a',)], [('bad',)], [('c',)]):
+        loader.spool.append(rows)
+    loader.spool.sync()
+
+    loader.replay_spool()
+    # журнал не встаёт на плохой пачке: остальные долиты, плохая отложена
+    assert loader.spool.empty()
+    assert BrokenDatabase.loaded == [('a',), ('c',)]
+    assert loader.metrics.get('loader_rows_replayed_total') == 2
+    assert loader.metrics.get('loader_rows_quarantined_total') == 1
+    assert (tmp_path / Spool.QUARANTINE_FILE).exists()
+
+
+class RecoveringLoader(Loader):
+    """База то падает, то поднимается: пока down, insert_batch отказывает как недоступная база"""
+
+    def __init__(self):
+        super(RecoveringLoader, self).__init__()
+        self.down = False
+        self.insert_attempts = 0
+
+    def insert_batch(self, rows, bulk, retry=True):
+        from lib.database import OperationalError
+        self.insert_attempts += 1
+        if self.down:
+            raise OperationalError(2003, "Can't connect to MySQL server")
+        super(RecoveringLoader, self).insert_batch(rows, bulk, retry)
+
+
+def test_spool_drains_while_live_batches_go_to_database(tmp_path, monkeypatch):
+    from lib.spool import Spool
+    from loaders import abstract_loader
+
+    BrokenDatabase.loaded = []
+    monkeypatch.setattr(abstract_loader, 'Database', BrokenDatabase)
+    loader = RecoveringLoader()
+    loader.read_rabbit_manager = FakeReader(loader, [])
+    loader.spool = Spool(str(tmp_path))
+    loader.SPOOL_REPLAY_BATCHES = 2
+
+    loader.down = True
+    loader.write_batch([('down 1',)], bulk=False)
+    # база только что отказала - следующая пачка идёт в журнал, базу не дёргаем
+    loader.write_batch([('down 2',)], bulk=False)
+    assert loader.insert_attempts == 1
+    assert loader.spool_replay_wait() > 0
+    for n in range(3, 7):
+        loader.spool.append([('down {}'.format(n),)])
+
+    loader.down = False
+    loader.database_retry_time = 0
+    loader.write_batch([('live',)], bulk=False)
+    # новая пачка пишется сразу, а не встаёт в конец журнала, журнал доливается рядом с ней
+    assert loader.committed == ['live']
+    assert BrokenDatabase.loaded == [('down 1',), ('down 2',)]
+    # пока база отвечает, долив идёт без пауз, до конца журнала
+    assert loader.spool_replay_wait() == 0
+    while not loader.spool.empty():
+        loader.replay_spool()
+    assert len(BrokenDatabase.loaded) == 6
+    assert loader.metrics.get('loader_rows_replayed_total') == 6
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from lib.message_queue import MessageBatcher
+
+
+class Publisher(object):
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, message, headers=None):
+        self.messages.append((message, headers))
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def run_once(loop):
+    """Один проход цикла событий"""
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+
+
+def test_lines_of_one_loop_pass_go_in_one_message(loop):
+    publisher = Publisher()
+    batcher = MessageBatcher(publisher, loop)
+    batcher.send_message(b'a', headers={'server_time': 1})
+    batcher.send_message('b', headers={'server_time': 2})
+    assert publisher.messages == []
+    run_once(loop)
+
+    (body, headers), = publisher.messages
+    assert headers == {'server_time': 1, 'batch_size': 2}
+    assert MessageBatcher.split(body, headers) == [b'a', b'b']
+
+
+def test_limits_flush_immediately(loop):
+    publisher = Publisher()
+    batcher = MessageBatcher(publisher, loop, max_lines=2, max_bytes=8)
+    for line in (b'1', b'2', b'3'):
+        batcher.send_message(line)
+    assert [MessageBatcher.split(*message) for message in publisher.messages] == [[b'1', b'2']]
+    batcher.send_message(b'12345678')
+    assert [MessageBatcher.split(*message) for message in publisher.messages] == [[b'1', b'2'],
+                                                                                  [b'3', b'12345678']]
+    run_once(loop)
+    assert len(publisher.messages) == 2
+
+
+def test_explicit_flush_cancels_scheduled_one(loop):
+    publisher = Publisher()
+    batcher = MessageBatcher(publisher, loop, max_delay=60)
+    batcher.send_message(b'a')
+    batcher.flush()
+    batcher.flush()
+    run_once(loop)
+    assert len(publisher.messages) == 1
+
+
+def test_split_of_unbatched_message():
+    assert MessageBatcher.split(b'a\nb', None) == [b'a\nb']
+    assert MessageBatcher.split(b'a\nb', {'server_time': 1}) == [b'a\nb']
+    assert MessageBatcher.split(b'', {'batch_size': 1}) == [b'']
@@ -0,0 +1,23 @@
+from lib.metrics import MetricsSlot, COUNTER, SUMMARY, render
+
+
+def test_render():
+    slot = MetricsSlot({'lines_total': (COUNTER, "Lines"), 'latency_seconds': (SUMMARY, "Latency")})
+    slot.inc('lines_total', 3)
+    slot.observe('latency_seconds', 0.5)
+    assert render([({'component': 'receiver', 'slot': 0}, slot)]).splitlines() == [
+        '# HELP logdb_lines_total Lines',
+        '# TYPE logdb_lines_total counter',
+        'logdb_lines_total{component="receiver",slot="0"} 3.0',
+        '# HELP logdb_latency_seconds Latency',
+        '# TYPE logdb_latency_seconds summary',
+        'logdb_latency_seconds_sum{component="receiver",slot="0"} 0.5',
+        'logdb_latency_seconds_count{component="receiver",slot="0"} 1.0',
+    ]
+
+
+def test_label_values_and_help_are_escaped():
+    slot = MetricsSlot({'lines_total': (COUNTER, 'Lines from C:\\logs\nper device')})
+    text = render([({'queue': 'a"b\\c\nd'}, slot)])
+    assert 'logdb_lines_total{queue="a\\"b\\\\c\\nd"} 0.0' in text.splitlines()
+    assert '# HELP logdb_lines_total Lines from C:\\\\logs\\nper device' in text.splitlines()
@@ -0,0 +1,65 @@
+import asyncio
+from time import time, sleep
+
+import pytest
+
+from lib.message_queue import OutboxPublisherRabbitManager
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def run_until(loop, condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        assert time() < deadline, "timed out"
+        loop.call_soon(loop.stop)
+        loop.run_forever()
+        sleep(0.01)
+
+
+def make_publisher(loop, events):
+    return OutboxPublisherRabbitManager(exchange="exchange", queues=("queue",), loop=loop,
+                                        max_size=10, high_water=4, low_water=1,
+                                        on_pause=lambda: events.append('pause'),
+                                        on_resume=lambda: events.append('resume'))
+
+
+def test_pause_and_resume(broker, loop):
+    events = []
+    publisher = make_publisher(loop, events)
+    broker.publish_gate.clear()
+    for n in range(6):
+        publisher.send_message(str(n).encode())
+    assert events == ['pause']
+
+    broker.publish_gate.set()
+    run_until(loop, lambda: events == ['pause', 'resume'])
+    assert not publisher.paused
+    assert publisher.drain(timeout=5)
+    assert broker.published("queue") == [str(n).encode() for n in range(6)]
+
+
+def test_stale_resume_does_not_undo_new_pause(broker, loop):
+    events = []
+    publisher = make_publisher(loop, events)
+    broker.publish_gate.clear()
+    for n in range(5):
+        publisher.send_message(b'x')
+    assert events == ['pause']
+
+    # поток публикации уже попросил возобновить чтение, но до цикла событий просьба ещё не дошла,
+    # а outbox за это время снова наполнился
+    publisher._resume_scheduled = True
+    loop.call_soon_threadsafe(publisher._resume)
+    run_until(loop, lambda: not publisher._resume_scheduled)
+    assert events == ['pause']
+    assert publisher.paused
+
+    broker.publish_gate.set()
+    run_until(loop, lambda: events == ['pause', 'resume'])
+    assert publisher.drain(timeout=5)
@@ -0,0 +1,103 @@
+from time import sleep
+
+import pytest
+
+pytest.importorskip("MySQLdb")
+
+from cleaners import partition_manager
+from cleaners.log_base_cleaner import LogDatabaseCleaner
+from cleaners.partition_manager import LogPartitionManager
+
+
+class FakeDatabase(object):
+    """Таблица без партиций с заданными уникальными ключами. После ALTER ... PARTITION BY - с партициями."""
+
+    def __init__(self, unique_keys):
+        self.unique_keys = unique_keys  # {имя ключа: [столбцы]}
+        self.partitions = [(None, None)]
+        self.executed = []
+        self._result = []
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        self.executed.append(query)
+        if 'information_schema.PARTITIONS' in query:
+            self._result = self.partitions
+        elif 'information_schema.STATISTICS' in query:
+            self._result = [(name, column) for name, columns in self.unique_keys.items() for column in columns]
+        elif 'PARTITION BY RANGE' in query:
+            self.partitions = [('p20260101', 1767225600), ('pmax', 'MAXVALUE')]
+
+    def fetchall(self):
+        return self._result
+
+    def altered(self):
+        return [query for query in self.executed if query.startswith('ALTER')]
+
+
+@pytest.fixture
+def cleanups(monkeypatch):
+    calls = []
+    monkeypatch.setattr(LogDatabaseCleaner, 'cleanup', lambda self: calls.append((self.table, self.time_column)))
+    return calls
+
+
+def run(monkeypatch, db, partition_existing_table):
+    monkeypatch.setattr(partition_manager, 'Database', db)
+    manager = LogPartitionManager()
+    manager.PARTITION_EXISTING_TABLE = partition_existing_table
+    manager.maintain()
+    return manager
+
+
+def test_unpartitioned_table_falls_back_to_delete(monkeypatch, cleanups):
+    db = FakeDatabase({'PRIMARY': ['id', 'packet_time']})
+    manager = run(monkeypatch, db, partition_existing_table=False)
+    assert db.altered() == []
+    assert cleanups == [('android.logs_android', 'packet_time')]
+    assert manager.metrics.get('partitions') == 0
+
+
+def test_unique_key_without_partition_column_is_not_partitioned(monkeypatch, cleanups):
+    db = FakeDatabase({'PRIMARY': ['id'], 'device': ['device_id', 'packet_time']})
+    run(monkeypatch, db, partition_existing_table=True)
+    assert db.altered() == []
+    assert len(cleanups) == 1
+
+
+def test_partition_existing_table(monkeypatch, cleanups):
+    db = FakeDatabase({'PRIMARY': ['id', 'packet_time']})
+    manager = run(monkeypatch, db, partition_existing_table=True)
+    assert 'PARTITION BY RANGE (packet_time)' in db.altered()[0]
+    assert cleanups == []
+    assert manager.metrics.get('partitions') == 2
+
+
+def test_heartbeat_while_partitioning(monkeypatch, cleanups):
+    ticks = []
+    ticks_during_alter = []
+
+    class SlowDatabase(FakeDatabase):
+        def execute(self, query, args=None):
+            if 'PARTITION BY RANGE' in query:
+                before = len(ticks)
+                sleep(0.3)
+                ticks_during_alter.append(len(ticks) - before)
+            super(SlowDatabase, self).execute(query, args)
+
+    monkeypatch.setattr(LogPartitionManager, 'HEARTBEAT_INTERVAL', 0.05)
+    monkeypatch.setattr(LogPartitionManager, 'working_tick', lambda self, status: ticks.append(status))
+    run(monkeypatch, SlowDatabase({'PRIMARY': ['id', 'packet_time']}), partition_existing_table=True)
+    # ProcessAliver не примет перестройку таблицы за зависание
+    assert ticks_during_alter[0] >= 3
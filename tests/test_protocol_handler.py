@@ -0,0 +1,110 @@
+import os
+import signal
+import socket
+from time import sleep, monotonic
+
+import pytest
+
+from lib.disk_queue import DiskQueue, DiskQueueReader
+from lib.message_queue import MessageBatcher
+from lib.metrics import MetricsSlot
+from protocols import protocol_handler
+from protocols.android_log_protocol import AndroidLogProtocol
+from protocols.protocol_handler import ProtocolHandler
+
+LINE = b'{"type": "log", "id": "42", "time": 1500000000, "text": "hello"}\n'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait(condition, timeout=10):
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        sleep(0.05)
+    return True
+
+
+def connect(port):
+    """Подключается к приёмщику, дождавшись, пока он начнёт слушать порт"""
+    deadline = monotonic() + 10
+    while True:
+        try:
+            return socket.create_connection(('127.0.0.1', port))
+        except ConnectionRefusedError:
+            assert monotonic() < deadline, "receiver is not listening"
+            sleep(0.05)
+
+
+def send(port, data):
+    with connect(port) as connection:
+        connection.sendall(data)
+
+
+@pytest.fixture
+def handlers(tmp_path, monkeypatch):
+    monkeypatch.setattr(protocol_handler, 'QUEUE_TRANSPORT', 'disk')
+    monkeypatch.setattr(DiskQueue, 'base_directory', str(tmp_path))
+    monkeypatch.setattr(ProtocolHandler, 'protocol', AndroidLogProtocol)
+    # как ProcessAliver: все экземпляры создаются в родителе, каждому свой слот метрик, потом запуск
+    handlers = [ProtocolHandler() for _ in range(2)]
+    for handler in handlers:
+        handler.port = free_port()
+        handler.metrics = MetricsSlot(ProtocolHandler.METRICS)
+    for handler in handlers:
+        handler.start()
+    yield handlers
+    for handler in handlers:
+        if handler.is_alive():
+            os.kill(handler.pid, signal.SIGTERM)
+        handler.join(15)
+
+
+def test_each_receiver_writes_only_its_own_slot(handlers):
+    first, second = handlers
+    send(first.port, LINE)
+    send(second.port, LINE * 2)
+    assert wait(lambda: first.metrics.get('receiver_lines_total') + second.metrics.get('receiver_lines_total') >= 3)
+    assert first.metrics.get('receiver_lines_total') == 1
+    assert second.metrics.get('receiver_lines_total') == 2
+    assert first.metrics.get('receiver_bytes_total') == len(LINE)
+    assert first.metrics.get('heartbeat_time_seconds') > 0
+    assert second.metrics.get('heartbeat_time_seconds') > 0
+
+
+def test_sigterm_publishes_everything_received(handlers):
+    first, _ = handlers
+    partial = b'{"type": "log", "id": "43", "time": 1500000000, "text": "partial"}'
+    # устройство остаётся подключённым и строку так и не дописывает
+    with connect(first.port) as connection:
+        connection.sendall(LINE + partial)
+        assert wait(lambda: first.metrics.get('receiver_bytes_total') == len(LINE + partial))
+        os.kill(first.pid, signal.SIGTERM)
+        first.join(15)
+    assert first.exitcode == 0
+
+    # недочитанная строка отправлена как законченная, ничего принятого не потеряно
+    reader = DiskQueueReader('android_loader_log')
+    lines = []
+    while len(lines) < 2:
+        _, _, properties, body = reader.read_one(block=True, timeout=5)
+        lines.extend(MessageBatcher.split(bytes(body), properties.headers))
+    assert lines == [LINE.rstrip(b'\n'), partial]
+
+
+def test_sigint_is_left_to_the_parent(handlers):
+    first, _ = handlers
+    send(first.port, LINE)
+    assert wait(lambda: first.metrics.get('receiver_lines_total') == 1)
+    # Ctrl+C приходит всей группе процессов; останавливает приёмщик SIGTERM от ProcessAliver
+    os.kill(first.pid, signal.SIGINT)
+    sleep(0.3)
+    assert first.is_alive()
+    os.kill(first.pid, signal.SIGTERM)
+    first.join(15)
+    assert first.exitcode == 0
@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+import pytest
+
+from lib import timer_wheel
+from lib.metrics import MetricsSlot
+from lib.timer_wheel import TimerWheel
+from protocols import abstract_protocol
+from protocols.android_log_protocol import AndroidLogProtocol
+from protocols.protocol_handler import ProtocolHandler
+from tests.test_timer_wheel import FakeLoop
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+    def is_closing(self):
+        return self.aborted
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def get_extra_info(self, name):
+        return None
+
+
+@pytest.fixture
+def loop(monkeypatch):
+    loop = FakeLoop()
+    monkeypatch.setattr(timer_wheel, 'monotonic', loop.time)
+    monkeypatch.setattr(abstract_protocol, 'monotonic', loop.time)
+    monkeypatch.setattr(AndroidLogProtocol, 'connections', set())
+    monkeypatch.setattr(AndroidLogProtocol, 'IDLE_TIMEOUT', 20)
+    monkeypatch.setattr(AndroidLogProtocol, 'PARTIAL_LINE_TIMEOUT', 10)
+    monkeypatch.setattr(AndroidLogProtocol, 'MAX_LINE_LENGTH', 100)
+    monkeypatch.setattr(AndroidLogProtocol, 'protocol_manager',
+                        SimpleNamespace(metrics=MetricsSlot(ProtocolHandler.METRICS), working_tick=lambda status: None))
+    monkeypatch.setattr(AndroidLogProtocol, 'rabbit_manager', SimpleNamespace(send_message=lambda *args, **kw: None))
+    monkeypatch.setattr(AndroidLogProtocol, 'timers', TimerWheel(loop, AndroidLogProtocol.timeout_deadline,
+                                                                 AndroidLogProtocol.timeout_expired))
+    return loop
+
+
+def connect():
+    protocol = AndroidLogProtocol()
+    protocol.connection_made(FakeTransport())
+    return protocol
+
+
+def trickle(loop, protocol, chunk, seconds):
+    """Присылает chunk раз в секунду, как медленный отправитель"""
+    for _ in range(seconds):
+        if protocol.transport.aborted:
+            return
+        protocol.data_received(chunk)
+        loop.advance(1)
+
+
+def metric(name):
+    return AndroidLogProtocol.protocol_manager.metrics.get(name)
+
+
+def test_idle_connection_is_closed(loop):
+    protocol = connect()
+    loop.advance(19)
+    assert not protocol.transport.aborted
+    loop.advance(2)
+    assert protocol.transport.aborted
+    assert metric('receiver_connections_idle_closed_total') == 1
+
+
+def test_active_connection_is_kept(loop):
+    protocol = connect()
+    trickle(loop, protocol, b'{"type": "ping"}\n', 60)
+    assert not protocol.transport.aborted
+
+
+def test_slowloris_is_closed(loop):
+    protocol = connect()
+    trickle(loop, protocol, b'x', 30)
+    assert protocol.transport.aborted
+    assert loop.now - 1000 <= 12
+    assert metric('receiver_connections_partial_line_closed_total') == 1
+
+
+def test_slowloris_with_overlong_line_is_closed(loop):
+    protocol = connect()
+    # строка уже длиннее MAX_LINE_LENGTH и выбрасывается, буфер пуст, но разделителя так и нет
+    trickle(loop, protocol, b'x' * 60, 30)
+    assert protocol.buffer.discarding
+    assert protocol.transport.aborted
+    assert loop.now - 1000 <= 12
+    assert metric('receiver_connections_partial_line_closed_total') == 1
@@ -0,0 +1,202 @@
+import asyncio
+from time import time, sleep
+
+import pytest
+from pika.exceptions import ConnectionClosed
+
+from lib import message_queue
+from lib.message_queue import AbstractRabbitManager, ReaderRabbitManager, OutboxPublisherRabbitManager
+
+
+@pytest.fixture(autouse=True)
+def fast_reconnect(monkeypatch):
+    monkeypatch.setattr(AbstractRabbitManager, 'RECONNECT_MIN_DELAY', 0.02)
+    monkeypatch.setattr(AbstractRabbitManager, 'RECONNECT_MAX_DELAY', 0.1)
+    monkeypatch.setattr(AbstractRabbitManager, 'RECONNECT_TICK_INTERVAL', 0.02)
+
+
+def wait(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        assert time() < deadline, "timed out"
+        sleep(0.01)
+
+
+def start_reader(broker, bodies, **kwargs):
+    broker.queues['q'] = [(body, None) for body in bodies]
+    reader = ReaderRabbitManager('q', autostart=False, **kwargs)
+    # поток чтения не должен держать процесс pytest после теста
+    reader.daemon = True
+    reader.start_queue_reading()
+    return reader
+
+
+def read(reader, count):
+    return [reader.read_one(block=True, timeout=5) for _ in range(count)]
+
+
+def test_reconnect_redelivers_unacked(broker):
+    ticks = []
+    reader = start_reader(broker, [b'1', b'2', b'3'], prefetch_count=10, on_reconnect_wait=lambda: ticks.append(time()))
+    (old_channel, method, _, body), = read(reader, 1)
+    assert body == b'1'
+    wait(lambda: reader.local_queue.qsize() == 2)
+    reader.ack(method.delivery_tag, channel=old_channel)
+
+    broker.down = True
+    broker.disconnect()
+    sleep(0.3)
+    attempts = broker.connect_attempts
+    broker.down = False
+    wait(lambda: reader.generation == 1)
+    # пока брокер лежал, попытки шли с паузами, а не подряд
+    assert 3 <= attempts < 20
+    assert ticks
+
+    # предвыбранное со старого канала выброшено: брокер отдаст это заново с новыми тегами
+    messages = read(reader, 2)
+    assert [body for _, _, _, body in messages] == [b'2', b'3']
+    assert all(channel is not old_channel for channel, _, _, _ in messages)
+    assert not reader.is_current(old_channel)
+
+    # подтверждение тега старого канала пропускается, а не подтверждает чужое сообщение нового
+    acks = len(broker.acks)
+    reader.ack(2, channel=old_channel)
+    assert len(broker.acks) == acks
+    reader.ack(messages[-1][1].delivery_tag, channel=messages[-1][0])
+    wait(lambda: broker.unacked() == 0)
+    assert broker.published('q') == []
+
+
+def test_heartbeat_while_broker_is_down(broker):
+    ticks = []
+    reader = start_reader(broker, [], on_reconnect_wait=lambda: ticks.append(time()))
+    broker.down = True
+    broker.disconnect()
+    sleep(0.5)
+    broker.down = False
+    wait(lambda: reader.generation == 1)
+    # пауза между попытками растёт до RECONNECT_MAX_DELAY, но о работе сообщается каждые RECONNECT_TICK_INTERVAL
+    assert len(ticks) > 5
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < AbstractRabbitManager.RECONNECT_MAX_DELAY
+
+
+class ProcessExit(BaseException):
+    pass
+
+
+def test_attribute_error_reconnects_once(broker, monkeypatch):
+    def exit(code):
+        raise ProcessExit(code)
+    monkeypatch.setattr(message_queue.os, '_exit', exit)
+    reader = ReaderRabbitManager('q', autostart=False)
+    calls = []
+
+    def broken():
+        calls.append(reader.generation)
+        raise AttributeError("'NoneType' object has no attribute 'sendall'")
+    # повторная ошибка после переподключения завершает процесс, чтобы его перезапустил ProcessAliver
+    with pytest.raises(ProcessExit):
+        reader.catch_disconnect(broken)
+    assert calls == [0, 1]
+
+    def flaky():
+        calls.append(reader.generation)
+        if len(calls) == 3:
+            raise AttributeError("glitch")
+        return 'ok'
+    assert reader.catch_disconnect(flaky) == 'ok'
+
+
+def test_disconnect_is_retried_until_success(broker):
+    reader = ReaderRabbitManager('q', autostart=False)
+    failures = [ConnectionClosed(320, "closed")] * 3
+
+    def f():
+        if failures:
+            raise failures.pop()
+        return reader.generation
+    assert reader.catch_disconnect(f) == 3
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_stopped_reader_fails_the_loader(broker, monkeypatch):
+    def crash(self):
+        raise RuntimeError("unexpected")
+    monkeypatch.setattr(ReaderRabbitManager, '_consume_queue', crash)
+    reader = start_reader(broker, [])
+    reader.join(5)
+    # загрузчик должен упасть и быть перезапущенным, а не ждать вечно пустую очередь
+    with pytest.raises(RuntimeError):
+        reader.read_one(block=True, timeout=1)
+
+
+def test_publisher_survives_broker_restart(broker):
+    loop = asyncio.new_event_loop()
+    publisher = OutboxPublisherRabbitManager(exchange="exchange", queues=("queue",), loop=loop, max_size=1000)
+    for n in range(10):
+        publisher.send_message(str(n).encode())
+    assert publisher.drain(timeout=5)
+
+    broker.down = True
+    broker.disconnect()
+    # приёмщик продолжает принимать: сообщения копятся в outbox, поток публикации переподключается
+    for n in range(10, 30):
+        publisher.send_message(str(n).encode())
+    sleep(0.3)
+    assert len(broker.published('queue')) == 10
+    attempts = broker.connect_attempts
+    # попытки с нарастающей паузой, а не подряд
+    assert 3 <= attempts < 20
+
+    up_time = time()
+    broker.down = False
+    assert publisher.drain(timeout=5)
+    # восстановление не дольше одной паузы между попытками
+    assert time() - up_time < AbstractRabbitManager.RECONNECT_MAX_DELAY + 0.5
+    assert publisher.generation == 1
+    # ничего не потеряно и не задвоено, порядок сохранён
+    assert broker.published('queue') == [str(n).encode() for n in range(30)]
+    loop.close()
+
+
+@pytest.fixture
+def loader(monkeypatch):
+    pytest.importorskip("MySQLdb")
+    from lib.common import Node
+    from tests.test_loader import Loader
+    monkeypatch.setattr(Node, 'handle_stop_signal', lambda self: None)
+    loader = Loader()
+    loader.BUFFER_FLUSH_TIMEOUT = 1000
+    return loader
+
+
+def test_loader_drops_buffered_rows_of_closed_channel(loader):
+    from tests.test_loader import run_loader
+    handle = loader.handle
+
+    def handle_and_reconnect(value):
+        if value == b'b':
+            # переподключение, пока строки старого канала ещё в буфере
+            loader.read_rabbit_manager.channel = object()
+        return handle(value)
+    loader.handle = handle_and_reconnect
+    reader = run_loader(loader, [[b'a'], [b'b']])
+
+    assert loader.committed == []
+    assert reader.acks == []
+    assert loader.metrics.get('loader_stale_rows_dropped_total') == 2
+
+
+def test_loader_skips_batch_of_closed_channel(loader):
+    from tests.test_loader import FakeReader
+    reader = loader.read_rabbit_manager = FakeReader(loader, [])
+    old_channel = reader.channel
+    loader.write_batch([('a',), ('b',)], bulk=False, channel=old_channel)
+    assert loader.committed == ['a', 'b']
+
+    # пачка успела уйти потоку записи до переподключения: писать её нельзя, сообщения придут заново
+    reader.channel = object()
+    loader.write_batch([('c',)], bulk=False, channel=old_channel)
+    assert loader.committed == ['a', 'b']
+    assert loader.metrics.get('loader_stale_batch_rows_skipped_total') == 1
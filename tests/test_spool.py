@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+
+from lib.spool import Spool, SpoolFull
+
+
+def test_replay_in_order_and_remove_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    batches = [[(n, 'row {}'.format(n))] for n in range(10)]
+    for rows in batches:
+        spool.append(rows)
+    spool.sync()
+    assert len(spool.segments) > 1
+
+    loaded = []
+    assert spool.replay(loaded.append, limit=3) == 3
+    assert spool.replay(loaded.append) == 7
+    assert loaded == batches
+    assert spool.empty()
+    assert spool.size == 0
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith(Spool.SEGMENT_SUFFIX)]
+
+
+def test_failed_load_keeps_batch(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([(1,)])
+    spool.append([(2,)])
+
+    def load(rows):
+        if rows == [(2,)]:
+            raise ConnectionError("database is down")
+    with pytest.raises(ConnectionError):
+        spool.replay(load)
+    loaded = []
+    spool.replay(loaded.append)
+    assert loaded == [[(2,)]]
+
+
+def test_offset_survives_reopen(tmp_path):
+    spool = Spool(str(tmp_path))
+    for n in range(3):
+        spool.append([(n,)])
+    spool.replay(lambda rows: None, limit=1)
+    spool._lock_file.close()
+
+    loaded = []
+    Spool(str(tmp_path)).replay(loaded.append)
+    assert loaded == [[(1,)], [(2,)]]
+
+
+def test_torn_record_is_truncated(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([(1,)])
+    spool.sync()
+    with open(spool._path(spool.segments[-1]), 'ab') as f:
+        f.write(Spool.RECORD_HEADER.pack(100) + b'[[2')
+    spool._lock_file.close()
+
+    loaded = []
+    reopened = Spool(str(tmp_path))
+    reopened.append([(3,)])
+    reopened.replay(loaded.append)
+    assert loaded == [[(1,)], [(3,)]]
+
+
+def test_full_spool(tmp_path):
+    spool = Spool(str(tmp_path), max_bytes=64)
+    spool.append([('x' * 20,)])
+    with pytest.raises(SpoolFull):
+        spool.append([('x' * 40,)])
+
+
+def test_acquire_skips_locked_spools(tmp_path):
+    first = Spool.acquire(str(tmp_path))
+    second = Spool.acquire(str(tmp_path))
+    assert first.directory != second.directory
+
+
+def test_quarantine(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.quarantine([(1, 'bad')], ValueError('no'))
+    with open(os.path.join(str(tmp_path), Spool.QUARANTINE_FILE)) as f:
+        record = json.loads(f.readline())
+    assert record['rows'] == [[1, 'bad']]
+    assert 'ValueError' in record['error']
@@ -0,0 +1,112 @@
+import pytest
+
+from lib import timer_wheel
+from lib.timer_wheel import TimerWheel
+
+
+class FakeLoop(object):
+    """Цикл событий с ручным временем: advance() сдвигает часы и вызывает наступившие call_later"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.calls = []  # [время, функция, отменён]
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        call = [self.now + delay, callback, False]
+        self.calls.append(call)
+        return Handle(call)
+
+    def advance(self, seconds):
+        end = self.now + seconds
+        while True:
+            due = [call for call in self.calls if call[0] <= end]
+            if not due:
+                break
+            call = min(due, key=lambda c: c[0])
+            self.calls.remove(call)
+            self.now = max(self.now, call[0])
+            if not call[2]:
+                call[1]()
+        self.now = end
+
+
+class Handle(object):
+    def __init__(self, call):
+        self.call = call
+
+    def cancel(self):
+        self.call[2] = True
+
+
+@pytest.fixture
+def loop(monkeypatch):
+    loop = FakeLoop()
+    monkeypatch.setattr(timer_wheel, 'monotonic', loop.time)
+    return loop
+
+
+def test_expires_after_deadline(loop):
+    expired = []
+    wheel = TimerWheel(loop, lambda item: deadlines[item], expired.append, resolution=1, slots=8)
+    deadlines = {'a': loop.now + 2.5, 'b': loop.now + 5}
+    for item, deadline in deadlines.items():
+        wheel.schedule(item, deadline)
+    loop.advance(2.4)
+    assert expired == []
+    loop.advance(1)
+    assert expired == ['a']
+    loop.advance(3)
+    assert expired == ['a', 'b']
+    assert len(wheel) == 0
+
+
+def test_activity_moves_deadline(loop):
+    expired = []
+    deadlines = {'a': loop.now + 2}
+    wheel = TimerWheel(loop, deadlines.get, expired.append, resolution=1, slots=8)
+    wheel.schedule('a', deadlines['a'])
+    loop.advance(1.5)
+    # объект был активен - дедлайн отодвинулся, колесо переложит его при срабатывании ячейки
+    deadlines['a'] = loop.now + 2
+    loop.advance(1)
+    assert expired == []
+    loop.advance(1.5)
+    assert expired == ['a']
+
+
+def test_deadline_beyond_the_wheel(loop):
+    expired = []
+    deadline = loop.now + 20
+    wheel = TimerWheel(loop, lambda item: deadline, expired.append, resolution=1, slots=4)
+    wheel.schedule('a', deadline)
+    loop.advance(19)
+    assert expired == []
+    assert len(wheel) == 1
+    loop.advance(2)
+    assert expired == ['a']
+
+
+def test_discard_and_none_deadline(loop):
+    expired = []
+    deadlines = {'a': loop.now + 1, 'b': loop.now + 1}
+    wheel = TimerWheel(loop, lambda item: None if item == 'b' else deadlines[item], expired.append, slots=8)
+    wheel.schedule('a', deadlines['a'])
+    wheel.schedule('b', deadlines['b'])
+    wheel.discard('a')
+    loop.advance(5)
+    assert expired == []
+    assert len(wheel) == 0
+
+
+def test_earlier_deadline_replaces_later(loop):
+    expired = []
+    deadlines = {'a': loop.now + 5}
+    wheel = TimerWheel(loop, deadlines.get, expired.append, slots=8)
+    wheel.schedule('a', deadlines['a'])
+    deadlines['a'] = loop.now + 1
+    wheel.schedule('a', deadlines['a'])
+    loop.advance(2)
+    assert expired == ['a']